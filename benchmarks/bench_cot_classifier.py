@@ -0,0 +1,153 @@
+import argparse
+import itertools
+import random
+import re
+import time
+
+from opentakserver.cot.classifier import classify
+
+
+# The regex chains CoTController used before the classifier
+def get_affiliation(type):
+    if re.match("^t-", type):
+        return get_tasking(type)
+    if re.match("^a-f-", type):
+        return "friendly"
+    if re.match("^a-h-", type):
+        return "hostile"
+    if re.match("^a-u-", type):
+        return "unknown"
+    if re.match("^a-p-", type):
+        return "pending"
+    if re.match("^a-a-", type):
+        return "assumed"
+    if re.match("^a-n-", type):
+        return "neutral"
+    if re.match("^a-s-", type):
+        return "suspect"
+    if re.match("^a-j-", type):
+        return "joker"
+    if re.match("^a-k-", type):
+        return "faker"
+
+
+def get_tasking(type):
+    if re.match("^t-x-f", type):
+        return "remarks"
+    if re.match("^t-x-s", type):
+        return "state/sync"
+    if re.match("^t-s", type):
+        return "required"
+    if re.match("^t-z", type):
+        return "cancel"
+    if re.match("^t-x-c-c", type):
+        return "commcheck"
+    if re.match("^t-x-c-g-d", type):
+        return "dgps"
+    if re.match("^t-k-d", type):
+        return "destroy"
+    if re.match("^t-k-i", type):
+        return "investigate"
+    if re.match("^t-k-t", type):
+        return "target"
+    if re.match("^t-k", type):
+        return "strike"
+    if re.match("^t-", type):
+        return "tasking"
+
+
+def get_battle_dimension(type):
+    if re.match("^a-.-A", type):
+        return "airborne"
+    if re.match("^a-.-G", type):
+        return "ground"
+    if re.match("^a-.-G-I", type):
+        return "installation"
+    if re.match("^a-.-S", type):
+        return "surface/sea"
+    if re.match("^a-.-U", type):
+        return "subsurface"
+
+
+def parse_type(type):
+    if re.match("^a-.-G-I", type):
+        return "installation"
+    if re.match("^a-.-G-E-V", type):
+        return "vehicle"
+    if re.match("^a-.-G-E", type):
+        return "equipment"
+    if re.match("^a-.-A-W-M-S", type):
+        return "sam"
+    if re.match("^a-.-A-M-F-Q-r", type):
+        return "uav"
+
+
+def is_marker(type):
+    return bool(re.match("^a-[fhupansjk]-[ZPAGSUF]", type) or re.match("^b-m-p", type))
+
+
+def legacy(type):
+    return get_affiliation(type), get_battle_dimension(type), parse_type(type), is_marker(type), \
+        bool(re.match("^u-rb", type))
+
+
+def corpus(size, seed):
+    rng = random.Random(seed)
+    types = ["a-f-G-U-C", "a-h-G-E-V", "a-u-A-M-F-Q-r", "a-n-A-W-M-S", "a-f-G-I", "a-s-S", "a-j-U", "b-m-p-s-m",
+             "b-m-p-w-GOTO", "b-t-f", "u-rb-a", "u-d-f", "t-x-c-t", "t-x-d-d", "t-x-f", "t-k-d", "t-k", "t-s", "t-",
+             "b-a-o-tbl", "a-f", "a-"]
+
+    letters = ["a", "b", "t", "u", "f", "h", "x", "k", "G", "A", "S", "U", "E", "V", "I", "M", "W", "r", "-"]
+    while len(types) < size:
+        types.append("-".join(rng.choice(letters) for _ in range(rng.randint(1, 8))))
+    return types
+
+
+def check(types):
+    for type in types:
+        expected = legacy(type)
+        result = classify(type)
+        if (result.affiliation, result.battle_dimension, result.type, result.is_marker, result.is_rb_line) != expected:
+            raise AssertionError("{}: classifier returned {}, regex chain returned {}".format(type, result, expected))
+    print("check: {} CoT types classified the same as the regex chain".format(len(types)))
+
+
+def benchmark(types, events, seed):
+    rng = random.Random(seed)
+    # Live traffic is a handful of types repeated over and over
+    stream = [rng.choice(types[:40]) for _ in range(events)]
+
+    start = time.perf_counter()
+    for type in stream:
+        legacy(type)
+    legacy_elapsed = time.perf_counter() - start
+
+    classify.cache_clear()
+    start = time.perf_counter()
+    for type in stream:
+        classify(type)
+    classifier_elapsed = time.perf_counter() - start
+    cache_info = classify.cache_info()
+
+    classify.cache_clear()
+    start = time.perf_counter()
+    for type in itertools.islice(itertools.cycle(types), events):
+        classify.__wrapped__(type)
+    uncached_elapsed = time.perf_counter() - start
+
+    print("regex chain: {:.0f} ns/event".format(legacy_elapsed / events * 1e9))
+    print("classifier:  {:.0f} ns/event ({:.1f}x), {}".format(classifier_elapsed / events * 1e9,
+                                                               legacy_elapsed / classifier_elapsed, cache_info))
+    print("classifier without the cache: {:.0f} ns/event".format(uncached_elapsed / events * 1e9))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the CoT type classifier to the old regex chains")
+    parser.add_argument("--types", type=int, default=20000)
+    parser.add_argument("--events", type=int, default=500000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    types = corpus(args.types, args.seed)
+    check(types)
+    benchmark(types, args.events, args.seed)
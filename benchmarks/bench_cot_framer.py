@@ -0,0 +1,100 @@
+import argparse
+import os
+import random
+import time
+from xml.etree.ElementTree import fromstring, ParseError
+
+from opentakserver.cot.framer import CoTFramer
+
+DEFAULT_STREAM = os.path.join(os.path.dirname(__file__), "data", "cot_stream.xml")
+
+
+def random_segments(data, rng, max_segment):
+    position = 0
+    while position < len(data):
+        size = rng.randint(1, max_segment)
+        yield data[position:position + size]
+        position += size
+
+
+def frame_all(segments):
+    framer = CoTFramer()
+    frames = []
+    for segment in segments:
+        frames.extend(framer.feed(segment))
+    return frames
+
+
+# The old ClientController approach, re-parse the whole buffer after every recv() until it's well-formed
+def legacy_reparse(segments):
+    parses = 0
+    buffer = b''
+    for segment in segments:
+        buffer += segment
+        try:
+            parses += 1
+            fromstring(buffer)
+            buffer = b''
+        except ParseError:
+            pass
+    return parses
+
+
+def fuzz(stream, iterations, max_segment, seed):
+    rng = random.Random(seed)
+    expected = frame_all([stream])
+
+    for frame in expected:
+        fromstring(frame)
+
+    for i in range(iterations):
+        frames = frame_all(random_segments(stream, rng, max_segment))
+        if frames != expected:
+            raise AssertionError("Segmentation {} produced {} frames, expected {}".format(i, len(frames), len(expected)))
+
+    print("fuzz: {} random segmentations of {} events matched".format(iterations, len(expected)))
+    return expected
+
+
+def benchmark(stream, repeat, max_segment, seed):
+    rng = random.Random(seed)
+    data = stream * repeat
+    segments = list(random_segments(data, rng, max_segment))
+
+    start = time.perf_counter()
+    frames = frame_all(segments)
+    elapsed = time.perf_counter() - start
+    print("framer: {} events, {:.1f} MB in {:.3f}s, {:.0f} events/s, {:.1f} MB/s".format(
+        len(frames), len(data) / 1e6, elapsed, len(frames) / elapsed, len(data) / 1e6 / elapsed))
+
+    # A single large event split into recv()-sized chunks shows the quadratic cost of re-parsing
+    large = (b'<event version="2.0" uid="large" type="u-d-f" how="h-e"><point lat="0" lon="0" hae="0" ce="0" le="0"/>'
+             b'<detail><link_attr>' + b'<link point="40.0,-73.0"/>' * 20000 + b'</link_attr></detail></event>')
+    chunks = [large[i:i + 4096] for i in range(0, len(large), 4096)]
+
+    start = time.perf_counter()
+    frame_all(chunks)
+    framer_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parses = legacy_reparse(chunks)
+    legacy_elapsed = time.perf_counter() - start
+    print("large event ({:.1f} kB, {} chunks): framer {:.4f}s, re-parse {:.4f}s ({} parses)".format(
+        len(large) / 1e3, len(chunks), framer_elapsed, legacy_elapsed, parses))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fuzz and benchmark the streaming CoT framer")
+    parser.add_argument("streams", nargs="*", default=[DEFAULT_STREAM], help="Recorded CoT stream files")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--max-segment", type=int, default=512)
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for path in args.streams:
+        with open(path, "rb") as f:
+            stream = f.read()
+        print(path)
+        fuzz(stream, args.iterations, args.max_segment, args.seed)
+        benchmark(stream, args.repeat, args.max_segment, args.seed)
@@ -0,0 +1,92 @@
+import argparse
+import importlib
+import os
+import pkgutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask_security.models import fsqla_v3 as fsqla
+from sqlalchemy import insert, select
+
+from opentakserver import geohash
+from opentakserver.extensions import db
+
+fsqla.FsModels.set_db_info(db)
+
+import opentakserver.models
+
+# EUD's relationships need every model to be mapped
+for module in pkgutil.iter_modules(opentakserver.models.__path__):
+    importlib.import_module("opentakserver.models." + module.name)
+
+from opentakserver.models.CoT import CoT
+from opentakserver.models.EUD import EUD
+from opentakserver.models.LastPoint import LastPoint
+from opentakserver.models.Point import Point
+
+UID = "ANDROID-0123456789abcdef"
+
+
+def load(points):
+    db.session.add(EUD(uid=UID, callsign="ALPHA", platform="ATAK-CIV"))
+    db.session.commit()
+
+    start = datetime(2024, 1, 1)
+    for offset in range(0, points, 10000):
+        count = min(10000, points - offset)
+        cot_ids = db.session.scalars(insert(CoT).returning(CoT.id, sort_by_parameter_order=True), [
+            {'how': 'm-g', 'type': 'a-f-G-U-C', 'sender_callsign': 'ALPHA', 'sender_uid': UID, 'uid': UID,
+             'xml': '<event/>', 'timestamp': start + timedelta(seconds=offset + i),
+             'start': start + timedelta(seconds=offset + i), 'stale': start + timedelta(seconds=offset + i + 60)}
+            for i in range(count)]).all()
+
+        rows = []
+        for i, cot_id in enumerate(cot_ids):
+            latitude = 40.75 + (offset + i) * 1e-6
+            longitude = -73.95
+            rows.append({'uid': UID, 'device_uid': UID, 'latitude': latitude, 'longitude': longitude,
+                         'geohash': geohash.encode(latitude, longitude), 'timestamp': start + timedelta(seconds=offset + i),
+                         'cot_id': cot_id})
+        point_ids = db.session.scalars(insert(Point).returning(Point.id, sort_by_parameter_order=True), rows).all()
+        db.session.commit()
+
+    db.session.add(LastPoint(device_uid=UID, point_id=point_ids[-1], timestamp=rows[-1]['timestamp']))
+    db.session.commit()
+
+
+# Every emit and API request serializes the EUD in a fresh session
+def measure(serialize, repeat):
+    timings = []
+    for i in range(repeat):
+        db.session.remove()
+        eud = db.session.execute(select(EUD).filter_by(uid=UID)).scalar_one()
+        start = time.perf_counter()
+        last_point = serialize(eud)
+        timings.append(time.perf_counter() - start)
+    return last_point, min(timings), sorted(timings)[len(timings) // 2]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time serializing an EUD's last known position")
+    parser.add_argument("--points", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///{}".format(os.path.join(tempfile.mkdtemp(), "ots.db"))
+    db.init_app(app)
+
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        load(args.points)
+        print("loaded {} points in {:.1f} s".format(args.points, time.perf_counter() - start))
+
+        old, old_best, old_median = measure(lambda eud: eud.points[-1].to_json(), args.repeat)
+        new, new_best, new_median = measure(lambda eud: eud.to_json()['last_point'], args.repeat)
+        assert old == new, "{} != {}".format(old, new)
+
+        print("points relationship: best {:.2f} ms, median {:.2f} ms".format(old_best * 1e3, old_median * 1e3))
+        print("last_points table: best {:.2f} ms, median {:.2f} ms".format(new_best * 1e3, new_median * 1e3))
@@ -0,0 +1,118 @@
+import argparse
+import logging
+import os
+import selectors
+import socket
+import time
+
+from flask import Flask
+
+from opentakserver.SocketServer import SocketServer
+from opentakserver.cot.envelope import CoTEnvelope, PROPERTIES
+from opentakserver.cot.event import CoTEvent
+from opentakserver.cot.framer import CoTFramer
+from opentakserver.cot.protobuf import encode_event
+from opentakserver.defaultconfig import DefaultConfig
+
+DEFAULT_STREAM = os.path.join(os.path.dirname(__file__), "data", "cot_stream.xml")
+
+
+def drain(readers):
+    received = 0
+    for reader in readers:
+        try:
+            while True:
+                data = reader.recv(1048576)
+                if not data:
+                    break
+                received += len(data)
+        except BlockingIOError:
+            pass
+    return received
+
+
+# A socket server that isn't running, with clients on one end of socket pairs. The test reads the other ends
+def connect_clients(app, logger, count, protocol_version):
+    server = SocketServer(logger, app.app_context(), 0)
+    server.selector = selectors.DefaultSelector()
+    readers = []
+    for i in range(count):
+        sock, reader = socket.socketpair()
+        reader.setblocking(False)
+        server.add_client(sock, '127.0.0.1', i)
+        client = server.clients[sock.fileno()]
+        client.uid = "ANDROID-{:016x}".format(i)
+        client.callsign = "EUD-{}".format(i)
+        client.protocol_version = protocol_version
+        # Marks the client as consuming, like it does once it has sent its first SA
+        client.consumer = i
+        readers.append(reader)
+    drain(readers)
+    return server, readers
+
+
+# One RabbitMQ message per client, each client unpacking and queueing the CoT itself
+def per_client(server, body):
+    for client in list(server.clients.values()):
+        client.on_message(None, None, PROPERTIES, body)
+    server.run_callbacks()
+
+
+# One RabbitMQ message per server, unpacked once and shared by every client
+def shared(server, body):
+    server.on_broadcast(None, None, PROPERTIES, body)
+    server.run_callbacks()
+
+
+def run(server, readers, deliver, bodies, repeat):
+    best = None
+    received = 0
+    for i in range(repeat):
+        elapsed = 0
+        received = 0
+        for body in bodies:
+            start = time.process_time()
+            deliver(server, body)
+            elapsed += time.process_time() - start
+            # Reading the other end isn't the server's work
+            received += drain(readers)
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(bodies), received
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Server CPU time to hand one broadcast CoT to every streaming client. "
+                                                 "RabbitMQ isn't needed, the broker's own cost of delivering one "
+                                                 "message per client isn't included")
+    parser.add_argument("--stream", default=DEFAULT_STREAM, help="File of concatenated CoT events")
+    parser.add_argument("--recipients", type=int, default=1000)
+    parser.add_argument("--events", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    logger = logging.getLogger("bench_fanout")
+    logger.setLevel(logging.ERROR)
+
+    app = Flask(__name__)
+    app.config.from_object(DefaultConfig)
+
+    with open(args.stream, "rb") as f:
+        events = [CoTEvent.from_xml(frame) for frame in CoTFramer().feed(f.read())]
+    events = [event for event in events if event.name == 'event' and not event.attrs['uid'].endswith('ping')]
+    bodies = [CoTEnvelope.from_event("sender", event, encode_event(event)).pack()
+              for event in (events * args.events)[:args.events]]
+
+    modes = [('per client', per_client)]
+    if hasattr(SocketServer, 'on_broadcast'):
+        modes.append(('shared', shared))
+
+    for protocol_version, protocol in ((0, 'XML'), (1, 'protobuf')):
+        server, readers = connect_clients(app, logger, args.recipients, protocol_version)
+        for name, deliver in modes:
+            seconds, received = run(server, readers, deliver, bodies, args.repeat)
+            print("{:8} {:10}: {:.2f} ms per event for {} recipients, {:.1f} us per recipient, {:.1f} MB sent".format(
+                protocol, name, seconds * 1e3, args.recipients, seconds / args.recipients * 1e6, received / 1e6))
+        for reader in readers:
+            reader.close()
+        for client in server.clients.values():
+            client.sock.close()
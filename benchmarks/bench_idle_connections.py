@@ -0,0 +1,102 @@
+import argparse
+import logging
+import multiprocessing
+import socket
+import time
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0
+
+
+# Opens connections to the streaming port and keeps them open without sending anything until told to stop
+def run_clients(port, connections, ready, done):
+    sockets = []
+    for i in range(connections):
+        sockets.append(socket.create_connection(('127.0.0.1', port)))
+    ready.put(len(sockets))
+    done.wait()
+    for sock in sockets:
+        sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Latency of the TCP streaming loop and the server's CPU time while "
+                                                 "it holds many idle connections")
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--processes", type=int, default=4, help="Processes the connections are spread over")
+    parser.add_argument("--wakeups", type=int, default=200, help="Callbacks handed to the loop with call_soon()")
+    parser.add_argument("--seconds", type=int, default=5, help="How long the server's idle CPU time is measured")
+    parser.add_argument("--no-monkey-patch", action="store_true", help="Don't monkey patch with eventlet like app.py")
+    args = parser.parse_args()
+
+    if not args.no_monkey_patch:
+        import eventlet
+        eventlet.monkey_patch()
+
+    # Imported after monkey patching, like in app.py
+    from eventlet import patcher
+    from flask import Flask
+
+    from opentakserver.SocketServer import SocketServer
+    from opentakserver.defaultconfig import DefaultConfig
+
+    logger = logging.getLogger("bench_idle_connections")
+    logger.setLevel(logging.ERROR)
+
+    app = Flask(__name__)
+    app.config.from_object(DefaultConfig)
+    # The clients never speak, so don't advertise the TAK protocol to them either
+    app.config["OTS_ENABLE_TAK_PROTOCOL"] = False
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    server = SocketServer(logger, app.app_context(), port)
+    server.start()
+    time.sleep(1)
+
+    # The clients are started without the monkey patching
+    context = multiprocessing.get_context('spawn')
+    ready = context.Queue()
+    done = context.Event()
+    processes = [context.Process(target=run_clients, args=(port, args.connections // args.processes, ready, done))
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+
+    # Everything here waits with time.sleep() so a server on a green thread gets to run too
+    connections = args.connections // args.processes * args.processes
+    deadline = time.monotonic() + 300
+    while len(server.clients) < connections and time.monotonic() < deadline:
+        time.sleep(0.1)
+    for process in processes:
+        ready.get()
+    print("{} idle connections{}, {}".format(
+        len(server.clients), "" if args.no_monkey_patch else " after eventlet.monkey_patch()",
+        type(server.selector).__name__))
+
+    # How long a callback from another thread, like a broadcast from the RabbitMQ ioloop, waits for the loop
+    handled = patcher.original('threading').Event()
+    latencies = []
+    for i in range(args.wakeups):
+        handled.clear()
+        start = time.perf_counter()
+        server.call_soon(handled.set)
+        while not handled.is_set():
+            time.sleep(0.0001)
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.005)
+    print("call_soon() latency: p50 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(
+        *[percentile(latencies, fraction) * 1e3 for fraction in (0.5, 0.99, 1)]))
+
+    start = time.process_time()
+    time.sleep(args.seconds)
+    print("CPU time while idle: {:.1f} ms per second".format((time.process_time() - start) / args.seconds * 1e3))
+
+    done.set()
+    for process in processes:
+        process.join()
+    server.stop()
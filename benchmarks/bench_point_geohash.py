@@ -0,0 +1,116 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, DateTime, Float, Index, Integer, MetaData, String, Table, create_engine, func, select
+from sqlalchemy.exc import OperationalError
+
+from opentakserver import geohash
+
+metadata = MetaData()
+points = Table("points", metadata,
+               Column("id", Integer, primary_key=True),
+               Column("latitude", Float),
+               Column("longitude", Float),
+               Column("geohash", String),
+               Column("timestamp", DateTime),
+               Index("ix_points_geohash", "geohash", "latitude", "longitude"))
+
+# Half of the points are spread around the world, the other half are EUDs moving around New York
+CENTER = (40.75, -73.95)
+
+
+def generate(count, seed=0):
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    for i in range(count):
+        if i % 2:
+            latitude = rng.uniform(-80, 80)
+            longitude = rng.uniform(-180, 180)
+        else:
+            latitude = CENTER[0] + rng.gauss(0, 0.5)
+            longitude = CENTER[1] + rng.gauss(0, 0.5)
+        yield i + 1, latitude, longitude, geohash.encode(latitude, longitude), start + timedelta(seconds=i)
+
+
+def load(engine, count):
+    metadata.create_all(engine)
+    connection = engine.raw_connection()
+    cursor = connection.cursor()
+    rows = generate(count)
+    while True:
+        batch = [row for row, i in zip(rows, range(100000))]
+        if not batch:
+            break
+        cursor.executemany("INSERT INTO points (id, latitude, longitude, geohash, timestamp) VALUES (?, ?, ?, ?, ?)",
+                           batch)
+        connection.commit()
+    connection.close()
+
+
+def count(engine):
+    try:
+        with engine.connect() as connection:
+            return connection.execute(select(func.count()).select_from(points)).scalar()
+    except OperationalError:
+        return None
+
+
+def measure(engine, query, repeat):
+    timings = []
+    with engine.connect() as connection:
+        for i in range(repeat):
+            start = time.perf_counter()
+            rows = connection.execute(query).all()
+            timings.append(time.perf_counter() - start)
+    return len(rows), min(timings), sorted(timings)[len(timings) // 2]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time bounding box and radius queries on the points table")
+    parser.add_argument("--points", type=int, default=10000000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--database", help="SQLite file to reuse between runs, a temporary one is used by default")
+    args = parser.parse_args()
+
+    path = args.database or os.path.join(tempfile.mkdtemp(), "points.db")
+    engine = create_engine("sqlite:///{}".format(path))
+
+    if count(engine) != args.points:
+        engine.dispose()
+        if os.path.exists(path):
+            os.remove(path)
+        start = time.perf_counter()
+        load(engine, args.points)
+        print("loaded {} points in {:.1f} s".format(args.points, time.perf_counter() - start))
+
+    lat, lon = CENTER
+    queries = {
+        "street viewport 0.01 deg": (lon - 0.005, lat - 0.005, lon + 0.005, lat + 0.005),
+        "city viewport 0.1 deg": (lon - 0.05, lat - 0.05, lon + 0.05, lat + 0.05),
+        "regional viewport 1 deg": (lon - 0.5, lat - 0.5, lon + 0.5, lat + 0.5),
+        "antimeridian viewport": (179.5, -10, -179.5, 10),
+    }
+
+    for name, (west, south, east, north) in queries.items():
+        if west > east:
+            longitude = (points.c.longitude >= west) | (points.c.longitude <= east)
+        else:
+            longitude = points.c.longitude.between(west, east)
+        full_scan = select(points.c.id).where(points.c.latitude.between(south, north), longitude)
+        indexed = select(points.c.id).where(geohash.bbox_filter(points.c, west, south, east, north))
+
+        scan_rows, scan_best, scan_median = measure(engine, full_scan, args.repeat)
+        index_rows, index_best, index_median = measure(engine, indexed, args.repeat)
+        assert scan_rows == index_rows, "{}: {} rows scanned, {} from the index".format(name, scan_rows, index_rows)
+        print("{}: {} rows, {} geohash ranges, full scan {:.2f} ms, geohash {:.2f} ms (medians {:.2f} / {:.2f})".format(
+            name, index_rows, len(geohash.cover(west, south, east, north)), scan_best * 1e3, index_best * 1e3,
+            scan_median * 1e3, index_median * 1e3))
+
+    for meters in (500, 5000):
+        indexed = select(points.c.id).where(geohash.radius_filter(points.c, lat, lon, meters))
+        rows, best, median = measure(engine, indexed, args.repeat)
+        print("radius {} m: {} rows, geohash {:.2f} ms (median {:.2f})".format(meters, rows, best * 1e3, median * 1e3))
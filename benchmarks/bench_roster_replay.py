@@ -0,0 +1,96 @@
+import argparse
+import json
+import socket
+import time
+from datetime import datetime, timedelta
+from threading import Thread
+
+from opentakserver.cot.envelope import CoTEnvelope
+from opentakserver.cot.framer import CoTFramer
+from opentakserver.presence import PresenceRegistry
+
+SA = ('<event version="2.0" uid="{uid}" type="a-f-G-U-C" time="{time}" start="{time}" stale="{stale}" how="m-g">'
+      '<point lat="40.{n:06d}" lon="-73.{n:06d}" hae="12.1" ce="4.5" le="9999999.0"/><detail>'
+      '<takv os="34" version="4.10.0.57" device="GOOGLE PIXEL 7" platform="ATAK-CIV"/>'
+      '<contact endpoint="*:-1:stcp" callsign="EUD-{n}"/><uid Droid="EUD-{n}"/>'
+      '<__group role="Team Member" name="Cyan"/><status battery="86"/><track course="88.1" speed="1.6"/>'
+      '</detail></event>')
+
+
+def build_registry(euds):
+    presence = PresenceRegistry()
+    now = datetime.utcnow()
+    time_string = now.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    stale_string = (now + timedelta(minutes=6)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    for n in range(euds):
+        uid = "ANDROID-{:016x}".format(n)
+        cot = SA.format(uid=uid, n=n, time=time_string, stale=stale_string).encode('utf-8')
+        presence.connect(uid, "EUD-{}".format(n), cot, now, now + timedelta(minutes=6))
+    return presence
+
+
+# Reads until it has framed the expected number of events
+def receive(sock, expected, result):
+    framer = CoTFramer(max_size=64 * 1048576)
+    frames = 0
+    while frames < expected:
+        data = sock.recv(65536)
+        if not data:
+            break
+        frames += len(framer.feed(data))
+    result.append((frames, time.perf_counter()))
+
+
+def deliver(presence, send):
+    server, client = socket.socketpair()
+    result = []
+    reader = Thread(target=receive, args=(client, len(presence), result))
+    reader.start()
+
+    start = time.perf_counter()
+    writes = send(presence, server)
+    reader.join()
+    frames, end = result[0]
+
+    server.close()
+    client.close()
+    return frames, writes, end - start
+
+
+# The old path, one JSON message per EUD through the broker, each one unpacked and written by the newcomer's consumer
+def per_eud(presence, sock):
+    writes = 0
+    for uid, last_event_time, cot, proto in presence.roster():
+        body = json.dumps({'cot': cot.decode('utf-8'), 'uid': None}).encode('utf-8')
+        sock.sendall(CoTEnvelope.unpack(body).xml)
+        writes += 1
+    return writes
+
+
+def batched(presence, sock):
+    sock.sendall(b''.join(cot for uid, last_event_time, cot, proto in presence.roster()))
+    return 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time delivering the roster of online EUDs to a new EUD")
+    parser.add_argument("--euds", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    presence = build_registry(args.euds)
+    roster_bytes = sum(len(cot) for uid, last_event_time, cot, proto in presence.roster())
+    print("roster: {} EUDs, {:.1f} kB".format(len(presence), roster_bytes / 1e3))
+
+    for name, send in (("per-EUD messages", per_eud), ("batched write", batched)):
+        timings = []
+        for i in range(args.repeat):
+            frames, writes, elapsed = deliver(presence, send)
+            assert frames == args.euds, "{} delivered {} of {} events".format(name, frames, args.euds)
+            timings.append(elapsed)
+        print("{}: {} writes, best {:.2f} ms, median {:.2f} ms".format(
+            name, writes, min(timings) * 1e3, sorted(timings)[len(timings) // 2] * 1e3))
+
+    # Every EUD reconnecting at once, e.g. after a server restart
+    print("reconnect storm of {} EUDs: {} broker publishes before, {} socket writes now".format(
+        args.euds, args.euds * args.euds, args.euds))
@@ -0,0 +1,92 @@
+import argparse
+import os
+import time
+from collections import defaultdict
+
+from opentakserver.cot.envelope import CoTEnvelope
+from opentakserver.cot.event import CoTEvent
+from opentakserver.cot.framer import CoTFramer, ProtobufFramer
+from opentakserver.cot.protobuf import decode_event, encode_event, event_to_message
+
+DEFAULT_STREAM = os.path.join(os.path.dirname(__file__), "data", "cot_stream.xml")
+
+
+# Best of repeat runs, in CPU seconds
+def cpu_time(function, items, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.process_time()
+        for item in items:
+            function(item)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def xml_in(xml):
+    return CoTEnvelope.from_event(None, CoTEvent.from_xml(xml)).pack()
+
+
+def xml_in_translated(xml):
+    event = CoTEvent.from_xml(xml)
+    return CoTEnvelope.from_event(None, event, encode_event(event)).pack()
+
+
+def protobuf_in(payload):
+    event = decode_event(payload)
+    return CoTEnvelope.from_event(None, event, payload).pack()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bytes and CPU time of XML against TAK protocol version 1 (protobuf) "
+                                                 "streaming, per 1000 events")
+    parser.add_argument("--stream", default=DEFAULT_STREAM, help="File of concatenated CoT events")
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--recipients", type=int, default=50, help="Streaming clients each event is delivered to")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with open(args.stream, "rb") as f:
+        frames = [frame for frame in CoTFramer().feed(f.read()) if CoTEvent.from_xml(frame).name == 'event']
+    xmls = [frames[i % len(frames)] for i in range(args.events)]
+    events = [CoTEvent.from_xml(xml) for xml in xmls]
+    protos = [encode_event(event) for event in events]
+    payloads = [event_to_message(event).SerializeToString() for event in events]
+
+    # Translating back and forth has to be stable, and the stream has to frame back into the same payloads
+    for proto, payload in zip(protos, payloads):
+        if encode_event(decode_event(payload)) != proto:
+            raise AssertionError("{} doesn't survive a round trip".format(decode_event(payload).xml))
+    if ProtobufFramer().feed(b''.join(protos)) != payloads:
+        raise AssertionError("Framing the stream messages didn't return the payloads")
+
+    sizes = defaultdict(lambda: [0, 0, 0])
+    for event, xml, proto in zip(events, xmls, protos):
+        size = sizes[event.attrs['type']]
+        size[0] += 1
+        size[1] += len(xml)
+        size[2] += len(proto)
+
+    scale = 1000 / args.events
+    print("{} events from {}, {} recipients each".format(args.events, os.path.basename(args.stream), args.recipients))
+    for type, (count, xml_bytes, proto_bytes) in sorted(sizes.items()):
+        print("  {:12} {:>5} B XML, {:>5} B protobuf ({:.0%} smaller)".format(
+            type, xml_bytes // count, proto_bytes // count, 1 - proto_bytes / xml_bytes))
+
+    xml_bytes = sum(len(xml) for xml in xmls) * scale
+    proto_bytes = sum(len(proto) for proto in protos) * scale
+    print("bytes per 1k events: {:.1f} kB XML, {:.1f} kB protobuf, {:.1f} kB saved per recipient, {:.1f} MB for {} "
+          "recipients".format(xml_bytes / 1e3, proto_bytes / 1e3, (xml_bytes - proto_bytes) / 1e3,
+                              (xml_bytes - proto_bytes) * args.recipients / 1e6, args.recipients))
+
+    edge_xml = cpu_time(xml_in, xmls, args.repeat) * scale
+    edge_translated = cpu_time(xml_in_translated, xmls, args.repeat) * scale
+    edge_protobuf = cpu_time(protobuf_in, payloads, args.repeat) * scale
+    translate = cpu_time(encode_event, events, args.repeat) * scale
+    print("CPU per 1k events received: {:.1f} ms XML, {:.1f} ms XML translated once, {:.1f} ms protobuf".format(
+        edge_xml * 1e3, edge_translated * 1e3, edge_protobuf * 1e3))
+
+    # Without the stream message in the envelope, every client that speaks protobuf has to translate the event itself
+    print("CPU per 1k events delivered to {} protobuf clients: {:.1f} ms translating per client, {:.1f} ms translating "
+          "once, {:.1f} ms saved".format(args.recipients, translate * args.recipients * 1e3, translate * 1e3,
+                                         translate * (args.recipients - 1) * 1e3))
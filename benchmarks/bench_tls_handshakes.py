@@ -0,0 +1,188 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import selectors
+import socket
+import ssl
+import tempfile
+import time
+
+from flask import Flask
+
+from opentakserver.SocketServer import SocketServer
+from opentakserver.certificate_authority import CertificateAuthority
+from opentakserver.defaultconfig import DefaultConfig
+
+CLIENT = "bench-client"
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0
+
+
+# One client connection that connects, does the TLS handshake, optionally waits for the session ticket so the next
+# connection can resume, then disconnects and starts over
+class Connection:
+    def __init__(self, selector, context, port, resume, results):
+        self.selector = selector
+        self.context = context
+        self.port = port
+        self.resume = resume
+        self.results = results
+        self.session = None
+        self.sock = None
+        self.state = None
+        self.started = 0
+        self.connect()
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.started = time.perf_counter()
+        self.state = 'connecting'
+        self.sock.connect_ex(('127.0.0.1', self.port))
+        self.selector.register(self.sock, selectors.EVENT_WRITE, self)
+
+    def restart(self, failed=False):
+        if failed:
+            self.results['failures'] += 1
+        self.selector.unregister(self.sock)
+        self.sock.close()
+        self.connect()
+
+    def step(self):
+        try:
+            if self.state == 'connecting':
+                if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    return self.restart(True)
+                self.selector.unregister(self.sock)
+                self.sock = self.context.wrap_socket(self.sock, do_handshake_on_connect=False,
+                                                     session=self.session if self.resume else None)
+                self.selector.register(self.sock, selectors.EVENT_WRITE, self)
+                self.state = 'handshake'
+
+            if self.state == 'handshake':
+                self.sock.do_handshake()
+                self.results['latencies'].append(time.perf_counter() - self.started)
+                self.results['resumed'] += self.sock.session_reused
+                if not self.resume:
+                    return self.restart()
+                self.state = 'ticket'
+                self.selector.modify(self.sock, selectors.EVENT_READ, self)
+            elif self.state == 'ticket':
+                # Reading processes the session tickets the server sends after the handshake
+                try:
+                    self.sock.recv(1)
+                except ssl.SSLWantReadError:
+                    pass
+                self.session = self.sock.session
+                return self.restart()
+        except ssl.SSLWantReadError:
+            self.selector.modify(self.sock, selectors.EVENT_READ, self)
+        except ssl.SSLWantWriteError:
+            self.selector.modify(self.sock, selectors.EVENT_WRITE, self)
+        except (ssl.SSLError, OSError):
+            self.restart(self.state != 'ticket')
+
+
+# Connects and never starts the handshake, reconnecting whenever the server gives up on it
+class StalledConnection:
+    def __init__(self, selector, port, results):
+        self.selector = selector
+        self.port = port
+        self.results = results
+        self.connect()
+
+    def connect(self):
+        self.sock = socket.create_connection(('127.0.0.1', self.port))
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ, self)
+
+    def step(self):
+        try:
+            if self.sock.recv(4096):
+                return
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            pass
+        self.results['stalled_dropped'] += 1
+        self.selector.unregister(self.sock)
+        self.sock.close()
+        self.connect()
+
+
+def run_clients(port, ca_folder, clients, stalled, seconds, resume, queue):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.load_verify_locations(os.path.join(ca_folder, "ca.pem"))
+    context.load_cert_chain(os.path.join(ca_folder, "certs", CLIENT, CLIENT + ".pem"),
+                            os.path.join(ca_folder, "certs", CLIENT, CLIENT + ".nopass.key"))
+
+    results = {'latencies': [], 'failures': 0, 'resumed': 0, 'stalled_dropped': 0}
+    selector = selectors.DefaultSelector()
+    connections = [StalledConnection(selector, port, results) for i in range(stalled)]
+    connections += [Connection(selector, context, port, resume, results) for i in range(clients)]
+
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for key, mask in selector.select(timeout=0.5):
+            key.data.step()
+
+    queue.put(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Accept throughput and TLS handshake latency of the SSL streaming "
+                                                 "port with many clients reconnecting at once")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--stalled", type=int, default=0, help="Clients that connect and never start the handshake")
+    parser.add_argument("--seconds", type=int, default=20)
+    parser.add_argument("--processes", type=int, default=2, help="Processes the clients are spread over")
+    parser.add_argument("--resume", action="store_true", help="Resume the previous TLS session on reconnect")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("bench_tls_handshakes")
+    logger.setLevel(logging.ERROR)
+
+    app = Flask(__name__)
+    app.config.from_object(DefaultConfig)
+    app.config["OTS_CA_FOLDER"] = os.path.join(tempfile.mkdtemp(), "ca")
+    with app.app_context():
+        ca = CertificateAuthority(logger, app)
+        ca.create_ca()
+        ca.issue_certificate(CLIENT, True)
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    server = SocketServer(logger, app.app_context(), port, True)
+    server.start()
+    time.sleep(1)
+
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_clients, args=(
+        port, app.config["OTS_CA_FOLDER"], args.clients // args.processes, args.stalled // args.processes,
+        args.seconds, args.resume, queue)) for i in range(args.processes)]
+    for process in processes:
+        process.start()
+
+    results = [queue.get() for process in processes]
+    for process in processes:
+        process.join()
+
+    latencies = [latency for result in results for latency in result['latencies']]
+    print("{} clients, {} stalled, {} s{}".format(args.clients, args.stalled, args.seconds,
+                                                   ", resuming sessions" if args.resume else ""))
+    print("handshakes: {} ({:.0f}/s), {} resumed, {} failed, {} stalled connections dropped by the server".format(
+        len(latencies), len(latencies) / args.seconds, sum(result['resumed'] for result in results),
+        sum(result['failures'] for result in results), sum(result['stalled_dropped'] for result in results)))
+    print("client latency: p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms".format(
+        *[percentile(latencies, fraction) * 1e3 for fraction in (0.5, 0.9, 0.99, 1)]))
+    if hasattr(server, "handshake_stats"):
+        print("server: {}".format(server.handshake_stats()))
+
+    server.stop()
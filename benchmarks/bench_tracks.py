@@ -0,0 +1,121 @@
+import argparse
+import json
+import math
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, DateTime, Float, Index, Integer, MetaData, String, Table, create_engine, select
+
+from opentakserver import tracks
+from opentakserver.functions import iso8601_string_from_datetime
+
+metadata = MetaData()
+points = Table("points", metadata,
+               Column("id", Integer, primary_key=True),
+               Column("uid", String),
+               Column("device_uid", String),
+               Column("latitude", Float),
+               Column("longitude", Float),
+               Column("timestamp", DateTime),
+               Index("ix_points_device_uid_timestamp", "device_uid", "timestamp"))
+
+START = datetime(2024, 1, 1)
+
+
+# EUDs driving around New York, turning now and then and stopping for a while, with a few meters of GPS noise
+def generate(euds, hours, interval, seed=0):
+    rng = random.Random(seed)
+    for eud in range(euds):
+        uid = "ANDROID-{:016x}".format(eud)
+        latitude = 40.75 + rng.gauss(0, 0.05)
+        longitude = -73.95 + rng.gauss(0, 0.05)
+        heading = rng.uniform(0, 2 * math.pi)
+        speed = 10
+        for i in range(hours * 3600 // interval):
+            if rng.random() < 0.02:
+                heading += rng.gauss(0, 1)
+            if rng.random() < 0.01:
+                speed = 0 if speed else rng.uniform(5, 25)
+            latitude += speed * interval * math.cos(heading) / 111320
+            longitude += speed * interval * math.sin(heading) / (111320 * math.cos(math.radians(latitude)))
+            yield (uid, uid, latitude + rng.gauss(0, 3e-5), longitude + rng.gauss(0, 3e-5),
+                   START + timedelta(seconds=i * interval))
+
+
+def load(engine, euds, hours, interval):
+    metadata.create_all(engine)
+    connection = engine.raw_connection()
+    cursor = connection.cursor()
+    rows = generate(euds, hours, interval)
+    while True:
+        batch = [row for row, i in zip(rows, range(100000))]
+        if not batch:
+            break
+        cursor.executemany("INSERT INTO points (uid, device_uid, latitude, longitude, timestamp) VALUES (?, ?, ?, ?, ?)",
+                           batch)
+        connection.commit()
+    connection.close()
+
+
+# The same query as /api/track
+def fetch(connection, uids):
+    return connection.execute(select(points.c.device_uid, points.c.timestamp, points.c.latitude, points.c.longitude)
+                              .where(points.c.device_uid.in_(uids), points.c.uid == points.c.device_uid)
+                              .order_by(points.c.device_uid, points.c.timestamp)).all()
+
+
+def every_point(connection, uids):
+    rows = fetch(connection, uids)
+    start = time.perf_counter()
+    body = json.dumps([{'uid': uid, 'latitude': latitude, 'longitude': longitude,
+                        'timestamp': iso8601_string_from_datetime(timestamp)}
+                       for uid, timestamp, latitude, longitude in rows])
+    return len(rows), time.perf_counter() - start, len(body)
+
+
+def downsampled(connection, uids, method, count=None, tolerance=None):
+    rows = fetch(connection, uids)
+    start = time.perf_counter()
+    results = tracks.tracks(rows, method, count, tolerance)
+    body = json.dumps([{'uid': uid, 'points': list(zip(latitudes.tolist(), longitudes.tolist(),
+                                                       map(iso8601_string_from_datetime, timestamps)))}
+                       for uid, (timestamps, latitudes, longitudes, total) in results.items()])
+    return sum(len(track[1]) for track in results.values()), time.perf_counter() - start, len(body)
+
+
+def measure(connection, function, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        returned, processing, size = function(connection)
+        timings.append((time.perf_counter() - start, processing))
+    total, processing = min(timings)
+    return returned, total, processing, size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time /api/track's downsampling against returning every point")
+    parser.add_argument("--euds", type=int, default=100)
+    parser.add_argument("--hours", type=int, default=12)
+    parser.add_argument("--interval", type=int, default=5, help="Seconds between position reports")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite:///{}".format(os.path.join(tempfile.mkdtemp(), "ots.db")))
+    start = time.perf_counter()
+    load(engine, args.euds, args.hours, args.interval)
+    print("loaded {} EUDs with {} points each in {:.1f} s".format(
+        args.euds, args.hours * 3600 // args.interval, time.perf_counter() - start))
+
+    uids = ["ANDROID-{:016x}".format(eud) for eud in range(args.euds)]
+    with engine.connect() as connection:
+        for name, function in (("every point", lambda c: every_point(c, uids)),
+                               ("dp 500 points", lambda c: downsampled(c, uids, 'dp', count=500)),
+                               ("dp 10 m tolerance", lambda c: downsampled(c, uids, 'dp', tolerance=10)),
+                               ("time 500 points", lambda c: downsampled(c, uids, 'time', count=500))):
+            returned, total, processing, size = measure(connection, function, args.repeat)
+            print("{:18} {:>8} points {:>7.1f} MB  total {:7.1f} ms  of which downsampling and JSON {:7.1f} ms"
+                  .format(name, returned, size / 1e6, total * 1e3, processing * 1e3))
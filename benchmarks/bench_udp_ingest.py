@@ -0,0 +1,117 @@
+import argparse
+import logging
+import multiprocessing
+import socket
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask
+
+from opentakserver.UDPServer import UDPServer
+from opentakserver.cot.envelope import unpack_batch
+from opentakserver.defaultconfig import DefaultConfig
+from opentakserver.extensions import rabbitmq_pool
+
+# ATAK's mesh SA, XML declaration included
+SA = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+      '<event version="2.0" uid="{uid}" type="a-f-G-U-C" time="{time}" start="{time}" stale="{stale}" how="m-g">'
+      '<point lat="40.{n:06d}" lon="-73.{n:06d}" hae="12.1" ce="4.5" le="9999999.0"/><detail>'
+      '<takv os="34" version="4.10.0.57" device="GOOGLE PIXEL 7" platform="ATAK-CIV"/>'
+      '<contact endpoint="*:4242:udp" callsign="EUD-{n}"/><uid Droid="EUD-{n}"/>'
+      '<__group role="Team Member" name="Cyan"/><status battery="86"/><track course="88.1" speed="1.6"/>'
+      '</detail></event>')
+
+
+def datagrams(euds):
+    now = datetime.utcnow()
+    time_string = now.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    stale_string = (now + timedelta(minutes=6)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    return [SA.format(uid="ANDROID-{:016x}".format(n), n=n, time=time_string, stale=stale_string).encode('utf-8')
+            for n in range(euds)]
+
+
+# Sends rate datagrams a second in 1 ms bursts
+def send(port, rate, seconds, euds):
+    messages = datagrams(euds)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    per_tick = rate / 1000
+    sent = 0
+    start = time.perf_counter()
+    while True:
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            break
+        while sent < elapsed * 1000 * per_tick:
+            sock.sendto(messages[sent % len(messages)], ('127.0.0.1', port))
+            sent += 1
+        time.sleep(0.0005)
+    sock.close()
+
+
+class Sink:
+    def __init__(self, verify):
+        self.messages = 0
+        self.envelopes = 0
+        self.verify = verify
+
+    def publish(self, exchange, body, routing_key='', properties=None):
+        self.messages += 1
+        if self.verify:
+            self.envelopes += len(unpack_batch(body))
+
+
+def run(app, logger, rate, seconds, euds, batch_size, use_recvmmsg, verify):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    app.config["OTS_UDP_BATCH_SIZE"] = batch_size
+    sink = Sink(verify)
+    rabbitmq_pool.publish = sink.publish
+
+    server = UDPServer(logger, app.app_context(), port, use_recvmmsg=use_recvmmsg)
+    server.start()
+    time.sleep(0.5)
+
+    sender = multiprocessing.Process(target=send, args=(port, rate, seconds, euds))
+    cpu = time.process_time()
+    start = time.perf_counter()
+    sender.start()
+    sender.join()
+    # Let the server drain its receive buffer
+    time.sleep(0.5)
+    cpu = time.process_time() - cpu
+    elapsed = time.perf_counter() - start
+    server.stop()
+    server.join()
+
+    counts = server.stats()
+    print("{:10} batch {:3}: {:>7} published of {:>7} sent in {:>5} messages, {:>6.0f}/s wall, server CPU {:.2f} s, "
+          "{:>6.0f} datagrams per CPU second{}".format(
+              counts['receiver'], batch_size, counts['published'], int(rate * seconds), sink.messages,
+              counts['published'] / elapsed, cpu, counts['published'] / cpu if cpu else 0,
+              ", {} envelopes verified".format(sink.envelopes) if verify else ""))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="UDP CoT ingestion rate, from datagram to the batch published to the "
+                                                 "cot_controller exchange. RabbitMQ isn't needed, published batches "
+                                                 "are counted instead")
+    parser.add_argument("--rate", type=int, default=25000, help="Datagrams sent per second")
+    parser.add_argument("--seconds", type=int, default=5)
+    parser.add_argument("--euds", type=int, default=500)
+    parser.add_argument("--verify", action="store_true", help="Unpack every published batch")
+    parser.add_argument("--no-tak-protocol", action="store_true",
+                        help="Don't translate each datagram to a TAK protocol stream message")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("bench_udp_ingest")
+    logger.setLevel(logging.ERROR)
+
+    app = Flask(__name__)
+    app.config.from_object(DefaultConfig)
+    app.config["OTS_ENABLE_TAK_PROTOCOL"] = not args.no_tak_protocol
+
+    # One datagram per read and per message against batched reads and messages, with and without recvmmsg
+    for batch_size, use_recvmmsg in ((1, False), (64, False), (64, True)):
+        run(app, logger, args.rate, args.seconds, args.euds, batch_size, use_recvmmsg, args.verify)
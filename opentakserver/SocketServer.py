@@ -1,24 +1,85 @@
 import os
 import socket
 import ssl
-from threading import Thread
+import time
+import traceback
+from collections import deque
 
 from opentakserver.controllers.client_controller import ClientController
+from opentakserver.cot.envelope import CoTEnvelope
+from opentakserver.cot.wire import WireCoT
+from opentakserver.extensions import rabbitmq_pool
+from opentakserver.unpatched import selectors, threading
 
 
-class SocketServer(Thread):
-    def __init__(self, logger, app_context=None, port=8088, ssl_server=False):
+# A TLS handshake in progress. It's advanced one step each time the client's next message arrives, so a slow or
+# stalled client only holds up its own connection instead of the whole loop
+class TLSHandshake:
+    def __init__(self, server, sock, address, port):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.port = port
+        self.started = time.monotonic()
+
+    def step(self):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.server.selector.modify(self.sock, selectors.EVENT_READ, self.step)
+        except ssl.SSLWantWriteError:
+            self.server.selector.modify(self.sock, selectors.EVENT_WRITE, self.step)
+        except (ssl.SSLError, OSError) as e:
+            self.server.handshake_failed(self, e)
+        else:
+            self.server.handshake_done(self)
+
+
+def handshake_stats(counts, times, in_progress):
+    times = sorted(times)
+    stats = dict(counts, in_progress=in_progress)
+    for name, fraction in (('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99), ('max_ms', 1)):
+        stats[name] = round(times[min(int(len(times) * fraction), len(times) - 1)] * 1000, 1) if times else None
+    return stats
+
+
+class SocketServer(threading.Thread):
+    # With reuse_port several processes can listen on the same port and the kernel spreads connections over them
+    def __init__(self, logger, app_context=None, port=8088, ssl_server=False, reuse_port=False):
         super().__init__()
 
         self.logger = logger
         self.port = port
         self.ssl = ssl_server
+        self.reuse_port = reuse_port
         self.shutdown = False
         self.daemon = True
         self.socket = None
-        self.clients = []
+        self.ssl_context = None
+        self.clients = {}
         self.app_context = app_context
 
+        # TLS handshakes in progress by socket, oldest first
+        self.handshakes = {}
+        self.handshake_times = deque(maxlen=1000)
+        self.handshake_counts = {'completed': 0, 'resumed': 0, 'failed': 0, 'timed_out': 0}
+        self.handshake_timeout = None
+        self.max_handshakes = None
+        self.accepting = False
+
+        # Every client socket on this server is multiplexed on a single selector loop running in this thread.
+        # Other threads (i.e. the RabbitMQ ioloop) hand work to the loop with call_soon(). This is a real OS thread with
+        # an epoll selector even when eventlet has monkey patched threading and selectors, see unpatched.py
+        self.selector = None
+        self.callbacks = deque()
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+
+        # Broadcasts on the cot exchange arrive once for the whole server instead of once per client
+        self.broadcast_channel = None
+        self.broadcast_consumer = None
+
     def run(self):
         if self.ssl:
             self.socket = self.launch_ssl_server()
@@ -28,53 +89,211 @@ class SocketServer(Thread):
             self.logger.info("TCP connections are disabled")
             return
 
-        self.socket.settimeout(1.0)
+        self.socket.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.set_accepting(True)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ, self.run_callbacks)
 
         while not self.shutdown:
             try:
-                sock, addr = self.socket.accept()
-                if self.ssl:
-                    self.logger.info("New SSL connection from {}".format(addr[0]))
-                else:
-                    self.logger.info("New TCP connection from {}".format(addr[0]))
-
-                new_thread = ClientController(addr[0], addr[1], sock, self.logger, self.app_context.app, self.ssl)
-                new_thread.daemon = True
-                new_thread.start()
-                self.clients.append(new_thread)
+                events = self.selector.select(timeout=1.0)
+                for key, mask in events:
+                    if isinstance(key.data, ClientController):
+                        if mask & selectors.EVENT_WRITE:
+                            key.data.flush()
+                        if mask & selectors.EVENT_READ:
+                            key.data.handle_read()
+                    else:
+                        key.data()
+
+                if self.handshakes:
+                    self.expire_handshakes()
             except KeyboardInterrupt:
                 break
-            except TimeoutError:
-                if self.shutdown:
-                    self.socket.shutdown(socket.SHUT_RDWR)
-                    self.socket.close()
             except BaseException as e:
                 self.logger.warning(str(e))
 
+        for client in list(self.clients.values()):
+            self.logger.debug('Attempting to stop client {}'.format(client.address))
+            client.close_connection()
+
+        for handshake in list(self.handshakes.values()):
+            handshake.sock.close()
+
+        self.unsubscribe()
+
+        self.selector.close()
+        self.socket.close()
+
         if self.ssl:
             self.logger.info("SSL server has shut down")
         else:
             self.logger.info("TCP server has shut down")
 
+    def accept(self):
+        try:
+            sock, addr = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        if self.ssl:
+            self.logger.info("New SSL connection from {}".format(addr[0]))
+            sock.setblocking(False)
+            sock = self.ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+            handshake = TLSHandshake(self, sock, addr[0], addr[1])
+            self.handshakes[sock] = handshake
+            self.selector.register(sock, selectors.EVENT_READ, handshake.step)
+
+            # Every handshake still costs CPU time on this loop, past the limit new connections wait in the backlog
+            if len(self.handshakes) >= self.max_handshakes:
+                self.set_accepting(False)
+        else:
+            self.logger.info("New TCP connection from {}".format(addr[0]))
+            self.add_client(sock, addr[0], addr[1])
+
+    def add_client(self, sock, address, port):
+        client = ClientController(address, port, sock, self.logger, self.app_context.app, self.ssl, self)
+        self.clients[sock.fileno()] = client
+        self.selector.register(sock, selectors.EVENT_READ, client)
+
+    def set_accepting(self, accepting):
+        if accepting and not self.accepting:
+            self.selector.register(self.socket, selectors.EVENT_READ, self.accept)
+        elif not accepting and self.accepting:
+            self.selector.unregister(self.socket)
+        self.accepting = accepting
+
+    def end_handshake(self, handshake):
+        self.handshakes.pop(handshake.sock, None)
+        try:
+            self.selector.unregister(handshake.sock)
+        except (KeyError, ValueError):
+            pass
+
+        if len(self.handshakes) < self.max_handshakes:
+            self.set_accepting(True)
+
+    def handshake_done(self, handshake):
+        self.end_handshake(handshake)
+        self.handshake_times.append(time.monotonic() - handshake.started)
+        self.handshake_counts['completed'] += 1
+        if handshake.sock.session_reused:
+            self.handshake_counts['resumed'] += 1
+
+        try:
+            self.add_client(handshake.sock, handshake.address, handshake.port)
+        except BaseException as e:
+            self.logger.error("Failed to add client {}: {}".format(handshake.address, e))
+            handshake.sock.close()
+
+    def handshake_failed(self, handshake, error, timed_out=False):
+        self.end_handshake(handshake)
+        self.handshake_counts['timed_out' if timed_out else 'failed'] += 1
+        self.logger.warning("Failed to do handshake with {}: {}".format(handshake.address, error))
+        handshake.sock.close()
+
+    # self.handshakes is in the order the connections were accepted, so only the oldest ones need checking
+    def expire_handshakes(self):
+        now = time.monotonic()
+        while self.handshakes:
+            handshake = next(iter(self.handshakes.values()))
+            if now - handshake.started < self.handshake_timeout:
+                break
+            self.handshake_failed(handshake, "Timed out after {} seconds".format(self.handshake_timeout), True)
+
+    def handshake_stats(self):
+        return handshake_stats(self.handshake_counts, self.handshake_times, len(self.handshakes))
+
+    def set_writable(self, client, writable):
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if writable else selectors.EVENT_READ
+        try:
+            if self.selector.get_key(client.sock).events != events:
+                self.selector.modify(client.sock, events, client)
+        except (KeyError, ValueError):
+            pass
+
+    def remove_client(self, client):
+        try:
+            self.selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+
+        for fileno, c in list(self.clients.items()):
+            if c is client:
+                self.clients.pop(fileno)
+
+    def client_stats(self):
+        return [client.stats() for client in list(self.clients.values())]
+
+    # Called on the loop when a client starts consuming, so servers without clients don't need RabbitMQ
+    def subscribe(self):
+        if self.broadcast_channel is None:
+            self.broadcast_channel = rabbitmq_pool.acquire()
+            self.broadcast_consumer = self.broadcast_channel.consume(
+                "cot-{}-{}-{}".format(socket.gethostname(), os.getpid(), self.port), self.on_broadcast, exchange='cot',
+                exclusive=True)
+
+    def unsubscribe(self):
+        if self.broadcast_channel is not None:
+            self.broadcast_channel.cancel(self.broadcast_consumer)
+            rabbitmq_pool.release(self.broadcast_channel)
+            self.broadcast_channel = None
+
+    # Called from the RabbitMQ ioloop thread. The envelope is unpacked once for every client
+    def on_broadcast(self, unused_channel, basic_deliver, properties, body):
+        try:
+            self.call_soon(self.broadcast, WireCoT(CoTEnvelope.unpack(body, properties.content_type)))
+        except BaseException as e:
+            self.logger.error(traceback.format_exc())
+
+    def broadcast(self, cot):
+        for client in list(self.clients.values()):
+            if client.consumer is None:
+                continue
+            try:
+                client.deliver(cot)
+            except BaseException as e:
+                self.logger.error(traceback.format_exc())
+
+    def call_soon(self, callback, *args):
+        self.callbacks.append((callback, args))
+        try:
+            self.wakeup_sender.send(b'\0')
+        except (BlockingIOError, OSError):
+            # The loop already has a pending wakeup
+            pass
+
+    def run_callbacks(self):
+        try:
+            while self.wakeup_receiver.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+        while self.callbacks:
+            callback, args = self.callbacks.popleft()
+            try:
+                callback(*args)
+            except BaseException as e:
+                self.logger.error("Socket server callback failed: {}".format(e))
+
     def launch_tcp_server(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         s.bind(('0.0.0.0', self.port))
-        s.listen(1)
+        s.listen(socket.SOMAXCONN)
 
         return s
 
     def launch_ssl_server(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0) as sock:
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-            context = self.get_ssl_context()
-
-            sconn = context.wrap_socket(sock, server_side=True)
-            sconn.bind(('0.0.0.0', self.port))
-            sconn.listen(0)
-
-            return sconn
+        # The listening socket stays plain TCP, each accepted socket is wrapped individually
+        self.ssl_context = self.get_ssl_context()
+        self.handshake_timeout = self.app_context.app.config.get("OTS_SSL_HANDSHAKE_TIMEOUT")
+        self.max_handshakes = self.app_context.app.config.get("OTS_SSL_MAX_HANDSHAKES")
+        return self.launch_tcp_server()
 
     def stop(self):
         if self.ssl:
@@ -83,9 +302,7 @@ class SocketServer(Thread):
             self.logger.warning("Shutting down TCP server")
 
         self.shutdown = True
-        for client in self.clients:
-            self.logger.debug('Attempting to stop client {}'.format(client.address))
-            client.stop()
+        self.call_soon(lambda: None)
 
     def get_ssl_context(self):
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
@@ -98,4 +315,9 @@ class SocketServer(Thread):
             context.verify_mode = self.app_context.app.config.get("OTS_SSL_VERIFICATION_MODE")
             context.load_verify_locations(cafile=os.path.join(self.app_context.app.config.get("OTS_CA_FOLDER"), 'ca.pem'))
 
+            # Reconnecting clients can resume their session with a ticket and skip the certificate exchange
+            context.num_tickets = self.app_context.app.config.get("OTS_SSL_SESSION_TICKETS")
+            if not context.num_tickets:
+                context.options |= ssl.OP_NO_TICKET
+
             return context
@@ -0,0 +1,206 @@
+import ctypes
+import ctypes.util
+import errno
+import selectors
+import socket
+import sys
+import traceback
+from threading import Thread
+
+from opentakserver.cot.datagrams import parse_datagrams
+from opentakserver.cot.envelope import CoTEnvelope, UDP_PROPERTIES, pack_batch
+from opentakserver.cot.protobuf import MESH_HEADER, encode_event, stream_frame
+from opentakserver.extensions import rabbitmq_pool
+
+MAX_DATAGRAM = 65535
+# Plain ints, the socket module's flags are enums and combining them is slow
+MSG_DONTWAIT = int(getattr(socket, 'MSG_DONTWAIT', 0x40))
+MSG_TRUNC = int(getattr(socket, 'MSG_TRUNC', 0x20))
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t), ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+# Receives up to count datagrams with a single recvmmsg() call. Only on Linux
+class RecvMMsgReceiver:
+    def __init__(self, sock, count):
+        self.sock = sock
+        self.count = count
+        self.recvmmsg = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).recvmmsg
+        self.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+
+        self.buffers = [memoryview(bytearray(MAX_DATAGRAM)) for i in range(count)]
+        self.iovecs = (iovec * count)()
+        self.messages = (mmsghdr * count)()
+        for i, buffer in enumerate(self.buffers):
+            self.iovecs[i].iov_base = ctypes.addressof(ctypes.c_char.from_buffer(buffer))
+            self.iovecs[i].iov_len = MAX_DATAGRAM
+            self.messages[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            self.messages[i].msg_hdr.msg_iovlen = 1
+
+        # Going through the ctypes structures costs more than the system call saves, so the lengths and flags the
+        # kernel fills in are read straight from their memory
+        self.fields = memoryview(self.messages).cast('B').cast('I')
+        size = ctypes.sizeof(mmsghdr) // 4
+        self.lengths = [i * size + mmsghdr.msg_len.offset // 4 for i in range(count)]
+        self.flags = [i * size + (mmsghdr.msg_hdr.offset + msghdr.msg_flags.offset) // 4 for i in range(count)]
+
+    # Returns (datagrams, truncated)
+    def receive(self):
+        received = self.recvmmsg(self.sock.fileno(), self.messages, self.count, MSG_DONTWAIT, None)
+        if received < 0:
+            error = ctypes.get_errno()
+            if error in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return [], 0
+            raise OSError(error, "recvmmsg failed")
+
+        datagrams = []
+        truncated = 0
+        fields = self.fields
+        for i in range(received):
+            if fields[self.flags[i]] & MSG_TRUNC:
+                truncated += 1
+            else:
+                datagrams.append(bytes(self.buffers[i][:fields[self.lengths[i]]]))
+        return datagrams, truncated
+
+
+# One recv() per datagram until the socket is drained or count datagrams have been read
+class RecvReceiver:
+    def __init__(self, sock, count):
+        self.sock = sock
+        self.count = count
+
+    def receive(self):
+        datagrams = []
+        try:
+            for i in range(self.count):
+                datagrams.append(self.sock.recv(MAX_DATAGRAM))
+        except (BlockingIOError, InterruptedError):
+            pass
+        return datagrams, 0
+
+
+def receiver(sock, count, use_recvmmsg=True):
+    if use_recvmmsg and sys.platform.startswith('linux'):
+        try:
+            return RecvMMsgReceiver(sock, count)
+        except (AttributeError, OSError):
+            pass
+    return RecvReceiver(sock, count)
+
+
+# Takes in CoT from sensors and radios that send it as UDP datagrams, either to a unicast port or a multicast group
+# like ATAK's mesh SA on 239.2.3.1:6969, as XML or TAK protocol mesh messages. Every datagram waiting on the socket is
+# read at once, parsed together and sent to the cot_controller exchange as a single RabbitMQ message. Like the TCP
+# streaming port, UDP isn't authenticated
+class UDPServer(Thread):
+    def __init__(self, logger, app_context, port, group=None, interface='0.0.0.0', use_recvmmsg=True):
+        super().__init__()
+
+        self.logger = logger
+        self.app_context = app_context
+        self.port = port
+        self.group = group
+        self.interface = interface
+        self.use_recvmmsg = use_recvmmsg
+        self.shutdown = False
+        self.daemon = True
+        self.socket = None
+        self.receiver = None
+
+        self.max_size = app_context.app.config.get("OTS_MAX_COT_SIZE")
+        self.batch_size = app_context.app.config.get("OTS_UDP_BATCH_SIZE")
+        self.receive_buffer = app_context.app.config.get("OTS_UDP_RECEIVE_BUFFER")
+        self.tak_protocol = app_context.app.config.get("OTS_ENABLE_TAK_PROTOCOL")
+        self.counts = {'received': 0, 'published': 0, 'batches': 0, 'malformed': 0, 'ignored': 0, 'too_large': 0}
+
+    def launch_udp_server(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+
+        if self.group:
+            # Binding to the group only receives its datagrams, but not every platform allows it
+            try:
+                s.bind((self.group, self.port))
+            except OSError:
+                s.bind(('', self.port))
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                         socket.inet_aton(self.group) + socket.inet_aton(self.interface))
+        else:
+            s.bind(('0.0.0.0', self.port))
+
+        s.setblocking(False)
+        return s
+
+    def run(self):
+        try:
+            self.socket = self.launch_udp_server()
+        except OSError as e:
+            self.logger.error("Failed to listen for UDP on {}:{}: {}".format(self.group or '0.0.0.0', self.port, e))
+            return
+
+        self.receiver = receiver(self.socket, self.batch_size, self.use_recvmmsg)
+        self.logger.info("Listening for CoT on UDP {}:{} with {}".format(
+            self.group or '0.0.0.0', self.port, type(self.receiver).__name__))
+
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+        while not self.shutdown:
+            try:
+                if selector.select(timeout=1.0):
+                    datagrams, truncated = self.receiver.receive()
+                    self.counts['too_large'] += truncated
+                    if datagrams:
+                        self.handle_datagrams(datagrams)
+            except BaseException as e:
+                self.logger.error(traceback.format_exc())
+
+        selector.close()
+        self.socket.close()
+        self.logger.info("UDP server on port {} has shut down".format(self.port))
+
+    def handle_datagrams(self, datagrams):
+        self.counts['received'] += len(datagrams)
+        self.counts['batches'] += 1
+
+        sized = [datagram for datagram in datagrams if len(datagram) <= self.max_size]
+        self.counts['too_large'] += len(datagrams) - len(sized)
+
+        envelopes = []
+        for datagram, event in zip(sized, parse_datagrams(sized)):
+            if event is None:
+                self.counts['malformed'] += 1
+            # Same as the streaming ports, only events go on and pings are only answered on a connection
+            elif event.name != 'event' or 'uid' not in event.attrs or event.attrs['uid'].endswith('ping'):
+                self.counts['ignored'] += 1
+            else:
+                # Like the streaming ports, the stream message for clients that speak protobuf is made once here
+                if datagram.startswith(MESH_HEADER):
+                    proto = stream_frame(datagram[len(MESH_HEADER):])
+                else:
+                    proto = encode_event(event) if self.tak_protocol else None
+                envelopes.append(CoTEnvelope.from_event(event.attrs['uid'], event, proto))
+
+        if envelopes:
+            rabbitmq_pool.publish('cot_controller', pack_batch(envelopes), properties=UDP_PROPERTIES)
+            self.counts['published'] += len(envelopes)
+
+    def stats(self):
+        return dict(self.counts, port=self.port, group=self.group, receiver=type(self.receiver).__name__)
+
+    def stop(self):
+        self.logger.warning("Shutting down UDP server on port {}".format(self.port))
+        self.shutdown = True
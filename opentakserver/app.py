@@ -1,4 +1,5 @@
-import sys
+import importlib
+import pkgutil
 import traceback
 
 import eventlet
@@ -7,12 +8,15 @@ try:
 except BaseException as e:
     print("Failed to monkey_patch(): {}".format(e))
 
+from opentakserver import models
 from opentakserver.PasswordValidator import PasswordValidator
 
 import platform
 import requests
 from sqlalchemy import insert
 import sqlite3
+from opentakserver.migrations import migrate
+from opentakserver.models.EUD import EUD
 from opentakserver.models.Icon import Icon
 
 import yaml
@@ -20,11 +24,9 @@ from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 
 from opentakserver.EmailValidator import EmailValidator
 
-import logging
-from logging.handlers import TimedRotatingFileHandler
 import os
+import socket
 
-import colorlog
 from werkzeug.middleware.proxy_fix import ProxyFix
 from datetime import datetime
 import sqlalchemy
@@ -39,13 +41,15 @@ from flask_security import Security, SQLAlchemyUserDatastore, hash_password, uia
 from flask_security.models import fsqla_v3 as fsqla
 from flask_security.signals import user_registered
 
-from opentakserver.extensions import logger, db, socketio, mail, apscheduler
+from opentakserver.extensions import logger, db, socketio, mail, apscheduler, rabbitmq_pool, presence, setup_logging
 from opentakserver.defaultconfig import DefaultConfig
 from opentakserver.models.WebAuthn import WebAuthn
 
 from opentakserver.controllers.cot_controller import CoTController
 from opentakserver.certificate_authority import CertificateAuthority
 from opentakserver.SocketServer import SocketServer
+from opentakserver.UDPServer import UDPServer
+from opentakserver.streaming_worker import StreamingWorkers, WorkerPort
 try:
     from opentakserver.mumble.mumble_ice_app import MumbleIceDaemon
 except ModuleNotFoundError:
@@ -97,6 +101,13 @@ def init_extensions(app):
     channel.queue_declare(queue='cot_controller')
     channel.exchange_declare(exchange='cot_controller', exchange_type='fanout')
 
+    rabbitmq_pool.init_app(app)
+
+    # Streaming workers share the streaming ports with SO_REUSEPORT
+    if app.config.get("OTS_STREAMING_WORKERS") and not hasattr(socket, "SO_REUSEPORT"):
+        logger.warning("SO_REUSEPORT isn't supported on this platform, streaming from the main process")
+        app.config.update(OTS_STREAMING_WORKERS=0)
+
     cot_thread = CoTController(app.app_context(), logger, db, socketio)
     app.cot_thread = cot_thread
 
@@ -109,6 +120,11 @@ def init_extensions(app):
     except sqlalchemy.exc.InvalidRequestError:
         pass
 
+    # Every model has to be imported for the EUD model's relationships to resolve before the first query below. The
+    # blueprints import the rest of them too late
+    for module in pkgutil.iter_modules(models.__path__):
+        importlib.import_module("opentakserver.models.{}".format(module.name))
+
     from opentakserver.models.user import User
     from opentakserver.models.role import Role
 
@@ -118,27 +134,8 @@ def init_extensions(app):
     mail.init_app(app)
     with app.app_context():
         db.create_all()
-
-
-def setup_logging(app):
-    level = logging.INFO
-    if app.config.get("DEBUG"):
-        level = logging.DEBUG
-
-    if sys.stdout.isatty():
-        color_log_handler = colorlog.StreamHandler()
-        color_log_formatter = colorlog.ColoredFormatter(
-            '%(log_color)s[%(asctime)s] - OpenTAKServer[%(process)d] - %(module)s - %(levelname)s - %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
-        color_log_handler.setFormatter(color_log_formatter)
-        logger.setLevel(level)
-        logger.addHandler(color_log_handler)
-        logger.info("Added color logger")
-
-    os.makedirs(os.path.join(app.config.get("OTS_DATA_FOLDER"), "logs"), exist_ok=True)
-    fh = TimedRotatingFileHandler(os.path.join(app.config.get("OTS_DATA_FOLDER"), 'logs', 'opentakserver.log'), when='midnight', backupCount=app.config.get("OTS_BACKUP_COUNT"))
-    fh.setLevel(level)
-    fh.setFormatter(logging.Formatter("[%(asctime)s] - OpenTAKServer[%(process)d] - %(module)s - %(levelname)s - %(message)s"))
-    logger.addHandler(fh)
+        migrate(db, logger)
+        presence.load(db.session.execute(db.select(EUD)).scalars())
 
 
 def create_app():
@@ -271,13 +268,31 @@ if __name__ == '__main__':
                                                password=hash_password("password"), roles=["administrator"])
         db.session.commit()
 
-    tcp_thread = SocketServer(logger, app.app_context(), app.config.get("OTS_TCP_STREAMING_PORT"))
-    tcp_thread.start()
-    app.tcp_thread = tcp_thread
-
-    ssl_thread = SocketServer(logger, app.app_context(), app.config.get("OTS_SSL_STREAMING_PORT"), True)
-    ssl_thread.start()
-    app.ssl_thread = ssl_thread
+    streaming_workers = None
+    if app.config.get("OTS_STREAMING_WORKERS"):
+        streaming_workers = StreamingWorkers(logger, app.config.get("OTS_STREAMING_WORKERS"))
+        app.tcp_thread = WorkerPort(streaming_workers, 'tcp')
+        app.ssl_thread = WorkerPort(streaming_workers, 'ssl')
+    else:
+        tcp_thread = SocketServer(logger, app.app_context(), app.config.get("OTS_TCP_STREAMING_PORT"))
+        tcp_thread.start()
+        app.tcp_thread = tcp_thread
+
+        ssl_thread = SocketServer(logger, app.app_context(), app.config.get("OTS_SSL_STREAMING_PORT"), True)
+        ssl_thread.start()
+        app.ssl_thread = ssl_thread
+
+    # UDP stays in the main process even with streaming workers, every socket joined to a multicast group would get
+    # its own copy of each datagram
+    app.udp_threads = []
+    if app.config.get("OTS_ENABLE_UDP_STREAMING_PORT"):
+        app.udp_threads.append(UDPServer(logger, app.app_context(), app.config.get("OTS_UDP_STREAMING_PORT")))
+    for group in app.config.get("OTS_UDP_MULTICAST_GROUPS"):
+        address, port = group.rsplit(":", 1)
+        app.udp_threads.append(UDPServer(logger, app.app_context(), int(port), address,
+                                         app.config.get("OTS_UDP_MULTICAST_INTERFACE")))
+    for udp_thread in app.udp_threads:
+        udp_thread.start()
 
     if app.config.get("OTS_ENABLE_MUMBLE_AUTHENTICATION"):
         try:
@@ -295,3 +310,9 @@ if __name__ == '__main__':
 
     socketio.run(app, host=app.config.get("OTS_LISTENER_ADDRESS"), port=app.config.get("OTS_LISTENER_PORT"),
                  debug=app.config.get("DEBUG"), log_output=app.config.get("DEBUG"))
+
+    if streaming_workers:
+        streaming_workers.stop()
+
+    # Write any CoTs that are still buffered before exiting
+    app.cot_thread.stop()
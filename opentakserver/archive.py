@@ -0,0 +1,129 @@
+import os
+from datetime import datetime, timedelta, time
+
+from sqlalchemy import Column, Index, MetaData, Table, create_engine, delete, exists, func, insert, or_, select
+
+from opentakserver.models.CoT import CoT
+from opentakserver.models.Point import Point
+
+
+# Moves CoTs and their points out of the live tables into one SQLite file per day, once they're older than the live
+# window. Dropping or exporting a day is then a single file operation instead of a huge DELETE, and the live tables
+# stay small. Rows are moved in small batches, each in its own transaction, so the CoT writer is never blocked for
+# long. CoTs and points that are still referenced by markers, chats, alerts, CasEvacs, R&B lines, videos or an EUD's
+# last point stay in the live tables
+class CoTArchive:
+    def __init__(self, folder, logger, batch_size=5000):
+        self.folder = folder
+        self.logger = logger
+        self.batch_size = batch_size
+
+        # The partitions have the same columns as the live tables, without the foreign keys
+        self.metadata = MetaData()
+        self.tables = {}
+        for table in (CoT.__table__, Point.__table__):
+            self.tables[table.name] = Table(table.name, self.metadata,
+                                            *[Column(column.name, column.type, primary_key=column.primary_key,
+                                                     autoincrement=False) for column in table.columns])
+        Index("ix_points_device_uid_timestamp", self.tables['points'].c.device_uid, self.tables['points'].c.timestamp)
+
+    def path(self, day):
+        return os.path.join(self.folder, "cot-{}.sqlite".format(day.isoformat()))
+
+    # [(date, path)] oldest first
+    def partitions(self):
+        if not os.path.exists(self.folder):
+            return []
+
+        partitions = []
+        for filename in os.listdir(self.folder):
+            if filename.startswith("cot-") and filename.endswith(".sqlite"):
+                try:
+                    partitions.append((datetime.strptime(filename[4:-7], "%Y-%m-%d").date(),
+                                       os.path.join(self.folder, filename)))
+                except ValueError:
+                    continue
+        return sorted(partitions)
+
+    def engine(self, day):
+        os.makedirs(self.folder, exist_ok=True)
+        engine = create_engine("sqlite:///{}".format(self.path(day)))
+        self.metadata.create_all(engine)
+        return engine
+
+    # Columns in other tables that point at rows of this table
+    def references(self, db, table, exclude=()):
+        return [foreign_key.parent for other in db.metadata.tables.values() if other.name not in exclude
+                for foreign_key in other.foreign_keys if foreign_key.column.table is table]
+
+    def archivable(self, db, start, end):
+        point_references = [exists().where(column == Point.id)
+                            for column in self.references(db, Point.__table__)]
+        cot_references = [exists().where(column == CoT.id)
+                          for column in self.references(db, CoT.__table__, exclude=('points',))]
+        referenced_point = exists().where(Point.cot_id == CoT.id, or_(*point_references))
+
+        return (select(CoT.id).where(CoT.timestamp >= start, CoT.timestamp < end, ~or_(*cot_references),
+                                     ~referenced_point)
+                .order_by(CoT.timestamp, CoT.id).limit(self.batch_size))
+
+    def archive_day(self, db, day):
+        start = datetime.combine(day, time())
+        end = start + timedelta(days=1)
+        engine = None
+        archived = 0
+
+        while True:
+            cot_ids = db.session.execute(self.archivable(db, start, end)).scalars().all()
+            if not cot_ids:
+                break
+
+            if not engine:
+                engine = self.engine(day)
+
+            cots = [row._asdict() for row in db.session.execute(select(CoT.__table__).where(CoT.id.in_(cot_ids)))]
+            points = [row._asdict() for row in
+                      db.session.execute(select(Point.__table__).where(Point.cot_id.in_(cot_ids)))]
+
+            # Written to the partition first, so a crash in between leaves a copy in both places and the next run
+            # replaces it instead of losing it
+            with engine.begin() as connection:
+                connection.execute(insert(self.tables['cot']).prefix_with("OR REPLACE"), cots)
+                if points:
+                    connection.execute(insert(self.tables['points']).prefix_with("OR REPLACE"), points)
+
+            db.session.execute(delete(Point).where(Point.cot_id.in_(cot_ids)))
+            db.session.execute(delete(CoT).where(CoT.id.in_(cot_ids)))
+            db.session.commit()
+            archived += len(cot_ids)
+
+        if engine:
+            engine.dispose()
+        return archived
+
+    # Archives every whole day older than live_days
+    def archive(self, db, live_days):
+        oldest = db.session.execute(select(func.min(CoT.timestamp))).scalar()
+        if not oldest:
+            return 0
+
+        archived = 0
+        day = oldest.date()
+        cutoff = (datetime.utcnow() - timedelta(days=live_days)).date()
+        while day < cutoff:
+            count = self.archive_day(db, day)
+            if count:
+                self.logger.info("Archived {} CoTs from {}".format(count, day))
+            archived += count
+            day += timedelta(days=1)
+        return archived
+
+    def drop_expired(self, retention_days):
+        cutoff = (datetime.utcnow() - timedelta(days=retention_days)).date()
+        dropped = []
+        for day, path in self.partitions():
+            if day < cutoff:
+                os.remove(path)
+                dropped.append(day)
+                self.logger.info("Deleted the CoT archive from {}".format(day))
+        return dropped
@@ -1,3 +1,5 @@
+import base64
+import binascii
 import datetime
 import hashlib
 import json
@@ -13,18 +15,20 @@ from urllib.parse import urlparse
 
 import ffmpeg
 import yaml
-from sqlalchemy import update
+from sqlalchemy import select, tuple_, update
 from werkzeug.datastructures import ImmutableMultiDict
 
 import bleach
 import psutil
 import requests
 import sqlalchemy.exc
-from flask import current_app as app, request, Blueprint, jsonify, send_from_directory
+from flask import current_app as app, request, Blueprint, jsonify, send_from_directory, Response, stream_with_context
 from flask_security import auth_required, roles_accepted, hash_password, current_user, \
     admin_change_password, verify_password
 
-from opentakserver.extensions import logger, db
+from opentakserver import export, geohash, serializers
+from opentakserver.extensions import logger, db, rabbitmq_pool, presence
+from opentakserver.functions import datetime_from_iso8601_string, iso8601_string_from_datetime
 from .marti import data_package_share
 
 from opentakserver.models.Alert import Alert
@@ -61,17 +65,30 @@ def search(query, model, field):
     return query
 
 
-def paginate(query):
+def paginate(query, timestamp=None):
     try:
         page = int(request.args.get('page')) if 'page' in request.args else 1
         per_page = int(request.args.get('per_page')) if 'per_page' in request.args else 10
     except ValueError:
         return {'success': False, 'error': 'Invalid page or per_page number'}, 400, {'Content-Type': 'application/json'}
 
-    pagination = db.paginate(query, page=page, per_page=per_page)
+    # Counting every row is the slowest part of a page on big tables, cursors skip it unless asked for
+    count = request.args.get('count', 'false' if 'cursor' in request.args else 'true').lower() not in ('false', '0')
+
+    model = query.column_descriptions[0]['entity']
+    query = query.options(*serializers.load_options(model))
+
+    if request.args.get('stream') == 'ndjson':
+        return stream_ndjson(query)
+
+    if 'cursor' in request.args:
+        return paginate_by_cursor(query, model, timestamp, per_page, count)
+
+    pagination = db.paginate(query.statement, page=page, per_page=per_page, count=count)
     rows = pagination.items
 
-    results = {'results': [], 'total_pages': pagination.pages, 'current_page': page, 'per_page': per_page}
+    results = {'results': [], 'total_pages': pagination.pages if count else None, 'current_page': page,
+               'per_page': per_page}
 
     for row in rows:
         results['results'].append(row.to_json())
@@ -79,6 +96,50 @@ def paginate(query):
     return jsonify(results)
 
 
+# Newest first, keyed on (timestamp, id). Unlike OFFSET, every page costs the same no matter how deep it is.
+# Pass cursor= for the first page and the returned next_cursor for the ones after it
+def paginate_by_cursor(query, model, timestamp, per_page, count):
+    keys = (timestamp, model.id) if timestamp is not None else (model.id,)
+
+    total = query.order_by(None).count() if count else None
+
+    if request.args.get('cursor'):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(request.args.get('cursor')))
+            if timestamp is not None:
+                values[0] = datetime.datetime.fromisoformat(values[0])
+            if len(values) != len(keys) or not isinstance(values[-1], int):
+                raise ValueError
+        except (binascii.Error, KeyError, TypeError, ValueError):
+            return {'success': False, 'error': 'Invalid cursor'}, 400, {'Content-Type': 'application/json'}
+
+        query = query.where(tuple_(*keys) < tuple_(*values))
+
+    rows = query.order_by(*[key.desc() for key in keys]).limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        values = [rows[-1].id]
+        if timestamp is not None:
+            values.insert(0, getattr(rows[-1], timestamp.key).isoformat())
+        next_cursor = base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('utf-8')
+
+    return jsonify({'results': [row.to_json() for row in rows], 'next_cursor': next_cursor, 'total': total,
+                    'per_page': per_page})
+
+
+# Every matching row, one JSON object per line, read from a server side cursor in chunks. The session only holds weak
+# references to unmodified rows, so each chunk is freed once it's sent and memory use doesn't grow with the row count
+def stream_ndjson(query):
+    def rows():
+        result = db.session.execute(query.statement.execution_options(yield_per=500))
+        for chunk in result.scalars().partitions():
+            yield ''.join(app.json.dumps(row.to_json()) + '\n' for row in chunk)
+
+    return Response(stream_with_context(rows()), mimetype='application/x-ndjson')
+
+
 def change_config_setting(setting, value):
     try:
         with open(os.path.join(app.config.get("OTS_DATA_FOLDER"), "config.yml"), "r") as config_file:
@@ -141,8 +202,14 @@ def status():
 
     response = {
         'tcp': app.tcp_thread.is_alive(), 'ssl': app.ssl_thread.is_alive(),
-        'cot_router': app.cot_thread.iothread.is_alive(),
-        'online_euds': app.cot_thread.online_euds, 'system_boot_time': system_boot_time.strftime("%Y-%m-%d %H:%M:%SZ"),
+        'streaming_clients': app.tcp_thread.client_stats() + app.ssl_thread.client_stats(),
+        'tls_handshakes': app.ssl_thread.handshake_stats(),
+        'udp': [udp_thread.stats() for udp_thread in app.udp_threads],
+        'cot_router': app.cot_thread.iothread.is_alive(), 'rabbitmq_pool': rabbitmq_pool.stats(),
+        'cot_writer': app.cot_thread.writer.stats(), 'persistence': app.cot_thread.persistence.stats(),
+        'online_euds': {eud.uid: {'callsign': eud.callsign, 'last_event_time': eud.last_event_time}
+                        for eud in presence.snapshot() if eud.online},
+        'presence': presence.stats(), 'system_boot_time': system_boot_time.strftime("%Y-%m-%d %H:%M:%SZ"),
         'system_uptime': system_uptime.total_seconds(), 'ots_start_time': app.start_time.strftime("%Y-%m-%d %H:%M:%SZ"),
         'ots_uptime': ots_uptime.total_seconds(), 'cpu_time': cpu_time_dict, 'cpu_percent': p.cpu_percent(),
         'load_avg': psutil.getloadavg(), 'memory': vmem_dict, 'disk_usage': disk_usage_dict, 'temps': temps_dict,
@@ -165,9 +232,12 @@ def control_tcp_socket(action):
         change_config_setting("OTS_ENABLE_TCP_STREAMING_PORT", True)
         app.config.update(OTS_ENABLE_TCP_STREAMING_PORT=True)
 
-        tcp_thread = SocketServer(logger, app.app_context(), app.config.get("OTS_TCP_STREAMING_PORT"))
-        tcp_thread.start()
-        app.tcp_thread = tcp_thread
+        if app.config.get("OTS_STREAMING_WORKERS"):
+            app.tcp_thread.start()
+        else:
+            tcp_thread = SocketServer(logger, app.app_context(), app.config.get("OTS_TCP_STREAMING_PORT"))
+            tcp_thread.start()
+            app.tcp_thread = tcp_thread
 
         return jsonify({'success': True})
 
@@ -194,6 +264,10 @@ def control_ssl_socket(action):
         if app.ssl_thread.is_alive():
             return jsonify({'success': False, 'error': 'ssl thread is already active'}), 400
 
+        if app.config.get("OTS_STREAMING_WORKERS"):
+            app.ssl_thread.start()
+            return jsonify({'success': True})
+
         with app.app_context():
             ssl_thread = SocketServer(logger, app.app_context(), app.config.get("OTS_SSL_STREAMING_PORT"), True)
             ssl_thread.start()
@@ -348,7 +422,7 @@ def data_packages():
     query = search(query, DataPackage, 'size')
     query = search(query, DataPackage, 'tool')
 
-    return paginate(query)
+    return paginate(query, DataPackage.submission_time)
 
 
 @api_blueprint.route('/api/data_packages/download')
@@ -386,7 +460,7 @@ def query_cot():
     query = search(query, CoT, 'sender_callsign')
     query = search(query, CoT, 'sender_uid')
 
-    return paginate(query)
+    return paginate(query, CoT.timestamp)
 
 
 @api_blueprint.route("/api/alerts", methods=['GET'])
@@ -397,7 +471,7 @@ def query_alerts():
     query = search(query, Alert, 'sender_uid')
     query = search(query, Alert, 'alert_type')
 
-    return paginate(query)
+    return paginate(query, Alert.start_time)
 
 
 @api_blueprint.route("/api/point", methods=['GET'])
@@ -408,7 +482,112 @@ def query_points():
     query = search(query, EUD, 'uid')
     query = search(query, EUD, 'callsign')
 
-    return paginate(query)
+    # bbox=west,south,east,north and lat, lon and radius in meters. Both use the geohash index
+    try:
+        if 'bbox' in request.args:
+            west, south, east, north = [float(value) for value in request.args.get('bbox').split(',')]
+            if not (-180 <= west <= 180 and -180 <= east <= 180 and -90 <= south <= north <= 90):
+                raise ValueError
+            query = query.where(geohash.bbox_filter(Point, west, south, east, north))
+
+        if 'radius' in request.args:
+            latitude = float(request.args.get('lat'))
+            longitude = float(request.args.get('lon'))
+            radius = float(request.args.get('radius'))
+            if not (-90 <= latitude <= 90 and -180 <= longitude <= 180 and radius > 0):
+                raise ValueError
+            query = query.where(geohash.radius_filter(Point, latitude, longitude, radius))
+
+        if 'start' in request.args:
+            query = query.where(Point.timestamp >= datetime_from_iso8601_string(request.args.get('start')))
+        if 'end' in request.args:
+            query = query.where(Point.timestamp <= datetime_from_iso8601_string(request.args.get('end')))
+    except (TypeError, ValueError):
+        return ({'success': False, 'error': 'Invalid bbox, radius, start or end'}, 400,
+                {'Content-Type': 'application/json'})
+
+    return paginate(query, Point.timestamp)
+
+
+# Downsampled tracks for one or more EUDs, i.e. /api/track?uid=ANDROID-1&uid=ANDROID-2&start=...&points=500.
+# method=dp (Douglas-Peucker) keeps at most points points per track, or every point more than tolerance meters off the
+# track when tolerance is given. method=time keeps one point per equal slice of time
+@api_blueprint.route("/api/track", methods=['GET'])
+@auth_required()
+def query_tracks():
+    uids = [bleach.clean(uid) for uid in request.args.getlist('uid')]
+    method = request.args.get('method', 'dp')
+
+    try:
+        count = int(request.args.get('points', 1000))
+        tolerance = float(request.args.get('tolerance')) if 'tolerance' in request.args else None
+        start = datetime_from_iso8601_string(request.args.get('start')) if 'start' in request.args else None
+        end = datetime_from_iso8601_string(request.args.get('end')) if 'end' in request.args else None
+        if not uids or count < 2 or (tolerance is not None and tolerance < 0) or method not in ('dp', 'time'):
+            raise ValueError
+    except (TypeError, ValueError):
+        return ({'success': False, 'error': 'Specify at least one uid, points of 2 or more, a tolerance of 0 or more, '
+                                            'method dp or time and valid start and end times'}, 400,
+                {'Content-Type': 'application/json'})
+
+    try:
+        from opentakserver import tracks
+    except ModuleNotFoundError:
+        return ({'success': False, 'error': 'Tracks require numpy, install it with pip install numpy'}, 501,
+                {'Content-Type': 'application/json'})
+
+    # Only the EUDs' own positions, read straight off the (device_uid, timestamp) index
+    query = (select(Point.device_uid, Point.timestamp, Point.latitude, Point.longitude)
+             .where(Point.device_uid.in_(uids), Point.uid == Point.device_uid, Point.latitude.is_not(None),
+                    Point.longitude.is_not(None)))
+    if start:
+        query = query.where(Point.timestamp >= start)
+    if end:
+        query = query.where(Point.timestamp <= end)
+    rows = db.session.execute(query.order_by(Point.device_uid, Point.timestamp)).all()
+
+    results = []
+    for uid, (timestamps, latitudes, longitudes, total) in tracks.tracks(rows, method, count, tolerance).items():
+        results.append({'uid': uid, 'total_points': total,
+                        'points': list(zip(latitudes.tolist(), longitudes.tolist(),
+                                           map(iso8601_string_from_datetime, timestamps)))})
+
+    return jsonify({'results': results})
+
+
+# Streams cot, points or markers for a time range as Parquet or Arrow IPC, including archived days
+@api_blueprint.route("/api/export", methods=['GET'])
+@auth_required()
+def export_data():
+    table = request.args.get('table', 'points')
+    export_format = request.args.get('format', 'parquet')
+    if table not in export.TABLES or export_format not in export.FORMATS:
+        return ({'success': False, 'error': 'table must be one of {} and format one of {}'.format(
+            ', '.join(export.TABLES), ', '.join(export.FORMATS))}, 400, {'Content-Type': 'application/json'})
+
+    try:
+        start = datetime_from_iso8601_string(request.args.get('start')) if 'start' in request.args else None
+        end = datetime_from_iso8601_string(request.args.get('end')) if 'end' in request.args else None
+        bbox = export.parse_bbox(request.args.get('bbox')) if 'bbox' in request.args else None
+    except ValueError:
+        return {'success': False, 'error': 'Invalid start, end or bbox'}, 400, {'Content-Type': 'application/json'}
+
+    # pyarrow is in the optional export extra
+    try:
+        import pyarrow
+    except ImportError:
+        return ({'success': False, 'error': 'Exporting requires pyarrow, install it with pip install '
+                                            'opentakserver[export]'}, 501, {'Content-Type': 'application/json'})
+
+    sender_uid = bleach.clean(request.args.get('sender_uid')) if 'sender_uid' in request.args else None
+    type_prefix = bleach.clean(request.args.get('type')) if 'type' in request.args else None
+
+    sources = export.sources(db.engine, app.config.get("OTS_ARCHIVE_FOLDER"), table, start, end)
+    data = export.export(sources, table, export_format, start=start, end=end, sender_uid=sender_uid,
+                         type_prefix=type_prefix, bbox=bbox)
+    filename = "{}.{}".format(table, export_format)
+    return Response(stream_with_context(data), mimetype=export.FORMATS[export_format],
+                    headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
 
 
 @api_blueprint.route("/api/casevac", methods=['GET'])
@@ -420,7 +599,7 @@ def query_casevac():
     query = search(query, CasEvac, 'sender_uid')
     query = search(query, CasEvac, 'uid')
 
-    return paginate(query)
+    return paginate(query, CasEvac.timestamp)
 
 
 @api_blueprint.route("/api/user/add", methods=['POST'])
@@ -1105,22 +1284,25 @@ def get_map_state():
     try:
         results = {'euds': [], 'markers': [], 'rb_lines': [], 'casevacs': []}
 
-        euds = db.session.execute(db.session.query(EUD)).all()
+        euds = db.session.execute(db.session.query(EUD).options(*serializers.load_options(EUD))).all()
         for eud in euds:
             results['euds'].append(eud[0].to_json())
 
         markers = db.session.execute(
-            db.session.query(Marker).join(CoT).filter(CoT.stale >= datetime.datetime.now())).all()
+            db.session.query(Marker).options(*serializers.load_options(Marker)).join(CoT)
+            .filter(CoT.stale >= datetime.datetime.now())).all()
         for marker in markers:
             results['markers'].append(marker[0].to_json())
 
         rb_lines = db.session.execute(
-            db.session.query(RBLine).join(CoT).filter(CoT.stale >= datetime.datetime.now())).all()
+            db.session.query(RBLine).options(*serializers.load_options(RBLine)).join(CoT)
+            .filter(CoT.stale >= datetime.datetime.now())).all()
         for rb_line in rb_lines:
             results['rb_lines'].append(rb_line[0].to_json())
 
         casevacs = db.session.execute(
-            db.session.query(CasEvac).join(CoT).filter(CoT.stale >= datetime.datetime.now())).all()
+            db.session.query(CasEvac).options(*serializers.load_options(CasEvac)).join(CoT)
+            .filter(CoT.stale >= datetime.datetime.now())).all()
         for casevac in casevacs:
             results['casevacs'].append(casevac[0].to_json())
 
@@ -18,7 +18,7 @@ from OpenSSL import crypto
 from bs4 import BeautifulSoup
 from flask import current_app as app, request, Blueprint, send_from_directory, jsonify
 from flask_security import verify_password, current_user
-from opentakserver.extensions import logger, db
+from opentakserver.extensions import logger, db, presence
 from opentakserver.forms.MediaMTXPathConfig import MediaMTXPathConfig
 from opentakserver import __version__ as version
 
@@ -51,10 +51,10 @@ def basic_auth(credentials):
 
 @marti_blueprint.route('/Marti/api/clientEndPoints', methods=['GET'])
 def client_end_points():
-    euds = db.session.execute(db.select(EUD)).scalars()
     return_value = {'version': 3, "type": "com.bbn.marti.remote.ClientEndpoint", 'data': [],
                     'nodeId': app.config.get("OTS_NODE_ID")}
-    for eud in euds:
+    # Served from the presence registry instead of the DB
+    for eud in presence.snapshot():
         return_value['data'].append({
             'callsign': eud.callsign,
             'uid': eud.uid,
@@ -159,6 +159,7 @@ def sign_csr_v2():
 
             db.session.add(eud)
             db.session.commit()
+            presence.load([eud])
         except sqlalchemy.exc.IntegrityError:
             db.session.rollback()
             eud = db.session.execute(db.session.query(EUD).filter_by(uid=uid)).first()[0]
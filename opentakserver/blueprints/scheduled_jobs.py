@@ -1,13 +1,15 @@
-import json
 import traceback
 
 import pika
-from bs4 import BeautifulSoup
 from flask import Blueprint
 import adsbxcot
 from flask import current_app as app
 
-from opentakserver.extensions import apscheduler, logger, db
+from opentakserver.archive import CoTArchive
+from opentakserver.cot.envelope import CoTEnvelope, PROPERTIES
+from opentakserver.cot.event import CoTEvent
+from opentakserver.cot.protobuf import encode_event
+from opentakserver.extensions import apscheduler, logger, db, presence
 import requests
 
 from opentakserver.models.Chatrooms import Chatroom
@@ -19,6 +21,7 @@ from opentakserver.models.CoT import CoT
 from opentakserver.models.DataPackage import DataPackage
 from opentakserver.models.EUD import EUD
 from opentakserver.models.GeoChat import GeoChat
+from opentakserver.models.LastPoint import LastPoint
 from opentakserver.models.Marker import Marker
 from opentakserver.models.Point import Point
 from opentakserver.models.RBLine import RBLine
@@ -48,12 +51,11 @@ def get_airplanes_live_data():
                     except ValueError:
                         continue
 
-                    # noinspection PyTypeChecker
-                    channel.basic_publish(exchange='cot', routing_key='', body=json.dumps(
-                        {'cot': str(BeautifulSoup(event, 'xml')), 'uid': app.config['OTS_NODE_ID']}))
-                    # noinspection PyTypeChecker
-                    channel.basic_publish(exchange='cot_controller', routing_key='', body=json.dumps(
-                        {'cot': str(BeautifulSoup(event, 'xml')), 'uid': app.config['OTS_NODE_ID']}))
+                    cot = CoTEvent.from_xml(event)
+                    proto = encode_event(cot) if app.config.get("OTS_ENABLE_TAK_PROTOCOL") else None
+                    message = CoTEnvelope.from_event(app.config['OTS_NODE_ID'], cot, proto).pack()
+                    channel.basic_publish(exchange='cot', routing_key='', body=message, properties=PROPERTIES)
+                    channel.basic_publish(exchange='cot_controller', routing_key='', body=message, properties=PROPERTIES)
 
                 channel.close()
                 rabbit_connection.close()
@@ -85,6 +87,22 @@ def delete_video_recordings():
             logger.error("Failed to delete recordings: {}".format(e))
 
 
+# Keeps the last OTS_ARCHIVE_AFTER_DAYS of CoTs in the database and older ones in daily archive files, so it can run
+# while EUDs are connected. Purge Data deletes everything
+@apscheduler.task("cron", id="archive_cot", name="Archive CoTs", day="*", hour=0, minute=30, next_run_time=None)
+def archive_cot():
+    with apscheduler.app.app_context():
+        try:
+            archive = CoTArchive(app.config.get("OTS_ARCHIVE_FOLDER"), logger, app.config.get("OTS_ARCHIVE_BATCH_SIZE"))
+            archive.archive(db, app.config.get("OTS_ARCHIVE_AFTER_DAYS"))
+            if app.config.get("OTS_ARCHIVE_RETENTION_DAYS"):
+                archive.drop_expired(app.config.get("OTS_ARCHIVE_RETENTION_DAYS"))
+        except BaseException as e:
+            db.session.rollback()
+            logger.error("Failed to archive CoTs: {}".format(e))
+            logger.error(traceback.format_exc())
+
+
 @apscheduler.task("cron", id="purge_data", name="Purge Data", day="*", hour=0, minute=0, next_run_time=None)
 def purge_data():
     delete_video_recordings()
@@ -95,6 +113,7 @@ def purge_data():
     ChatroomsUids.query.delete()
     CoT.query.delete()
     DataPackage.query.delete()
+    LastPoint.query.delete()
     EUD.query.delete()
     GeoChat.query.delete()
     Marker.query.delete()
@@ -104,4 +123,5 @@ def purge_data():
     VideoStream.query.delete()
     ZMIST.query.delete()
     db.session.commit()
+    presence.forget_offline()
     logger.info("Purged all data")
@@ -1,32 +1,48 @@
-import json
 import socket
+import ssl
+import time
 import traceback
 import uuid
-from xml.etree.ElementTree import Element, SubElement, tostring, fromstring, ParseError
+from xml.etree.ElementTree import Element, SubElement, tostring, ParseError
 import datetime
-from threading import Thread
 
 from flask_security import verify_password
-
-from bs4 import BeautifulSoup
-import pika
-
-from opentakserver.extensions import db
+from google.protobuf.message import DecodeError
+
+from opentakserver.controllers.outbound_queue import OutboundQueue
+from opentakserver.cot.envelope import CoTEnvelope, PROPERTIES
+from opentakserver.cot.event import CoTEvent
+from opentakserver.cot.framer import CoTFramer, ProtobufFramer
+from opentakserver.cot.protobuf import VERSION, decode_event, encode_event, negotiation_response, requested_version, \
+    stream_frame, version_advertisement
+from opentakserver.cot.wire import WireCoT
+from opentakserver.extensions import db, rabbitmq_pool, presence
 from opentakserver.models.EUD import EUD
 
 
-class ClientController(Thread):
-    def __init__(self, address, port, sock, logger, app, is_ssl):
-        Thread.__init__(self)
+class ClientController:
+    def __init__(self, address, port, sock, logger, app, is_ssl, server):
         self.address = address
         self.port = port
         self.sock = sock
         self.logger = logger
         self.shutdown = False
-        self.sock.settimeout(1.0)
         self.app = app
         self.db = db
         self.is_ssl = is_ssl
+        self.server = server
+        self.closed = False
+
+        # Socket buffers
+        self.framer = CoTFramer(app.config.get("OTS_MAX_COT_SIZE"))
+        self.outbound = OutboundQueue(app.config.get("OTS_CLIENT_QUEUE_SIZE"))
+        self.high_water = app.config.get("OTS_CLIENT_QUEUE_HIGH_WATER")
+        self.slow_timeout = app.config.get("OTS_CLIENT_SLOW_TIMEOUT")
+        self.over_high_water_since = None
+
+        # The TAK protocol version the client switched to, 0 while it's still sending XML
+        self.tak_protocol = app.config.get("OTS_ENABLE_TAK_PROTOCOL")
+        self.protocol_version = 0
 
         # Device attributes
         self.uid = None
@@ -52,159 +68,286 @@ class ClientController(Thread):
         self.location_source = None
         self.common_name = None
 
-        if self.is_ssl:
-            try:
-                self.sock.do_handshake()
-                for c in self.sock.getpeercert()['subject']:
-                    if c[0][0] == 'commonName':
-                        self.common_name = c[0][1]
-                        self.logger.debug("Got common name {}".format(self.common_name))
-            except BaseException as e:
-                logger.warning("Failed to do handshake: {}".format(e))
-
-        # RabbitMQ
-        try:
-            self.rabbit_connection = pika.SelectConnection(pika.ConnectionParameters(self.app.config.get("OTS_RABBITMQ_SERVER_ADDRESS")),
-                                                           self.on_connection_open)
-            self.rabbit_channel = None
-            self.iothread = Thread(target=self.rabbit_connection.ioloop.start)
-            self.iothread.daemon = True
-            self.iothread.start()
-            self.is_consuming = False
-        except BaseException as e:
-            self.logger.error("Failed to connect to rabbitmq: {}".format(e))
-            return
+        # RabbitMQ, a channel leased from the shared pool once the EUD identifies itself
+        self.rabbit_channel = None
+        self.consumer = None
 
-    def on_connection_open(self, connection):
-        self.rabbit_connection.channel(on_open_callback=self.on_channel_open)
-        self.rabbit_connection.add_on_close_callback(self.on_close)
+        # uid -> last event time of the SA messages sent in the roster, so older copies from RabbitMQ can be dropped
+        self.roster_times = {}
 
-    def on_channel_open(self, channel):
-        self.rabbit_channel = channel
-        self.rabbit_channel.add_on_close_callback(self.on_close)
+        # The socket server has already done the TLS handshake
+        if self.is_ssl:
+            for c in self.sock.getpeercert().get('subject', ()):
+                if c[0][0] == 'commonName':
+                    self.common_name = c[0][1]
+                    self.logger.debug("Got common name {}".format(self.common_name))
+
+        self.sock.setblocking(False)
 
-    def on_close(self, channel, error):
-        self.logger.info("Connection closed for {}: {}".format(self.address, error))
+        # Lets the client know it can switch to protobuf
+        if self.tak_protocol:
+            self.send(version_advertisement())
 
+    # Called from the RabbitMQ ioloop thread with the DMs and chatroom messages sent to this EUD's queue. Broadcasts
+    # come from the socket server, see SocketServer.broadcast()
     def on_message(self, unused_channel, basic_deliver, properties, body):
         try:
-            body = json.loads(body)
-            if body['uid'] != self.uid:
-                self.sock.send(body['cot'].encode())
+            self.server.call_soon(self.deliver, WireCoT(CoTEnvelope.unpack(body, properties.content_type)))
         except:
             self.logger.error(traceback.format_exc())
 
-    def run(self):
-        while not self.shutdown:
+    # Runs on the socket server's loop, so nothing is sent in the protocol the client just switched away from
+    def deliver(self, cot):
+        envelope = cot.envelope
+        if envelope.uid == self.uid:
+            return
+
+        if self.roster_times and envelope.event_uid in self.roster_times:
+            sent = self.roster_times.pop(envelope.event_uid, None)
+            if sent and cot.start and cot.start <= sent:
+                return
+
+        self.send(cot.proto if self.protocol_version else cot.xml, cot.key)
+
+    # A CoT in the protocol this client uses. The stream message is usually translated once where the CoT came in,
+    # translating it here for every client is the fallback. Returns None if the CoT can't be sent as protobuf
+    def encode(self, xml, proto=None):
+        if not self.protocol_version:
+            return xml
+        elif proto:
+            return proto
+
+        try:
+            return encode_event(CoTEvent.from_xml(xml))
+        except ParseError:
+            return None
+
+    def send(self, data, key=None):
+        if self.closed or data is None:
+            return
+
+        if not self.outbound.put(data, key) and self.outbound.dropped % 100 == 1:
+            self.logger.warning("{} is too slow, {} CoTs dropped".format(self.callsign or self.address,
+                                                                         self.outbound.dropped))
+        self.flush()
+
+    def flush(self):
+        while not self.closed:
+            data = self.outbound.next()
+            if data is None:
+                break
+
             try:
-                data = self.sock.recv(4096)
-            except (ConnectionError, ConnectionResetError) as e:
-                self.send_disconnect_cot()
+                sent = self.sock.send(data)
+            except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
                 break
-            except TimeoutError:
-                if self.shutdown:
-                    self.logger.warning("Closing connection to {}".format(self.address))
-                    self.send_disconnect_cot()
-                    self.sock.shutdown(socket.SHUT_RDWR)
-                    self.sock.close()
-                    break
-                else:
-                    continue
+            except OSError as e:
+                self.logger.warning("Failed to send to {}: {}".format(self.address, e))
+                self.close_connection()
+                return
 
-            if data:
-                # Sometimes recv() doesn't get all of the XML data in one go. Test if the XML is well-formed
-                # and if not, call recv() until it is
-                while True:
-                    try:
-                        fromstring(data)
-                        break
-                    except ParseError as e:
-                        try:
-                            data += self.sock.recv(4096)
-                            break
-                        except (ConnectionError, TimeoutError, ConnectionResetError) as e:
-                            break
-
-                soup = BeautifulSoup(data, 'xml')
-
-                event = soup.find('event')
-                auth = soup.find('auth')
-
-                if not self.is_authenticated and (auth or self.common_name):
-                    with self.app.app_context():
-                        if auth:
-                            cot = auth.find('cot')
-                            if cot:
-                                username = cot.attrs['username']
-                                password = cot.attrs['password']
-                                uid = cot.attrs['uid']
-                                user = self.app.security.datastore.find_user(username=username)
-                        elif self.common_name:
-                            user = self.app.security.datastore.find_user(username=self.common_name)
-
-                        if not user:
-                            self.logger.warning("User {} does not exist".format(username))
-                            self.close_connection()
-                            break
-                        elif not user.active:
-                            self.logger.warning("User {} is deactivated, disconnecting".format(username))
-                            self.close_connection()
-                            break
-                        elif self.common_name:
-                            self.logger.info("{} is ID'ed by cert".format(user.username))
-                            self.is_authenticated = True
-                        elif verify_password(password, user.password):
-                            self.logger.info("Successful login from {}".format(username))
-                            self.is_authenticated = True
-                            try:
-                                eud = self.db.session.execute(self.db.session.query(EUD).filter_by(uid=uid)).first()[0]
-                                self.logger.debug("Associating EUD uid {} to user {}".format(eud.uid, user.username))
-                                eud.user_id = user.id
-                                self.db.session.commit()
-                            except:
-                                self.logger.debug("This is a new eud: {} {}".format(uid, user.username))
-                                eud = EUD()
-                                eud.uid = uid
-                                eud.user_id = user.id
-                                self.db.session.add(eud)
-                                self.db.session.commit()
-
-                            else:
-                                self.logger.warning("Wrong password for user {}".format(username))
-                                self.close_connection()
-                                break
-
-                if event:
-                    # If this client is connected via ssl, make sure they're authenticated
-                    # before accepting any data from them
-                    if self.is_ssl and not self.is_authenticated:
-                        self.logger.warning("EUD isn't authenticated, ignoring")
-                        continue
-
-                    if event and self.pong(event):
-                        continue
-
-                    if event and not self.uid:
-                        self.parse_device_info(event)
-
-                    message = {'uid': self.uid, 'cot': str(soup)}
-                    if self.rabbit_channel:
-                        self.rabbit_channel.basic_publish(exchange='cot_controller', routing_key='',
-                                                          body=json.dumps(message))
-
-            else:
-                self.send_disconnect_cot()
+            self.outbound.sent(sent)
+            if sent < len(data):
                 break
 
+        if not self.closed:
+            self.server.set_writable(self, len(self.outbound) > 0)
+            self.check_high_water()
+
+    # Disconnects clients whose queue stays above the high water mark for too long
+    def check_high_water(self):
+        if len(self.outbound) < self.high_water:
+            self.over_high_water_since = None
+        elif self.over_high_water_since is None:
+            self.over_high_water_since = time.monotonic()
+        elif time.monotonic() - self.over_high_water_since > self.slow_timeout:
+            self.logger.warning("Disconnecting {}, it has had {} CoTs queued for over {} seconds".format(
+                self.callsign or self.address, len(self.outbound), self.slow_timeout))
+            self.close_connection()
+
+    def stats(self):
+        return {'address': self.address, 'uid': self.uid, 'callsign': self.callsign, 'depth': len(self.outbound),
+                'dropped': self.outbound.dropped, 'coalesced': self.outbound.coalesced,
+                'protocol': self.protocol_version}
+
+    def handle_read(self):
+        if self.closed:
+            return
+
+        try:
+            data = self.sock.recv(4096)
+            # SSL sockets can hold decrypted data that select() doesn't know about
+            while self.is_ssl and data and self.sock.pending():
+                data += self.sock.recv(self.sock.pending())
+        except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except OSError:
+            self.close_connection()
+            return
+
+        if not data:
+            self.close_connection()
+            return
+
+        self.receive(data)
+
+    # recv() can return part of an event or several events at once, the framer splits them back up
+    def receive(self, data):
+        framer = self.framer
+        try:
+            for frame in framer.split(data):
+                if self.closed:
+                    return
+                try:
+                    if self.protocol_version:
+                        self.handle_message(frame)
+                    else:
+                        self.handle_data(frame)
+                except BaseException as e:
+                    self.logger.error(traceback.format_exc())
+
+                # The client switched to protobuf partway through what it sent. The rest of it, including what the XML
+                # framer was still holding, is protobuf
+                if self.framer is not framer:
+                    self.receive(framer.take().lstrip())
+                    return
+        except ValueError as e:
+            self.logger.warning("Disconnecting {}: {}".format(self.address, e))
+            self.close_connection()
+
+    def handle_data(self, data):
+        try:
+            root = CoTEvent.from_xml(data)
+        except ParseError as e:
+            self.logger.warning("Ignoring malformed CoT from {}: {}".format(self.address, e))
+            return
+
+        event = root if root.name == 'event' else None
+        auth = root if root.name == 'auth' else None
+
+        if event and event.attrs.get('type') == 't-x-takp-q':
+            self.negotiate(event)
+            return
+
+        if not self.is_authenticated and (auth or self.common_name):
+            with self.app.app_context():
+                username = self.common_name
+                password = None
+                uid = None
+                user = None
+
+                if auth:
+                    cot = auth.find('cot')
+                    if cot:
+                        username = cot.attrs['username']
+                        password = cot.attrs['password']
+                        uid = cot.attrs['uid']
+                        user = self.app.security.datastore.find_user(username=username)
+                elif self.common_name:
+                    user = self.app.security.datastore.find_user(username=self.common_name)
+
+                if not user:
+                    self.logger.warning("User {} does not exist".format(username))
+                    self.close_connection()
+                    return
+                elif not user.active:
+                    self.logger.warning("User {} is deactivated, disconnecting".format(username))
+                    self.close_connection()
+                    return
+                elif self.common_name:
+                    self.logger.info("{} is ID'ed by cert".format(user.username))
+                    self.is_authenticated = True
+                elif verify_password(password, user.password):
+                    self.logger.info("Successful login from {}".format(username))
+                    self.is_authenticated = True
+                    try:
+                        eud = self.db.session.execute(self.db.session.query(EUD).filter_by(uid=uid)).first()[0]
+                        self.logger.debug("Associating EUD uid {} to user {}".format(eud.uid, user.username))
+                        eud.user_id = user.id
+                        self.db.session.commit()
+                    except:
+                        self.logger.debug("This is a new eud: {} {}".format(uid, user.username))
+                        eud = EUD()
+                        eud.uid = uid
+                        eud.user_id = user.id
+                        self.db.session.add(eud)
+                        self.db.session.commit()
+                else:
+                    self.logger.warning("Wrong password for user {}".format(username))
+                    self.close_connection()
+                    return
+
+        if event:
+            self.handle_event(event)
+
+    # A TAK protocol stream message, from clients that switched to protobuf
+    def handle_message(self, payload):
+        try:
+            event = decode_event(payload)
+        except (DecodeError, ParseError) as e:
+            self.logger.warning("Ignoring malformed TAK protocol message from {}: {}".format(self.address, e))
+            return
+
+        # The client's own encoding is passed on as is
+        self.handle_event(event, stream_frame(payload))
+
+    def handle_event(self, event, proto=None):
+        # If this client is connected via ssl, make sure they're authenticated
+        # before accepting any data from them
+        if self.is_ssl and not self.is_authenticated:
+            self.logger.warning("EUD isn't authenticated, ignoring")
+            return
+
+        if self.pong(event, proto):
+            return
+
+        if not self.uid:
+            self.parse_device_info(event)
+
+        self.publish(event, proto)
+
+    # The CoT is translated to a stream message here, once, instead of for every client that speaks protobuf
+    def publish(self, event, proto=None):
+        if proto is None and self.tak_protocol:
+            proto = encode_event(event)
+
+        envelope = CoTEnvelope.from_event(self.uid, event, proto)
+        rabbitmq_pool.publish('cot_controller', envelope.pack(), properties=PROPERTIES)
+
+    # The client asks to switch to protobuf after seeing the version advertisement. The response is still XML, the
+    # client doesn't send anything in between and everything after it is protobuf both ways
+    def negotiate(self, event):
+        version = requested_version(event)
+        accepted = bool(self.tak_protocol) and version == VERSION
+        self.send(negotiation_response(accepted))
+
+        if accepted:
+            self.protocol_version = version
+            self.framer = ProtobufFramer(self.app.config.get("OTS_MAX_COT_SIZE"))
+            self.logger.info("{} switched to TAK protocol version {}".format(self.callsign or self.address, version))
+        else:
+            self.logger.warning("{} asked for unsupported TAK protocol version {}".format(
+                self.callsign or self.address, version))
+
     def close_connection(self):
+        if self.closed:
+            return
+
         self.send_disconnect_cot()
-        self.sock.shutdown(socket.SHUT_RDWR)
+        self.closed = True
+        self.outbound.clear()
+        self.server.remove_client(self)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.sock.close()
 
     def stop(self):
         self.shutdown = True
+        self.server.call_soon(self.close_connection)
 
-    def pong(self, event):
+    def pong(self, event, proto=None):
         if 'uid' in event.attrs and event.attrs['uid'].endswith('ping'):
             now = datetime.datetime.now()
             stale = now + datetime.timedelta(seconds=10)
@@ -214,26 +357,40 @@ class ClientController(Thread):
             SubElement(cot, 'point', {'ce': '9999999', 'le': '9999999', 'hae': '0', 'lat': '0',
                                                 'lon': '0'})
 
-            self.sock.send(event.encode())
+            self.send(self.encode(event.xml, proto))
             return True
 
         return False
 
     def parse_device_info(self, event):
-        if not self.rabbit_channel:
-            return
         self.uid = event.attrs['uid']
         contact = event.find('contact')
         if contact:
             if 'callsign' in contact.attrs:
                 self.callsign = contact.attrs['callsign']
 
-                self.logger.debug("Declaring queue {}".format(self.uid))
-                self.rabbit_channel.queue_declare(queue=self.uid)
-                self.rabbit_channel.queue_bind(exchange='cot', queue=self.uid)
-                self.rabbit_channel.basic_consume(queue=self.uid, on_message_callback=self.on_message, auto_ack=True)
+                takv = event.find('takv')
+                roster = None
+                if not takv or takv.attrs.get('platform') != "OpenTAK ICU":
+                    roster = presence.roster(exclude=self.uid)
+                    if self.app.config.get("OTS_ROSTER_DEDUP"):
+                        self.roster_times = {uid: last_event_time for uid, last_event_time, cot, proto in roster}
+
+                # Broadcasts on the cot exchange reach every client through the socket server's own queue, this
+                # EUD's queue only gets its DMs and chatroom messages. Queues of EUDs that connected to older versions
+                # are still bound to the cot exchange
+                self.rabbit_channel = rabbitmq_pool.acquire()
+                self.consumer = self.rabbit_channel.consume(self.uid, self.on_message)
+                self.rabbit_channel.unbind(self.uid, 'cot')
+                self.server.subscribe()
                 self.logger.debug("{} is consuming".format(self.callsign))
 
+                # The latest SA of every online EUD goes straight to the socket in one write instead of one RabbitMQ
+                # message per EUD
+                if roster:
+                    self.send(b''.join(filter(None, (self.encode(cot, proto)
+                                                     for uid, last_event_time, cot, proto in roster))))
+
     def send_disconnect_cot(self):
         if self.uid:
             now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -247,8 +404,10 @@ class ClientController(Thread):
             link = SubElement(detail, 'link', {'relation': 'p-p', 'uid': self.uid, 'type': 'a-f-G-U-C'})
             flow_tags = SubElement(detail, '_flow-tags_', {'TAK-Server-f1a8159ef7804f7a8a32d8efc4b773d0': now})
 
-            message = json.dumps({'uid': self.uid, 'cot': tostring(event).decode('utf-8')})
-            self.rabbit_channel.basic_publish(exchange='cot_controller', routing_key='', body=message)
+            self.publish(CoTEvent(event, tostring(event)))
+
+        if self.rabbit_channel:
+            self.rabbit_channel.cancel(self.consumer)
+            rabbitmq_pool.release(self.rabbit_channel)
+            self.rabbit_channel = None
         self.logger.info('{} disconnected'.format(self.address))
-        if self.rabbit_connection:
-            self.rabbit_connection.close()
@@ -1,21 +1,23 @@
-import json
-import re
 import traceback
-from threading import Thread
+from threading import Thread, local
 
 import bleach
 import sqlalchemy.exc
 from sqlalchemy import exc, insert, update
-from bs4 import BeautifulSoup
 import pika
 
-from opentakserver.extensions import socketio
+from opentakserver import geohash
+from opentakserver.controllers.cot_writer import CoTWriter
+from opentakserver.controllers.persistence_pool import PersistencePool
+from opentakserver.cot.classifier import classify
+from opentakserver.cot.envelope import BATCH_CONTENT_TYPE, CoTEnvelope, PROPERTIES, UDP_APP_ID, unpack_batch
+from opentakserver.extensions import socketio, presence
 from opentakserver.functions import datetime_from_iso8601_string
+from opentakserver.presence import pack_change
 from opentakserver.models.Chatrooms import Chatroom
 from opentakserver.models.Alert import Alert
 from opentakserver.models.CasEvac import CasEvac
 from opentakserver.models.ChatroomsUids import ChatroomsUids
-from opentakserver.models.CoT import CoT
 from opentakserver.models.EUD import EUD
 from opentakserver.models.GeoChat import GeoChat
 from opentakserver.models.Icon import Icon
@@ -25,18 +27,60 @@ from opentakserver.models.VideoStream import VideoStream
 from opentakserver.models.ZMIST import ZMIST
 from opentakserver.models.Point import Point
 from opentakserver.models.Marker import Marker
+from opentakserver.unpatched import GreenCalls
+
+
+# A message from the cot_controller queue. It's acked once every CoT in it has been saved, so when the persistence
+# workers fall behind the broker stops delivering at the prefetch count instead of the ioloop waiting on the DB
+class Delivery:
+    def __init__(self, controller, channel, delivery_tag):
+        self.controller = controller
+        self.channel = channel
+        self.delivery_tag = delivery_tag
+        # on_message holds one until it's done routing the message
+        self.pending = 1
+
+    def add(self):
+        self.pending += 1
+
+    # Runs on a persistence worker's thread
+    def saved(self):
+        if self.controller.rabbit_connection.is_open:
+            self.controller.rabbit_connection.ioloop.add_callback_threadsafe(self.release)
+
+    # Runs on the RabbitMQ ioloop thread. If the channel closed the broker has already requeued the message
+    def release(self):
+        self.pending -= 1
+        if not self.pending and self.channel.is_open:
+            self.channel.basic_ack(self.delivery_tag)
 
 
 class CoTController:
     def __init__(self, context, logger, db, socketio):
-        self.context = context
+        self.app = context.app
+        self.contexts = local()
         self.logger = logger
         self.db = db
         self.socketio = socketio
 
-        self.online_euds = {}
-        self.online_callsigns = {}
         self.exchanges = []
+        # EUDs that came online over UDP and whose queue isn't bound yet
+        self.unbound = set()
+
+        # The writer and the persistence workers are real OS threads, their socketio emits go through this
+        self.green = GreenCalls(logger)
+
+        self.writer = CoTWriter(self.app, logger, db, self.app.config.get("OTS_COT_WRITER_BATCH_SIZE"),
+                                self.app.config.get("OTS_COT_WRITER_FLUSH_INTERVAL") / 1000,
+                                self.app.config.get("OTS_COT_WRITER_MAX_PENDING"), self.green)
+        self.writer.start()
+
+        self.persistence = PersistencePool(logger, self.app.config.get("OTS_PERSISTENCE_WORKERS"))
+
+        # Streaming workers keep a copy of the presence registry up to date from the presence exchange
+        self.streaming_workers = self.app.config.get("OTS_STREAMING_WORKERS")
+        if self.streaming_workers:
+            presence.listeners.append(self.publish_presence)
 
         # RabbitMQ
         try:
@@ -51,147 +95,217 @@ class CoTController:
             self.logger.error("cot_controller - Failed to connect to rabbitmq: {}".format(e))
             return
 
+    # Flask-SQLAlchemy scopes sessions to the app context, so each thread that uses the DB needs its own
+    @property
+    def context(self):
+        if not hasattr(self.contexts, 'context'):
+            self.contexts.context = self.app.app_context()
+        return self.contexts.context
+
+    # Stops consuming and saves any CoTs still waiting for a persistence worker or the writer
+    def stop(self):
+        if self.rabbit_connection.is_open:
+            self.rabbit_connection.ioloop.add_callback_threadsafe(self.rabbit_connection.close)
+        self.persistence.stop()
+        self.writer.stop()
+
     def on_connection_open(self, connection):
         self.rabbit_connection.channel(on_open_callback=self.on_channel_open)
         self.rabbit_connection.add_on_close_callback(self.on_close)
+        self.rabbit_connection.ioloop.call_later(1, self.expire_presence)
 
     def on_channel_open(self, channel):
         self.rabbit_channel = channel
         self.rabbit_channel.queue_declare(queue='cot_controller')
         self.rabbit_channel.exchange_declare(exchange='cot_controller', exchange_type='fanout')
         self.rabbit_channel.queue_bind(exchange='cot_controller', queue='cot_controller')
-        self.rabbit_channel.basic_consume(queue='cot_controller', on_message_callback=self.on_message, auto_ack=True)
-        self.rabbit_channel.add_on_close_callback(self.on_close)
+        # AMQP's prefetch count is at most 65535
+        self.rabbit_channel.basic_qos(prefetch_count=min(65535, self.app.config.get("OTS_PERSISTENCE_MAX_PENDING")))
+        self.rabbit_channel.basic_consume(queue='cot_controller', on_message_callback=self.on_message)
+        self.rabbit_channel.add_on_close_callback(self.on_channel_closed)
+
+        if self.streaming_workers:
+            self.rabbit_channel.exchange_declare(exchange='presence', exchange_type='fanout')
+            self.rabbit_channel.queue_declare(queue='presence_sync')
+            self.rabbit_channel.basic_consume(queue='presence_sync', on_message_callback=self.on_presence_sync,
+                                              auto_ack=True)
+
+    # Presence changes happen on the RabbitMQ ioloop thread, so they're published in the order they happened
+    def publish_presence(self, change):
+        if self.rabbit_channel and self.rabbit_channel.is_open:
+            self.rabbit_channel.basic_publish(exchange='presence', routing_key='', body=pack_change(change))
+
+    # A streaming worker that just started asks for every online EUD. They're sent to its queue followed by a
+    # message of type synced. Being published on the same channel as the changes keeps them in order
+    def on_presence_sync(self, unused_channel, basic_deliver, properties, body):
+        try:
+            for uid, callsign, cot, last_event_time, stale, proto in presence.online_euds():
+                self.rabbit_channel.basic_publish(exchange='', routing_key=properties.reply_to, body=pack_change(
+                    ('connect', uid, callsign, cot, last_event_time, stale, 'Connected', proto)))
+            self.rabbit_channel.basic_publish(exchange='', routing_key=properties.reply_to, body=b'',
+                                              properties=pika.BasicProperties(type='synced'))
+        except BaseException as e:
+            self.logger.error(traceback.format_exc())
 
-    def on_close(self, channel, error):
-        self.logger.error("cot_controller closing RabbitMQ connection: {}".format(error))
+    def expire_presence(self):
+        # Saved on the EUD's persistence worker, so it stays in order with the EUD's CoTs
+        for uid in presence.expire():
+            self.logger.debug("{} went stale".format(uid))
+            self.persistence.submit(uid, self.save_status, uid, 'Stale')
 
-    def parse_device_info(self, uid, soup, event):
-        link = event.find('link')
-        fileshare = event.find('fileshare')
+        if self.rabbit_connection.is_open:
+            self.rabbit_connection.ioloop.call_later(1, self.expire_presence)
 
-        # Don't parse server generated messages
-        with self.context:
-            if uid == self.context.app.config.get("OTS_NODE_ID"):
-                return
+    def on_close(self, connection, error):
+        self.rabbit_channel = None
+        self.logger.error("cot_controller closing RabbitMQ connection: {}".format(error))
 
-        callsign = None
-        phone_number = None
+    # The broker closes the channel on errors like binding a queue that doesn't exist. Without a new one nothing
+    # would be routed until a restart
+    def on_channel_closed(self, channel, error):
+        self.rabbit_channel = None
+        self.logger.error("cot_controller RabbitMQ channel closed: {}".format(error))
+        if self.rabbit_connection.is_open:
+            self.rabbit_connection.channel(on_open_callback=self.on_channel_open)
+
+    # Runs on the RabbitMQ ioloop thread. Keeps track of online EUDs and their queues and returns True when the EUD's
+    # info should be saved to the DB. EUDs that aren't connected to a streaming port, i.e. mesh SA received over UDP,
+    # are online but have no queue to bind
+    def track_device(self, uid, event, streaming=True, proto=None):
+        # Don't parse server generated messages
+        if uid == self.app.config.get("OTS_NODE_ID"):
+            return False
 
-        if uid not in self.online_euds and not uid.endswith('ping'):
+        if uid not in presence and not uid.endswith('ping'):
             takv = event.find('takv')
-            if takv:
-                device = takv.attrs['device']
-                os = takv.attrs['os']
-                platform = takv.attrs['platform']
-                version = takv.attrs['version']
-
-                contact = event.find('contact')
-                if contact:
-                    if 'callsign' in contact.attrs:
-                        callsign = contact.attrs['callsign']
-
-                        if uid not in self.online_euds:
-                            self.online_euds[uid] = {'cot': str(soup), 'callsign': callsign}
-
-                        if callsign not in self.online_callsigns:
-                            self.online_callsigns[callsign] = {'uid': uid, 'cot': soup}
-
-                        # Declare a RabbitMQ Queue for this uid and join the 'dms' and 'cot' exchanges
-                        if self.rabbit_channel and self.rabbit_channel.is_open and platform != "OpenTAK ICU":
-                            self.rabbit_channel.queue_bind(exchange='dms', queue=uid, routing_key=uid)
-                            self.rabbit_channel.queue_bind(exchange='chatrooms', queue=uid,
-                                                           routing_key='All Chat Rooms')
-
-                            for eud in self.online_euds:
-                                self.rabbit_channel.basic_publish(exchange='dms',
-                                                                  routing_key=uid,
-                                                                  body=json.dumps({'cot': str(self.online_euds[eud]['cot']),
-                                                                                   'uid': None}))
-
-                    if 'phone' in contact.attrs:
-                        phone_number = contact.attrs['phone']
+            if not takv:
+                return False
 
-                with self.context:
-                    group = event.find('__group')
-                    team = Team()
+            contact = event.find('contact')
+            if contact and 'callsign' in contact.attrs:
+                callsign = contact.attrs['callsign']
+                presence.connect(uid, callsign, event.xml, datetime_from_iso8601_string(event.attrs['start']),
+                                 datetime_from_iso8601_string(event.attrs['stale']), proto)
 
-                    if group:
-                        # Declare an exchange for each group and bind the callsign's queue
-                        if self.rabbit_channel.is_open and group.attrs['name'] not in self.exchanges:
-                            self.logger.debug("Declaring exchange {}".format(group.attrs['name']))
-                            self.rabbit_channel.exchange_declare(exchange=group.attrs['name'])
-                            self.rabbit_channel.queue_bind(queue=uid, exchange='chatrooms', routing_key=group.attrs['name'])
-                            self.exchanges.append(group.attrs['name'])
+                if streaming:
+                    self.bind_queue(uid, takv)
+                else:
+                    self.unbound.add(uid)
 
-                        team.name = bleach.clean(group.attrs['name'])
+            group = event.find('__group')
+            # Declare an exchange for each group and bind the callsign's queue
+            if (streaming and group and self.rabbit_channel and self.rabbit_channel.is_open and
+                    group.attrs['name'] not in self.exchanges):
+                self.logger.debug("Declaring exchange {}".format(group.attrs['name']))
+                self.rabbit_channel.exchange_declare(exchange=group.attrs['name'])
+                self.rabbit_channel.queue_bind(queue=uid, exchange='chatrooms', routing_key=group.attrs['name'])
+                self.exchanges.append(group.attrs['name'])
 
-                        try:
-                            chatroom = self.db.session.execute(self.db.session.query(Chatroom)
-                                                               .filter(Chatroom.name == team.name)).first()[0]
-                            team.chatroom_id = chatroom.id
-                        except TypeError:
-                            chatroom = None
+            return True
 
-                        try:
-                            self.db.session.add(team)
-                            self.db.session.commit()
-                        except sqlalchemy.exc.IntegrityError:
-                            self.db.session.rollback()
-                            team = self.db.session.execute(self.db.session.query(Team)
-                                                           .filter(Team.name == group.attrs['name'])).first()[0]
-                            if not team.chatroom_id and chatroom:
-                                team.chatroom_id = chatroom.id
-                                self.db.session.execute(update(Team).filter(Team.name).values(**team))
+        # Update the CoT stored in memory which contains the new stale time
+        elif event.find('takv'):
+            presence.update(uid, event.xml, datetime_from_iso8601_string(event.attrs['start']),
+                            datetime_from_iso8601_string(event.attrs['stale']), proto)
 
-                    try:
-                        eud = self.db.session.execute(self.db.session.query(EUD).filter_by(uid=uid)).first()[0]
-                    except:
-                        eud = EUD()
-
-                    eud.uid = uid
-                    eud.callsign = callsign
-                    eud.device = device
-                    eud.os = os
-                    eud.platform = platform
-                    eud.version = version
-                    eud.phone_number = phone_number
-                    eud.last_event_time = datetime_from_iso8601_string(event.attrs['start'])
-                    eud.last_status = 'Connected'
+            # An EUD that was seen over UDP first and has now connected to a streaming port
+            if streaming and uid in self.unbound:
+                self.bind_queue(uid, event.find('takv'))
 
-                    if group:
-                        eud.team_id = team.id
-                        eud.team_role = bleach.clean(group.attrs['role'])
+        return False
+
+    # Declare a RabbitMQ Queue for this uid and join the 'dms' and 'cot' exchanges. The EUD's ClientController sends it
+    # the roster of online EUDs
+    def bind_queue(self, uid, takv):
+        self.unbound.discard(uid)
+        if not self.rabbit_channel or not self.rabbit_channel.is_open:
+            return
+
+        # The ClientController declares the queue on its pooled channel too, but its first CoT can get here before
+        # that channel has opened. Declaring it again is a no-op
+        self.rabbit_channel.queue_declare(queue=uid)
+        if takv.attrs.get('platform') != "OpenTAK ICU":
+            self.rabbit_channel.queue_bind(exchange='dms', queue=uid, routing_key=uid)
+            self.rabbit_channel.queue_bind(exchange='chatrooms', queue=uid, routing_key='All Chat Rooms')
+
+    def parse_device_info(self, uid, event):
+        callsign = None
+        phone_number = None
 
-                    self.db.session.add(eud)
+        takv = event.find('takv')
+        device = takv.attrs['device']
+        os = takv.attrs['os']
+        platform = takv.attrs['platform']
+        version = takv.attrs['version']
+
+        contact = event.find('contact')
+        if contact:
+            if 'callsign' in contact.attrs:
+                callsign = contact.attrs['callsign']
+
+            if 'phone' in contact.attrs:
+                phone_number = contact.attrs['phone']
+
+        with self.context:
+            group = event.find('__group')
+            team = Team()
+
+            if group:
+                team.name = bleach.clean(group.attrs['name'])
+
+                try:
+                    chatroom = self.db.session.execute(self.db.session.query(Chatroom)
+                                                       .filter(Chatroom.name == team.name)).first()[0]
+                    team.chatroom_id = chatroom.id
+                except TypeError:
+                    chatroom = None
+
+                try:
+                    self.db.session.add(team)
                     self.db.session.commit()
+                except sqlalchemy.exc.IntegrityError:
+                    self.db.session.rollback()
+                    team = self.db.session.execute(self.db.session.query(Team)
+                                                   .filter(Team.name == group.attrs['name'])).first()[0]
+                    if not team.chatroom_id and chatroom:
+                        team.chatroom_id = chatroom.id
+                        self.db.session.execute(update(Team).filter(Team.name).values(**team))
 
-                    socketio.emit('eud', eud.to_json(), namespace='/socket.io')
+            try:
+                eud = self.db.session.execute(self.db.session.query(EUD).filter_by(uid=uid)).first()[0]
+            except:
+                eud = EUD()
+
+            eud.uid = uid
+            eud.callsign = callsign
+            eud.device = device
+            eud.os = os
+            eud.platform = platform
+            eud.version = version
+            eud.phone_number = phone_number
+            eud.last_event_time = datetime_from_iso8601_string(event.attrs['start'])
+            eud.last_status = 'Connected'
+
+            if group:
+                eud.team_id = team.id
+                eud.team_role = bleach.clean(group.attrs['role'])
+
+            self.db.session.add(eud)
+            self.db.session.commit()
 
-        # Update the CoT stored in memory which contains the new stale time
-        elif event.find('takv'):
-            self.online_euds[uid]['cot'] = str(soup)
+            self.green.call(socketio.emit, 'eud', eud.to_json(), namespace='/socket.io')
 
-    def insert_cot(self, soup, event, uid):
-        try:
-            sender_callsign = self.online_euds[uid]['callsign']
-        except:
-            sender_callsign = 'server'
+    def parse_cot(self, event, uid):
+        sender_callsign = presence.get_callsign(uid) or 'server'
 
         start = datetime_from_iso8601_string(event.attrs['start'])
         stale = datetime_from_iso8601_string(event.attrs['stale'])
         timestamp = datetime_from_iso8601_string(event.attrs['time'])
 
-        with self.context:
-            res = self.db.session.execute(insert(CoT).values(
-                how=event.attrs['how'], type=event.attrs['type'], sender_callsign=sender_callsign,
-                sender_uid=uid, timestamp=timestamp, xml=str(soup), start=start, stale=stale
-            ))
+        return dict(how=event.attrs['how'], type=event.attrs['type'], sender_callsign=sender_callsign,
+                    sender_uid=uid, timestamp=timestamp, xml=str(event), start=start, stale=stale)
 
-            self.db.session.commit()
-            return res.inserted_primary_key[0]
-
-    def parse_point(self, event, uid, cot_id):
+    def parse_point(self, event, uid):
         # hae = Height above the WGS ellipsoid in meters
         # ce = Circular 1-sigma or a circular area about the location in meters
         # le = Linear 1-sigma error or an altitude range about the location in meters
@@ -206,7 +320,6 @@ class CoTController:
             p.latitude = float(point.attrs['lat'])
             p.longitude = float(point.attrs['lon'])
             p.timestamp = datetime_from_iso8601_string(event.attrs['time'])
-            p.cot_id = cot_id
 
             # We only really care about the rest of the data if there's a valid lat/lon
             if p.latitude == 0 and p.longitude == 0:
@@ -246,25 +359,9 @@ class CoTController:
                 if 'battery' in status.attrs:
                     p.battery = status.attrs['battery']
 
-            with self.context:
-                res = self.db.session.execute(insert(Point).values(
-                    uid=p.uid, device_uid=p.device_uid, ce=p.ce, hae=p.hae, le=p.le, latitude=p.latitude,
-                    longitude=p.longitude, timestamp=p.timestamp, cot_id=cot_id, location_source=p.location_source,
-                    course=p.course, speed=p.speed, battery=p.battery, fov=p.fov, azimuth=p.azimuth)
-                )
-
-                self.db.session.commit()
-                # Get the point from the DB with its related CoT
-                p = self.db.session.execute(
-                    self.db.session.query(Point).filter(Point.id == res.inserted_primary_key[0])).first()[0]
-
-                # This CoT is a position update for an EUD, send it to socketio clients, so it can be seen on the UI map
-                # OpenTAK ICU position updates don't include the <takv> tag, but we still want to send the updated position
-                # to the UI's map
-                if event.find('takv') or event.find("__video"):
-                    socketio.emit('point', p.to_json(), namespace='/socket.io')
-
-                return res.inserted_primary_key[0]
+            return dict(uid=p.uid, device_uid=p.device_uid, ce=p.ce, hae=p.hae, le=p.le, latitude=p.latitude,
+                        longitude=p.longitude, geohash=geohash.encode(p.latitude, p.longitude), timestamp=p.timestamp, location_source=p.location_source,
+                        course=p.course, speed=p.speed, battery=p.battery, fov=p.fov, azimuth=p.azimuth)
 
     def parse_geochat(self, event, cot_id, point_pk):
         chat = event.find('__chat')
@@ -390,7 +487,7 @@ class CoTController:
                 with self.context:
                     self.db.session.add(alert)
                     self.db.session.commit()
-                    socketio.emit('alert', alert.to_json(), namespace='/socket.io')
+                    self.green.call(socketio.emit, 'alert', alert.to_json(), namespace='/socket.io')
             elif 'cancel' in emergency.attrs:
                 with self.context:
                     try:
@@ -399,7 +496,7 @@ class CoTController:
                                 Alert.start_time.desc())).first()[0]
                         alert.cancel_time = datetime_from_iso8601_string(event.attrs['start'])
                         self.db.session.commit()
-                        socketio.emit('alert', alert.to_json(), namespace='/socket.io')
+                        self.green.call(socketio.emit, 'alert', alert.to_json(), namespace='/socket.io')
                     except BaseException as e:
                         self.logger.error("Failed to set alert cancel time: {}".format(e))
 
@@ -434,10 +531,11 @@ class CoTController:
                             update(ZMIST).where(CasEvac.uid == event.attrs['uid']).values(**zmist.attrs))
                 self.db.session.commit()
 
-    def parse_marker(self, event, uid, point_pk, cot_pk):
-        if ((re.match("^a-[f|h|u|p|a|n|s|j|k]-[Z|P|A|G|S|U|F]", event.attrs['type']) or
-             # Spot map
-             re.match("^b-m-p", event.attrs['type'])) and
+    # The CoT writer fills in point_id and cot_id once the point and CoT are written
+    def parse_marker(self, event, uid):
+        cot_type = classify(event.attrs['type'])
+        # Atoms and spot map points
+        if (cot_type.is_marker and
                 # Don't worry about EUD location updates
                 not event.find('takv') and
                 # Ignore video streams from sources like OpenTAK ICU
@@ -446,24 +544,9 @@ class CoTController:
             try:
                 marker = Marker()
                 marker.uid = event.attrs['uid']
-                marker.affiliation = self.get_affiliation(event.attrs['type'])
-                marker.battle_dimension = self.get_battle_dimension(event.attrs['type'])
-
-                marker.mil_std_2525c = "s"
-                cot_type_list = event.attrs['type'].split("-")
-                cot_type_list.pop(0)  # this should always be letter a
-                affiliation = cot_type_list.pop(0)
-                battle_dimension = cot_type_list.pop(0)
-                marker.mil_std_2525c += affiliation
-                marker.mil_std_2525c += battle_dimension
-                marker.mil_std_2525c += "-"
-
-                for letter in cot_type_list:
-                    if letter.isupper():
-                        marker.mil_std_2525c += letter.lower()
-
-                while len(marker.mil_std_2525c) < 10:
-                    marker.mil_std_2525c += "-"
+                marker.affiliation = cot_type.affiliation
+                marker.battle_dimension = cot_type.battle_dimension
+                marker.mil_std_2525c = cot_type.mil_std_2525c
 
                 detail = event.find('detail')
                 icon = None
@@ -510,33 +593,14 @@ class CoTController:
                     marker.relation_type = link.attrs['relation_type'] if 'relation_type' in link.attrs else None
                     marker.parent_uid = link.attrs['uid'] if 'uid' in link.attrs else None
 
-                marker.point_id = point_pk
-                marker.cot_id = cot_pk
-
-                with self.context:
-                    try:
-                        self.db.session.add(marker)
-                        self.db.session.commit()
-                        self.logger.debug('added marker')
-                    except exc.IntegrityError:
-                        self.db.session.rollback()
-                        self.db.session.execute(
-                            update(Marker).where(Marker.uid == marker.uid).values(point_id=marker.point_id,
-                                                                                  icon_id=marker.icon_id,
-                                                                                  **marker.serialize()))
-                        self.db.session.commit()
-                        self.logger.debug('updated marker')
-                        marker = self.db.session.execute(self.db.session.query(Marker)
-                                                         .filter(Marker.uid == marker.uid)).first()[0]
-
-                    socketio.emit('marker', marker.to_json(), namespace='/socket.io')
+                return dict(icon_id=marker.icon_id, parent_uid=marker.parent_uid, **marker.serialize())
 
             except BaseException as e:
                 self.logger.error("Failed to parse marker: {}".format(e))
                 self.logger.error(traceback.format_exc())
 
     def parse_rbline(self, event, uid, point_pk, cot_pk):
-        if re.match("^u-rb", event.attrs['type']):
+        if classify(event.attrs['type']).is_rb_line:
             self.logger.debug("Got an R&B line")
             rb_line = RBLine()
 
@@ -595,21 +659,32 @@ class CoTController:
                         self.logger.debug('Updated R&B line: {}'.format(rb_line.uid))
 
                     rb_line.point = start_point
-                    socketio.emit("rb_line", rb_line.to_json(), namespace='/socket.io')
+                    self.green.call(socketio.emit, "rb_line", rb_line.to_json(), namespace='/socket.io')
+
+    # Runs on the CoT writer's thread once the CoT and its point are in the DB
+    def parse_details(self, event, uid, cot_pk, point_pk):
+        self.parse_geochat(event, cot_pk, point_pk)
+        self.parse_video(event, cot_pk)
+        self.parse_alert(event, uid, point_pk, cot_pk)
+        self.parse_casevac(event, uid, point_pk, cot_pk)
+        self.parse_rbline(event, uid, point_pk, cot_pk)
 
-    def rabbitmq_routing(self, event, data):
+    def rabbitmq_routing(self, event, envelope):
         # RabbitMQ Routing
         chat = event.find("__chat")
         destinations = event.find_all('dest')
 
         if chat and 'chatroom' in chat.attrs and chat.attrs['chatroom'] == 'All Chat Rooms':
-            self.rabbit_channel.basic_publish(exchange='chatrooms', routing_key='All Chat Rooms', body=json.dumps(data))
+            self.rabbit_channel.basic_publish(exchange='chatrooms', routing_key='All Chat Rooms', body=envelope.pack(),
+                                              properties=PROPERTIES)
 
         elif destinations:
             for destination in destinations:
                 # ATAK and WinTAK use callsign, iTAK uses uid
                 if 'callsign' in destination.attrs:
-                    uid = self.online_callsigns[destination.attrs['callsign']]['uid']
+                    uid = presence.get_uid(destination.attrs['callsign'])
+                    if not uid:
+                        continue
                 elif 'uid' in destination.attrs:
                     uid = destination.attrs['uid']
                 else:
@@ -617,123 +692,93 @@ class CoTController:
 
                 self.rabbit_channel.basic_publish(exchange='dms',
                                                   routing_key=uid,
-                                                  body=json.dumps(data))
+                                                  body=envelope.pack(), properties=PROPERTIES)
 
         # If no destination or callsign is specified, broadcast to all TAK clients
         elif self.rabbit_channel and self.rabbit_channel.is_open:
-            self.rabbit_channel.basic_publish(exchange='cot', routing_key="", body=json.dumps(data))
+            self.rabbit_channel.basic_publish(exchange='cot', routing_key="", body=envelope.pack(), properties=PROPERTIES)
 
         # Do nothing because the RabbitMQ channel hasn't opened yet or has closed
         else:
             self.logger.debug("Not publishing, channel closed")
 
-    def get_affiliation(self, type):
-        if re.match("^t-", type):
-            return self.get_tasking(type)
-        if re.match("^a-f-", type):
-            return "friendly"
-        if re.match("^a-h-", type):
-            return "hostile"
-        if re.match("^a-u-", type):
-            return "unknown"
-        if re.match("^a-p-", type):
-            return "pending"
-        if re.match("^a-a-", type):
-            return "assumed"
-        if re.match("^a-n-", type):
-            return "neutral"
-        if re.match("^a-s-", type):
-            return "suspect"
-        if re.match("^a-j-", type):
-            return "joker"
-        if re.match("^a-k-", type):
-            return "faker"
-
-    def get_tasking(self, type):
-        if re.match("^t-x-f", type):
-            return "remarks"
-        if re.match("^t-x-s", type):
-            return "state/sync"
-        if re.match("^t-s", type):
-            return "required"
-        if re.match("^t-z", type):
-            return "cancel"
-        if re.match("^t-x-c-c", type):
-            return "commcheck"
-        if re.match("^t-x-c-g-d", type):
-            return "dgps"
-        if re.match("^t-k-d", type):
-            return "destroy"
-        if re.match("^t-k-i", type):
-            return "investigate"
-        if re.match("^t-k-t", type):
-            return "target"
-        if re.match("^t-k", type):
-            return "strike"
-        if re.match("^t-", type):
-            return "tasking"
-
-    def get_battle_dimension(self, type):
-        if re.match("^a-.-A", type):
-            return "airborne"
-        if re.match("^a-.-G", type):
-            return "ground"
-        if re.match("^a-.-G-I", type):
-            return "installation"
-        if re.match("^a-.-S", type):
-            return "surface/sea"
-        if re.match("^a-.-U", type):
-            return "subsurface"
-
-    def parse_type(self, type):
-        if re.match("^a-.-G-I", type):
-            return "installation"
-        if re.match("^a-.-G-E-V", type):
-            return "vehicle"
-        if re.match("^a-.-G-E", type):
-            return "equipment"
-        if re.match("^a-.-A-W-M-S", type):
-            return "sam"
-        if re.match("^a-.-A-M-F-Q-r", type):
-            return "uav"
-
-    def on_message(self, unused_channel, basic_deliver, properties, body):
+    # Runs on a persistence worker's thread
+    def save_cot(self, event, uid, cot, new_device):
+        if new_device:
+            self.parse_device_info(uid, event)
+
+        # OpenTAK ICU position updates don't include the <takv> tag, but we still want to send the updated
+        # position to the UI's map
+        self.writer.write(cot, self.parse_point(event, uid), self.parse_marker(event, uid),
+                          bool(event.find('takv') or event.find("__video")),
+                          lambda cot_pk, point_pk: self.parse_details(event, uid, cot_pk, point_pk))
+
+        # EUD went offline
+        if event.attrs['type'] == 't-x-d-d':
+            try:
+                with self.context:
+                    eud = self.db.session.execute(self.db.select(EUD).filter_by(uid=uid)).scalar_one()
+                    eud.last_event_time = datetime_from_iso8601_string(event.attrs['start'])
+                    eud.last_status = 'Disconnected'
+                    self.db.session.commit()
+                    self.logger.debug("Updated {}".format(uid))
+                    eud_json = eud.to_json()
+                    # The first time an EUD connects but doesn't have a location.
+                    # Tells the UI what kind of EUD this is, ie ATAK/WinTAK/iTAK or OpenTAK ICU
+                    if not eud_json['last_point']:
+                        eud_json['type'] = event.attrs['type']
+                    self.green.call(socketio.emit, 'eud', eud.to_json(), namespace='/socket.io')
+            except BaseException as e:
+                self.logger.error("Failed to update EUD: {}".format(e))
+
+    # Runs on a persistence worker's thread
+    def save_status(self, uid, status):
+        try:
+            with self.context:
+                eud = self.db.session.execute(self.db.select(EUD).filter_by(uid=uid)).scalar_one_or_none()
+                if not eud:
+                    return
+                eud.last_status = status
+                self.db.session.commit()
+                self.green.call(socketio.emit, 'eud', eud.to_json(), namespace='/socket.io')
+        except BaseException as e:
+            self.logger.error("Failed to update EUD: {}".format(e))
+
+    # Routes the CoT right away and leaves saving it to the persistence workers, so a slow DB doesn't delay delivery
+    def on_message(self, channel, basic_deliver, properties, body):
+        delivery = Delivery(self, channel, basic_deliver.delivery_tag)
         try:
-            body = json.loads(body)
-            soup = BeautifulSoup(body['cot'], 'xml')
-            event = soup.find('event')
-            if event:
-                self.parse_device_info(body['uid'], soup, event)
-                cot_pk = self.insert_cot(soup, event, body['uid'])
-                point_pk = self.parse_point(event, body['uid'], cot_pk)
-                self.parse_geochat(event, cot_pk, point_pk)
-                self.parse_video(event, cot_pk)
-                self.parse_alert(event, body['uid'], point_pk, cot_pk)
-                self.parse_casevac(event, body['uid'], point_pk, cot_pk)
-                self.parse_marker(event, body['uid'], point_pk, cot_pk)
-                self.parse_rbline(event, body['uid'], point_pk, cot_pk)
-                self.rabbitmq_routing(event, body)
+            if properties.content_type == BATCH_CONTENT_TYPE:
+                envelopes = unpack_batch(body)
+            else:
+                envelopes = [CoTEnvelope.unpack(body, properties.content_type)]
+        except BaseException as e:
+            self.logger.error(traceback.format_exc())
+            envelopes = []
+
+        for envelope in envelopes:
+            self.handle_envelope(envelope, properties.app_id != UDP_APP_ID, delivery)
+        delivery.release()
+
+    def handle_envelope(self, envelope, streaming=True, delivery=None):
+        try:
+            event = envelope.event
+            uid = envelope.uid
+            if event.name == 'event':
+                new_device = self.track_device(uid, event, streaming, envelope.proto)
+                try:
+                    self.rabbitmq_routing(event, envelope)
+                except BaseException:
+                    self.logger.error(traceback.format_exc())
+                if delivery:
+                    delivery.add()
+                # The sender's callsign is looked up now in case the EUD goes offline before the CoT is saved
+                self.persistence.submit(uid, self.save_cot, event, uid, self.parse_cot(event, uid), new_device,
+                                        done=delivery.saved if delivery else None)
 
                 # EUD went offline
                 if event.attrs['type'] == 't-x-d-d':
                     link = event.find('link')
-
-                    try:
-                        with self.context:
-                            eud = self.db.session.execute(self.db.select(EUD).filter_by(uid=body['uid'])).scalar_one()
-                            eud.last_event_time = datetime_from_iso8601_string(event.attrs['start'])
-                            eud.last_status = 'Disconnected'
-                            self.db.session.commit()
-                            self.logger.debug("Updated {}".format(body['uid']))
-                            eud_json = eud.to_json()
-                            # The first time an EUD connects but doesn't have a location.
-                            # Tells the UI what kind of EUD this is, ie ATAK/WinTAK/iTAK or OpenTAK ICU
-                            if not eud_json['last_point']:
-                                eud_json['type'] = event.attrs['type']
-                            socketio.emit('eud', eud.to_json(), namespace='/socket.io')
-                    except BaseException as e:
-                        self.logger.error("Failed to update EUD: {}".format(e))
-
-                    self.online_euds.pop(link.attrs['uid'])
+                    presence.disconnect(link.attrs['uid'], datetime_from_iso8601_string(event.attrs['start']))
         except BaseException as e:
             self.logger.error(traceback.format_exc())
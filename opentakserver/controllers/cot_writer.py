@@ -0,0 +1,212 @@
+import time
+import traceback
+
+from sqlalchemy import insert, update, select
+
+from opentakserver.extensions import socketio
+from opentakserver.models.CoT import CoT
+from opentakserver.models.LastPoint import LastPoint
+from opentakserver.models.Point import Point
+from opentakserver.models.Marker import Marker
+from opentakserver.unpatched import GreenCalls, queue, threading
+
+
+class PendingCoT:
+    __slots__ = ('cot', 'point', 'marker', 'emit_point', 'callback', 'cot_id', 'point_id')
+
+    def __init__(self, cot, point=None, marker=None, emit_point=False, callback=None):
+        self.cot = cot
+        self.point = point
+        self.marker = marker
+        self.emit_point = emit_point
+        self.callback = callback
+        self.cot_id = None
+        self.point_id = None
+
+
+# Buffers CoT, Point, and Marker rows and writes them in multi-row inserts, one transaction per batch. A batch is
+# written once it holds batch_size CoTs or its oldest CoT has waited flush_interval seconds. It's a real OS thread, see
+# unpatched.py, so its socketio emits go through a GreenCalls
+class CoTWriter(threading.Thread):
+    STOP = object()
+
+    def __init__(self, app, logger, db, batch_size=500, flush_interval=0.25, max_pending=10000, green=None):
+        super().__init__()
+        self.daemon = True
+        self.context = app.app_context()
+        self.logger = logger
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.green = green or GreenCalls(logger)
+
+        # Bounds memory use. When the DB can't keep up write() blocks the persistence worker, which holds back the
+        # CoT controller's RabbitMQ acks until it catches up
+        self.queue = queue.Queue(maxsize=max_pending)
+
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+
+    # callback is called with (cot_pk, point_pk) on the writer's thread after the batch is committed
+    def write(self, cot, point=None, marker=None, emit_point=False, callback=None):
+        item = PendingCoT(cot, point, marker, emit_point, callback)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.logger.warning("CoT writer has {} CoTs waiting, blocking until the DB catches up".format(
+                self.queue.qsize()))
+            self.queue.put(item)
+
+    def stop(self):
+        self.queue.put(self.STOP)
+        self.join()
+
+    def stats(self):
+        return {'pending': self.queue.qsize(), 'max_pending': self.queue.maxsize, 'written': self.written,
+                'batches': self.batches, 'failed': self.failed}
+
+    def run(self):
+        batch = []
+        deadline = None
+
+        while True:
+            timeout = max(0, deadline - time.monotonic()) if batch else None
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is self.STOP:
+                self.flush(batch)
+                self.logger.info("CoT writer stopped")
+                return
+
+            if item:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self.flush(batch)
+                batch = []
+
+    def flush(self, batch):
+        if not batch:
+            return
+
+        with self.context:
+            try:
+                self.write_batch(batch)
+            except BaseException as e:
+                self.db.session.rollback()
+                self.logger.error("Failed to write {} CoTs, retrying one at a time: {}".format(len(batch), e))
+
+                # Write what we can so one bad row doesn't lose the whole batch
+                for item in batch:
+                    try:
+                        self.write_batch([item])
+                    except BaseException:
+                        self.db.session.rollback()
+                        item.cot_id = item.point_id = None
+                        self.failed += 1
+                        self.logger.error(traceback.format_exc())
+
+            try:
+                self.emit(batch)
+            except BaseException:
+                self.logger.error(traceback.format_exc())
+
+        for item in batch:
+            if item.callback and item.cot_id:
+                try:
+                    item.callback(item.cot_id, item.point_id)
+                except BaseException:
+                    self.logger.error(traceback.format_exc())
+
+    def write_batch(self, batch):
+        for item, cot_id in zip(batch, self.insert(CoT, [item.cot for item in batch])):
+            item.cot_id = cot_id
+
+        # Points reference their CoT and markers reference both, so each table is written after the one it points to
+        points = [item for item in batch if item.point]
+        for item in points:
+            item.point['cot_id'] = item.cot_id
+
+        for item, point_id in zip(points, self.insert(Point, [item.point for item in points])):
+            item.point_id = point_id
+
+        self.update_last_points(points)
+
+        # A marker that was updated more than once in this batch only needs its latest version written
+        markers = {}
+        for item in batch:
+            if item.marker:
+                item.marker['cot_id'] = item.cot_id
+                item.marker['point_id'] = item.point_id
+                markers[item.marker['uid']] = item.marker
+
+        if markers:
+            existing = dict(self.db.session.execute(select(Marker.uid, Marker.id)
+                                                    .where(Marker.uid.in_(markers.keys()))).all())
+
+            updates = [dict(marker, id=existing[uid]) for uid, marker in markers.items() if uid in existing]
+            if updates:
+                self.db.session.execute(update(Marker), updates)
+
+            inserts = [marker for uid, marker in markers.items() if uid not in existing]
+            if inserts:
+                self.db.session.execute(insert(Marker), inserts)
+
+        self.db.session.commit()
+        self.written += len(batch)
+        self.batches += 1
+
+    # Only an EUD's own position updates count, not the markers it sends
+    def update_last_points(self, points):
+        last_points = {}
+        for item in points:
+            device_uid = item.point['device_uid']
+            if device_uid and item.point['uid'] == device_uid:
+                last_point = last_points.get(device_uid)
+                if not last_point or item.point['timestamp'] >= last_point['timestamp']:
+                    last_points[device_uid] = {'device_uid': device_uid, 'point_id': item.point_id,
+                                               'timestamp': item.point['timestamp']}
+
+        if not last_points:
+            return
+
+        existing = dict(self.db.session.execute(select(LastPoint.device_uid, LastPoint.timestamp)
+                                                .where(LastPoint.device_uid.in_(last_points.keys()))).all())
+
+        # Points can arrive out of order, i.e. when an EUD reconnects and sends what it buffered while offline
+        updates = [last_point for device_uid, last_point in last_points.items()
+                   if device_uid in existing and last_point['timestamp'] >= existing[device_uid]]
+        if updates:
+            self.db.session.execute(update(LastPoint), updates)
+
+        inserts = [last_point for device_uid, last_point in last_points.items() if device_uid not in existing]
+        if inserts:
+            self.db.session.execute(insert(LastPoint), inserts)
+
+    def emit(self, batch):
+        # This CoT is a position update for an EUD, send it to socketio clients, so it can be seen on the UI map
+        point_ids = [item.point_id for item in batch if item.emit_point and item.point_id]
+        if point_ids:
+            for point in self.db.session.scalars(select(Point).where(Point.id.in_(point_ids))):
+                self.green.call(socketio.emit, 'point', point.to_json(), namespace='/socket.io')
+
+        marker_uids = {item.marker['uid'] for item in batch if item.marker and item.cot_id}
+        if marker_uids:
+            for marker in self.db.session.scalars(select(Marker).where(Marker.uid.in_(marker_uids))):
+                self.green.call(socketio.emit, 'marker', marker.to_json(), namespace='/socket.io')
+
+    def insert(self, model, rows):
+        if not rows:
+            return []
+
+        if self.db.engine.dialect.insert_executemany_returning_sort_by_parameter_order:
+            return self.db.session.scalars(insert(model).returning(model.id, sort_by_parameter_order=True), rows).all()
+
+        # Databases without INSERT..RETURNING get one statement per row, but still one transaction per batch
+        return [self.db.session.execute(insert(model).values(**row)).inserted_primary_key[0] for row in rows]
@@ -0,0 +1,59 @@
+from collections import deque
+
+
+# A bounded queue of messages waiting to be written to a streaming client. Messages can have a key, i.e. the uid of
+# the EUD or marker whose position they carry. When the queue is full a keyed message replaces the newest queued
+# message with the same key instead of being dropped, so a slow client still gets the latest position of everything
+class OutboundQueue:
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        # [key, data] lists so a queued message can be replaced in place
+        self.entries = deque()
+        self.keys = {}
+        # What's left of a message that was partially sent
+        self.partial = None
+
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.entries) + (self.partial is not None)
+
+    # Returns False if the message was dropped
+    def put(self, data, key=None):
+        if len(self.entries) >= self.max_size:
+            entry = self.keys.get(key) if key else None
+            if entry:
+                entry[1] = data
+                self.coalesced += 1
+                return True
+
+            self.dropped += 1
+            return False
+
+        entry = [key, data]
+        self.entries.append(entry)
+        if key:
+            self.keys[key] = entry
+        return True
+
+    # The bytes that should be sent next, or None when the queue is empty. Keeps returning the rest of the same
+    # message until all of it has been sent, which is sendall() without blocking
+    def next(self):
+        if self.partial is None and self.entries:
+            entry = self.entries.popleft()
+            if entry[0] and self.keys.get(entry[0]) is entry:
+                del self.keys[entry[0]]
+            self.partial = memoryview(entry[1])
+        return self.partial
+
+    def sent(self, count):
+        if count >= len(self.partial):
+            self.partial = None
+        else:
+            self.partial = self.partial[count:]
+
+    def clear(self):
+        self.entries.clear()
+        self.keys.clear()
+        self.partial = None
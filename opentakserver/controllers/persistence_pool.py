@@ -0,0 +1,65 @@
+import traceback
+import zlib
+
+from opentakserver.unpatched import queue, threading
+
+
+class PersistenceWorker(threading.Thread):
+    def __init__(self, pool, number):
+        super().__init__()
+        self.daemon = True
+        self.pool = pool
+        self.number = number
+        self.queue = queue.Queue()
+        self.completed = 0
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+
+            function, args, done = task
+            try:
+                function(*args)
+            except BaseException:
+                self.pool.logger.error(traceback.format_exc())
+
+            self.completed += 1
+            if done:
+                try:
+                    done()
+                except BaseException:
+                    self.pool.logger.error(traceback.format_exc())
+
+
+# Runs DB work for the CoT controller off of the RabbitMQ ioloop. Tasks with the same key always run on the same
+# worker so each EUD's CoTs are saved in the order they were received. The workers are real OS threads, see
+# unpatched.py, so a slow sqlite call doesn't hold up the ioloop or the green threads serving sockets.
+# submit() never blocks. The CoT controller limits how much work is queued with RabbitMQ's prefetch count instead
+class PersistencePool:
+    def __init__(self, logger, workers=2):
+        self.logger = logger
+        self.workers = [PersistenceWorker(self, i) for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    # done is called on the worker's thread after function returns, even if it raised
+    def submit(self, key, function, *args, done=None):
+        worker = self.workers[zlib.crc32(str(key).encode('utf-8')) % len(self.workers)]
+        worker.queue.put_nowait((function, args, done))
+
+    def stop(self):
+        for worker in self.workers:
+            worker.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    @property
+    def depth(self):
+        return sum(worker.queue.qsize() for worker in self.workers)
+
+    def stats(self):
+        return {'workers': len(self.workers), 'depth': self.depth,
+                'completed': sum(worker.completed for worker in self.workers),
+                'depth_per_worker': [worker.queue.qsize() for worker in self.workers]}
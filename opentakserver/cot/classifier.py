@@ -0,0 +1,74 @@
+from collections import namedtuple
+from functools import lru_cache
+
+AFFILIATIONS = {'f': 'friendly', 'h': 'hostile', 'u': 'unknown', 'p': 'pending', 'a': 'assumed', 'n': 'neutral',
+                's': 'suspect', 'j': 'joker', 'k': 'faker'}
+
+TASKINGS = {'t-x-f': 'remarks', 't-x-s': 'state/sync', 't-s': 'required', 't-z': 'cancel', 't-x-c-c': 'commcheck',
+            't-x-c-g-d': 'dgps', 't-k-d': 'destroy', 't-k-i': 'investigate', 't-k-t': 'target', 't-k': 'strike',
+            't-': 'tasking'}
+
+BATTLE_DIMENSIONS = {'A': 'airborne', 'G': 'ground', 'S': 'surface/sea', 'U': 'subsurface'}
+
+# Keyed on what follows a-<affiliation>-
+TYPES = {'G-I': 'installation', 'G-E-V': 'vehicle', 'G-E': 'equipment', 'A-W-M-S': 'sam', 'A-M-F-Q-r': 'uav'}
+
+MARKER_AFFILIATIONS = frozenset('fhupansjk')
+MARKER_DIMENSIONS = frozenset('ZPAGSUF')
+
+CoTType = namedtuple('CoTType', ['affiliation', 'battle_dimension', 'type', 'is_marker', 'is_rb_line',
+                                 'mil_std_2525c'])
+
+
+# Only the prefix lengths that exist in each table are tried, longest first
+def prefix_lookup(table):
+    lengths = sorted({len(key) for key in table}, reverse=True)
+
+    def lookup(value):
+        for length in lengths:
+            result = table.get(value[:length])
+            if result:
+                return result
+        return None
+
+    return lookup
+
+
+get_tasking = prefix_lookup(TASKINGS)
+get_type = prefix_lookup(TYPES)
+
+
+def mil_std_2525c(cot_type):
+    cot_type_list = cot_type.split("-")
+    cot_type_list.pop(0)  # this should always be letter a
+    code = "s" + cot_type_list.pop(0) + cot_type_list.pop(0) + "-"
+
+    for letter in cot_type_list:
+        if letter.isupper():
+            code += letter.lower()
+
+    return code.ljust(10, "-")
+
+
+# Every classification the CoT controller needs from a type string in one lookup. CoT types repeat constantly, so
+# results are cached
+@lru_cache(maxsize=4096)
+def classify(cot_type):
+    affiliation = None
+    battle_dimension = None
+    type = None
+
+    # Atoms, a-<affiliation>-<battle dimension>-...
+    atom = cot_type[:2] == 'a-' and cot_type[3:4] == '-' and cot_type[2] != '\n'
+    if atom:
+        affiliation = AFFILIATIONS.get(cot_type[2])
+        battle_dimension = BATTLE_DIMENSIONS.get(cot_type[4:5])
+        type = get_type(cot_type[4:])
+    elif cot_type[:2] == 't-':
+        affiliation = get_tasking(cot_type)
+
+    is_marker = ((atom and cot_type[2] in MARKER_AFFILIATIONS and cot_type[4:5] in MARKER_DIMENSIONS) or
+                 cot_type.startswith('b-m-p'))
+
+    return CoTType(affiliation, battle_dimension, type, is_marker, cot_type.startswith('u-rb'),
+                   mil_std_2525c(cot_type) if is_marker else None)
@@ -0,0 +1,63 @@
+import re
+from xml.etree.ElementTree import ParseError, fromstring
+
+from google.protobuf.message import DecodeError
+
+from opentakserver.cot.event import CoTEvent
+from opentakserver.cot.protobuf import MESH_HEADER, decode_event
+
+UTF8 = re.compile(rb'encoding\s*=\s*["\']utf-?8["\']', re.IGNORECASE)
+# What ATAK puts in front of every event
+ATAK_DECLARATION = b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+
+
+# The datagram without its XML declaration if it's exactly one <event> element that can safely be parsed together
+# with others, otherwise None. Anything unusual is left to be parsed on its own
+def batchable(datagram):
+    body = datagram
+    if datagram.startswith(ATAK_DECLARATION):
+        body = datagram[len(ATAK_DECLARATION):]
+    elif datagram.startswith(b'<?xml'):
+        end = datagram.find(b'?>')
+        if end < 0 or (b'encoding' in datagram[:end] and not UTF8.search(datagram, 0, end)):
+            return None
+        body = datagram[end + 2:].lstrip()
+
+    if body.startswith(b'<event') and body.endswith(b'</event>') and body.find(b'</event') == len(body) - 8:
+        return body
+    return None
+
+
+def parse(datagram):
+    try:
+        if datagram.startswith(MESH_HEADER):
+            return decode_event(datagram[len(MESH_HEADER):])
+        return CoTEvent.from_xml(datagram)
+    except (DecodeError, ParseError):
+        return None
+
+
+# Returns a CoTEvent, or None if it's malformed, for each datagram. Each datagram on its own costs a new XML parser,
+# which takes as long as parsing a small event, so datagrams that are a single <event> are parsed as one document.
+# If that fails or the events don't line up with the datagrams, each one is parsed on its own to find the bad ones.
+# TAK protocol mesh datagrams are always parsed on their own
+def parse_datagrams(datagrams):
+    datagrams = [datagram if datagram.startswith(MESH_HEADER) else datagram.strip() for datagram in datagrams]
+    bodies = [batchable(datagram) for datagram in datagrams]
+    batch = [i for i, body in enumerate(bodies) if body is not None]
+
+    events = [None] * len(datagrams)
+    if len(batch) > 1:
+        try:
+            root = fromstring(b'<batch>' + b''.join(bodies[i] for i in batch) + b'</batch>')
+            if len(root) == len(batch) and not root.text and all(child.tag == 'event' and not child.tail
+                                                                  for child in root):
+                for i, element in zip(batch, root):
+                    events[i] = CoTEvent(element, datagrams[i])
+        except ParseError:
+            pass
+
+    for i, datagram in enumerate(datagrams):
+        if events[i] is None:
+            events[i] = parse(datagram)
+    return events
@@ -0,0 +1,135 @@
+import json
+from xml.etree.ElementTree import Element, SubElement
+
+import msgpack
+import pika
+
+from opentakserver.cot.event import CoTEvent
+
+CONTENT_TYPE = 'application/x-msgpack'
+PROPERTIES = pika.BasicProperties(content_type=CONTENT_TYPE)
+# A msgpack list of packed envelopes, for edges that receive CoTs in bursts
+BATCH_CONTENT_TYPE = 'application/x-msgpack-batch'
+# CoTs received by the UDP server. Their senders aren't connected to a streaming port, so they have no queue to deliver to
+UDP_APP_ID = 'udp'
+UDP_PROPERTIES = pika.BasicProperties(content_type=BATCH_CONTENT_TYPE, app_id=UDP_APP_ID)
+VERSION = 1
+
+POINT_ATTRIBUTES = ('lat', 'lon', 'hae', 'ce', 'le')
+
+
+# Elements are shipped as [tag, attributes, text, tail, children] so the receiving end can rebuild the
+# tree without parsing XML
+def element_to_tree(element):
+    # Most elements in a CoT are leaves, skipping the list comprehension for them saves a good part of the time
+    return [element.tag, dict(element.attrib), element.text, element.tail,
+            [element_to_tree(c) for c in element] if len(element) else []]
+
+
+def tree_to_element(parent, tree):
+    tag, attrs, text, tail, children = tree
+    element = SubElement(parent, tag, attrs)
+    element.text = text
+    element.tail = tail
+    for child in children:
+        tree_to_element(element, child)
+    return element
+
+
+def point_to_list(point):
+    if point is None:
+        return None
+    try:
+        return [float(point.attrib[attr]) if attr in point.attrib else None for attr in POINT_ATTRIBUTES]
+    except ValueError:
+        return None
+
+
+# The message format of the cot_controller, cot, dms, and chatrooms exchanges. The edge parses the CoT once and ships
+# the routing and persistence fields alongside the original XML bytes. With the TAK protocol enabled it also carries the
+# event as a TAK protocol stream message, so clients that speak protobuf get it without translating once per client
+class CoTEnvelope:
+    __slots__ = ('uid', 'event_uid', 'type', 'how', 'time', 'start', 'stale', 'point', 'attrs', 'children', 'xml',
+                 'proto', '_event', '_body')
+
+    def __init__(self, uid, event_uid, type, how, time, start, stale, point, attrs, children, xml, proto=None):
+        self.uid = uid
+        self.event_uid = event_uid
+        self.type = type
+        self.how = how
+        self.time = time
+        self.start = start
+        self.stale = stale
+        self.point = point
+        self.attrs = attrs
+        self.children = children
+        self.xml = xml
+        self.proto = proto
+        self._event = None
+        self._body = None
+
+    @classmethod
+    def from_event(cls, uid, event, proto=None):
+        attrs = dict(event.attrs)
+        point = event.element.find('point')
+        envelope = cls(uid, attrs.pop('uid', None), attrs.pop('type', None), attrs.pop('how', None),
+                       attrs.pop('time', None), attrs.pop('start', None), attrs.pop('stale', None),
+                       point_to_list(point), attrs,
+                       [element_to_tree(child) for child in event.element], event.xml, proto)
+        envelope._event = event
+        return envelope
+
+    @classmethod
+    def from_xml(cls, uid, xml):
+        return cls.from_event(uid, CoTEvent.from_xml(xml))
+
+    # Accepts both this format and the JSON {'uid': ..., 'cot': ...} messages sent by older versions
+    @classmethod
+    def unpack(cls, body, content_type=None):
+        if content_type == CONTENT_TYPE or (content_type is None and body[:1] != b'{'):
+            message = msgpack.unpackb(body, raw=False)
+            if message.get('v') != VERSION:
+                raise ValueError("Unsupported CoT envelope version: {}".format(message.get('v')))
+
+            envelope = cls(message['uid'], message['event_uid'], message['type'], message['how'], message['time'],
+                           message['start'], message['stale'], message['point'], message['attrs'],
+                           message['children'], message['xml'], message.get('proto'))
+            envelope._body = body
+            return envelope
+
+        message = json.loads(body)
+        return cls.from_xml(message['uid'], message['cot'])
+
+    def pack(self):
+        if self._body is None:
+            self._body = msgpack.packb({
+                'v': VERSION, 'uid': self.uid, 'event_uid': self.event_uid, 'type': self.type, 'how': self.how,
+                'time': self.time, 'start': self.start, 'stale': self.stale, 'point': self.point, 'attrs': self.attrs,
+                'children': self.children, 'xml': self.xml, 'proto': self.proto
+            }, use_bin_type=True)
+        return self._body
+
+    # Rebuilds the event from the shipped tree instead of parsing the XML again
+    @property
+    def event(self):
+        if self._event is None:
+            attrs = dict(self.attrs)
+            for key in ('uid', 'type', 'how', 'time', 'start', 'stale'):
+                value = getattr(self, 'event_uid' if key == 'uid' else key)
+                if value is not None:
+                    attrs[key] = value
+
+            element = Element('event', attrs)
+            for child in self.children:
+                tree_to_element(element, child)
+
+            self._event = CoTEvent(element, self.xml)
+        return self._event
+
+
+def pack_batch(envelopes):
+    return msgpack.packb([envelope.pack() for envelope in envelopes], use_bin_type=True)
+
+
+def unpack_batch(body):
+    return [CoTEnvelope.unpack(message, CONTENT_TYPE) for message in msgpack.unpackb(body, raw=False)]
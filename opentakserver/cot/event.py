@@ -0,0 +1,61 @@
+from xml.etree.ElementTree import fromstring
+
+
+# A thin wrapper around an ElementTree element that offers the parts of BeautifulSoup's Tag API that the controllers
+# use, i.e. find(), find_all(), attrs, name, text and iterating over child tags
+class CoTElement:
+    __slots__ = ('element',)
+
+    def __init__(self, element):
+        self.element = element
+
+    # Unlike ElementTree elements, which are falsy when they have no children, a found tag is always truthy
+    def __bool__(self):
+        return True
+
+    def __iter__(self):
+        for child in self.element:
+            yield CoTElement(child)
+
+    def __repr__(self):
+        return "<{} {}>".format(self.name, self.attrs)
+
+    @property
+    def name(self):
+        return self.element.tag
+
+    @property
+    def attrs(self):
+        return self.element.attrib
+
+    @property
+    def text(self):
+        return ''.join(self.element.itertext())
+
+    # Searches all descendants like BeautifulSoup does, not just direct children
+    def find(self, name):
+        for element in self.element.iter(name):
+            if element is not self.element:
+                return CoTElement(element)
+        return None
+
+    def find_all(self, name):
+        return [CoTElement(element) for element in self.element.iter(name) if element is not self.element]
+
+
+class CoTEvent(CoTElement):
+    __slots__ = ('xml',)
+
+    def __init__(self, element, xml):
+        super().__init__(element)
+        self.xml = xml
+
+    # Raises xml.etree.ElementTree.ParseError if the XML isn't well-formed
+    @classmethod
+    def from_xml(cls, xml):
+        if isinstance(xml, str):
+            xml = xml.encode('utf-8')
+        return cls(fromstring(xml), xml)
+
+    def __str__(self):
+        return self.xml.decode('utf-8')
@@ -0,0 +1,110 @@
+import re
+
+# CoT streams are a sequence of root elements, either <event> or ATAK's <auth> message, with no delimiter between them
+END_TAG = re.compile(rb'</(?:event|auth)\s*>')
+# How far back from the end of the buffer a partially received end tag can start
+END_TAG_MARGIN = 64
+
+
+class CoTFramer:
+    def __init__(self, max_size=1048576):
+        self.buffer = bytearray()
+        self.scan_from = 0
+        self.max_size = max_size
+
+    def __len__(self):
+        return len(self.buffer)
+
+    # Returns every complete root element in the stream so far, each one exactly once
+    def feed(self, data):
+        return list(self.split(data))
+
+    # Yields the complete root elements one at a time. Whatever hasn't been yielded when the caller stops stays in the
+    # buffer, so a client that switches protocols partway through can hand the rest to another framer with take()
+    def split(self, data):
+        self.buffer += data
+
+        while True:
+            match = END_TAG.search(self.buffer, self.scan_from)
+            if not match:
+                # Only the tail of the buffer could still hold the start of an end tag
+                self.scan_from = max(0, len(self.buffer) - END_TAG_MARGIN)
+                break
+
+            frame = bytes(self.buffer[:match.end()]).strip()
+            del self.buffer[:match.end()]
+            self.scan_from = 0
+
+            if frame:
+                yield frame
+
+        if len(self.buffer) > self.max_size:
+            size = len(self.buffer)
+            self.reset()
+            raise ValueError("CoT message exceeds {} bytes ({} buffered)".format(self.max_size, size))
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.reset()
+        return data
+
+    def reset(self):
+        self.buffer = bytearray()
+        self.scan_from = 0
+
+
+# Splits a TAK Protocol Version 1 stream, where every message is 0xbf followed by the length of the payload as a
+# varint, back into payloads
+class ProtobufFramer:
+    def __init__(self, max_size=1048576):
+        self.buffer = bytearray()
+        self.max_size = max_size
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        start = 0
+
+        while start < len(self.buffer):
+            if self.buffer[start] != 0xbf:
+                self.reset()
+                raise ValueError("Not a TAK protocol message")
+
+            length = 0
+            shift = 0
+            end = start + 1
+            while end < len(self.buffer):
+                byte = self.buffer[end]
+                length |= (byte & 0x7f) << shift
+                shift += 7
+                end += 1
+                if not byte & 0x80:
+                    break
+                if shift > 35:
+                    self.reset()
+                    raise ValueError("Malformed TAK protocol message length")
+            else:
+                # The length isn't all here yet
+                break
+
+            if length > self.max_size:
+                self.reset()
+                raise ValueError("TAK protocol message of {} bytes exceeds {} bytes".format(length, self.max_size))
+            if end + length > len(self.buffer):
+                break
+
+            frames.append(bytes(self.buffer[end:end + length]))
+            start = end + length
+
+        del self.buffer[:start]
+        return frames
+
+    # Clients never switch away from protobuf, so unlike CoTFramer.split() every frame is split up front
+    def split(self, data):
+        return iter(self.feed(data))
+
+    def reset(self):
+        self.buffer = bytearray()
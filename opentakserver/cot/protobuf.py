@@ -0,0 +1,224 @@
+import re
+from datetime import datetime, timedelta, timezone
+from xml.etree.ElementTree import Element, SubElement, tostring
+
+from takproto.proto import TakMessage
+
+from opentakserver.cot.event import CoTEvent
+from opentakserver.functions import datetime_from_iso8601_string
+
+# TAK Protocol Version 1. On the streaming ports every message is 0xbf, the payload's length as a varint and a
+# serialized TakMessage. Mesh SA datagrams are 0xbf, the version, 0xbf and the TakMessage
+MAGIC = 0xbf
+MESH_HEADER = b'\xbf\x01\xbf'
+VERSION = 1
+
+EPOCH = datetime(1970, 1, 1)
+MILLISECOND = timedelta(milliseconds=1)
+
+# <detail> children that have a message of their own in Detail. Anything else, or one of these with attributes or
+# children the message can't hold, goes in xmlDetail as is
+STRING_DETAILS = {
+    'contact': ('contact', ('endpoint', 'callsign')),
+    '__group': ('group', ('name', 'role')),
+    'precisionlocation': ('precisionLocation', ('geopointsrc', 'altsrc')),
+    'takv': ('takv', ('device', 'platform', 'os', 'version')),
+}
+TRACK_ATTRIBUTES = {'speed', 'course'}
+ESCAPE = re.compile('[&<>"\n\r\t]')
+ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#09;'}
+
+
+def milliseconds(value):
+    if not value:
+        return 0
+    try:
+        # Much faster than strptime, but Python 3.10 only takes 3 or 6 digit fractions
+        moment = datetime.fromisoformat(value[:-1] if value.endswith('Z') else value)
+    except ValueError:
+        moment = datetime_from_iso8601_string(value)
+    if moment.tzinfo:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return (moment - EPOCH) // MILLISECOND
+
+
+def iso8601(milliseconds):
+    return (EPOCH + timedelta(milliseconds=milliseconds)).isoformat(timespec='milliseconds') + 'Z'
+
+
+def varint(value):
+    data = bytearray()
+    while value > 0x7f:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def stream_frame(payload):
+    return bytes((MAGIC,)) + varint(len(payload)) + payload
+
+
+# Fills in the Detail field the element belongs to, returns False if the element has to go in xmlDetail
+def add_detail(detail, element):
+    if len(element) or (element.text and element.text.strip()):
+        return False
+
+    attrs = element.attrib
+    if element.tag in STRING_DETAILS:
+        field, names = STRING_DETAILS[element.tag]
+        # Protobuf can't tell an empty string from a missing one
+        if detail.HasField(field) or not all(name in names and value for name, value in attrs.items()):
+            return False
+        message = getattr(detail, field)
+        message.SetInParent()
+        for name, value in attrs.items():
+            setattr(message, name, value)
+        return True
+
+    elif element.tag == 'status':
+        battery = attrs.get('battery')
+        if detail.HasField('status') or len(attrs) != 1 or not battery or not battery.isdigit():
+            return False
+        detail.status.battery = int(battery)
+        return True
+
+    elif element.tag == 'track':
+        if detail.HasField('track') or attrs.keys() != TRACK_ATTRIBUTES:
+            return False
+        try:
+            speed, course = float(attrs['speed']), float(attrs['course'])
+        except ValueError:
+            return False
+        detail.track.speed = speed
+        detail.track.course = course
+        return True
+
+    return False
+
+
+def escape(match):
+    return ESCAPES[match.group()]
+
+
+def attributes(attrs):
+    return ''.join(' {}="{}"'.format(name, ESCAPE.sub(escape, value)) for name, value in attrs)
+
+
+def element_to_xml(element):
+    if len(element) or element.text:
+        return tostring(element, encoding='unicode')
+    return '<{}{}/>'.format(element.tag, attributes(element.attrib.items()))
+
+
+# Raises ValueError if the event's times or point aren't valid
+def event_to_message(event):
+    message = TakMessage()
+    cot = message.cotEvent
+    attrs = event.attrs
+
+    for name in ('type', 'access', 'qos', 'opex', 'uid', 'how'):
+        value = attrs.get(name)
+        if value:
+            setattr(cot, name, value)
+
+    # ATAK usually sends the same time and start
+    cot.sendTime = milliseconds(attrs.get('time'))
+    cot.startTime = cot.sendTime if attrs.get('start') == attrs.get('time') else milliseconds(attrs.get('start'))
+    cot.staleTime = milliseconds(attrs.get('stale'))
+
+    point = event.element.find('point')
+    if point is not None:
+        point = point.attrib
+        cot.lat = float(point.get('lat', 0))
+        cot.lon = float(point.get('lon', 0))
+        cot.hae = float(point.get('hae', 0))
+        cot.ce = float(point.get('ce', 0))
+        cot.le = float(point.get('le', 0))
+
+    detail = event.element.find('detail')
+    if detail is not None:
+        cot.detail.SetInParent()
+        xml_detail = [element_to_xml(child) for child in detail if not add_detail(cot.detail, child)]
+        if xml_detail:
+            cot.detail.xmlDetail = ''.join(xml_detail)
+
+    return message
+
+
+# The event's XML, written out directly because ElementTree's serializer takes several times longer than parsing
+def message_to_xml(message):
+    cot = message.cotEvent
+    xml = ['<event version="2.0"{} time="{}" start="{}" stale="{}"{}>'.format(
+               attributes((('uid', cot.uid), ('type', cot.type))), iso8601(cot.sendTime), iso8601(cot.startTime),
+               iso8601(cot.staleTime), attributes((name, getattr(cot, name)) for name in ('how', 'access', 'qos', 'opex')
+                                                  if getattr(cot, name))),
+           '<point lat="{!r}" lon="{!r}" hae="{!r}" ce="{!r}" le="{!r}"/>'.format(cot.lat, cot.lon, cot.hae, cot.ce,
+                                                                                   cot.le)]
+
+    if cot.HasField('detail'):
+        detail = cot.detail
+        xml.append('<detail>')
+        xml.append(detail.xmlDetail)
+        for tag, (field, names) in STRING_DETAILS.items():
+            if detail.HasField(field):
+                message = getattr(detail, field)
+                xml.append('<{}{}/>'.format(tag, attributes((name, getattr(message, name)) for name in names
+                                                            if getattr(message, name))))
+        if detail.HasField('status'):
+            xml.append('<status battery="{}"/>'.format(detail.status.battery))
+        if detail.HasField('track'):
+            xml.append('<track speed="{!r}" course="{!r}"/>'.format(detail.track.speed, detail.track.course))
+        xml.append('</detail>')
+
+    xml.append('</event>')
+    return ''.join(xml).encode('utf-8')
+
+
+# Raises xml.etree.ElementTree.ParseError if xmlDetail isn't well-formed
+def message_to_event(message):
+    return CoTEvent.from_xml(message_to_xml(message))
+
+
+# Raises google.protobuf.message.DecodeError or xml.etree.ElementTree.ParseError if the payload is malformed
+def decode_event(payload):
+    return message_to_event(TakMessage.FromString(payload))
+
+
+# The event as a stream message, or None if it can't be represented in protobuf
+def encode_event(event):
+    try:
+        return stream_frame(event_to_message(event).SerializeToString())
+    except ValueError:
+        return None
+
+
+# The XML a streaming client gets before it switches, see t-x-takp-v, t-x-takp-q and t-x-takp-r in the TAK protocol
+# documentation
+def control_event(type, tag, attrs):
+    now = datetime.utcnow()
+    event = Element('event', {'version': '2.0', 'uid': 'protouid', 'type': type,
+                              'time': now.isoformat(timespec='milliseconds') + 'Z',
+                              'start': now.isoformat(timespec='milliseconds') + 'Z',
+                              'stale': (now + timedelta(minutes=1)).isoformat(timespec='milliseconds') + 'Z',
+                              'how': 'm-g'})
+    SubElement(event, 'point', {'lat': '0.0', 'lon': '0.0', 'hae': '0.0', 'ce': '999999', 'le': '999999'})
+    SubElement(SubElement(SubElement(event, 'detail'), 'TakControl'), tag, attrs)
+    return tostring(event)
+
+
+def version_advertisement():
+    return control_event('t-x-takp-v', 'TakProtocolSupport', {'version': str(VERSION)})
+
+
+def negotiation_response(accepted):
+    return control_event('t-x-takp-r', 'TakResponse', {'status': 'true' if accepted else 'false'})
+
+
+# The version a t-x-takp-q asks for, or None
+def requested_version(event):
+    request = event.find('TakRequest')
+    try:
+        return int(request.attrs['version']) if request else None
+    except (KeyError, ValueError):
+        return None
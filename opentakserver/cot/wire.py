@@ -0,0 +1,40 @@
+from opentakserver.cot.protobuf import encode_event
+from opentakserver.functions import datetime_from_iso8601_string
+
+
+# A CoT on its way to streaming clients. A broadcast reaches every client of a socket server as the same WireCoT, so
+# its bytes are made once, the first time a client needs them, and every client's outbound queue holds a view of the
+# same buffer instead of a copy
+class WireCoT:
+    __slots__ = ('envelope', 'key', '_xml', '_proto', '_start')
+
+    def __init__(self, envelope):
+        self.envelope = envelope
+        # Position updates can be coalesced if a client falls behind
+        self.key = envelope.event_uid if envelope.type and envelope.type.startswith('a-') else None
+        self._xml = None
+        self._proto = None
+        self._start = None
+
+    @property
+    def xml(self):
+        if self._xml is None:
+            self._xml = memoryview(self.envelope.xml)
+        return self._xml
+
+    # The TAK protocol stream message, or None if the CoT can't be sent as protobuf. It's usually translated where the
+    # CoT came in, translating it here is the fallback
+    @property
+    def proto(self):
+        if self._proto is None:
+            proto = self.envelope.proto
+            if proto is None:
+                proto = encode_event(self.envelope.event)
+            self._proto = memoryview(proto or b'')
+        return self._proto if len(self._proto) else None
+
+    @property
+    def start(self):
+        if self._start is None and self.envelope.start:
+            self._start = datetime_from_iso8601_string(self.envelope.start)
+        return self._start
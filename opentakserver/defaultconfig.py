@@ -22,8 +22,36 @@ class DefaultConfig:
     OTS_ENABLE_TCP_STREAMING_PORT = True
     OTS_TCP_STREAMING_PORT = 8088
     OTS_SSL_STREAMING_PORT = 8089
+    OTS_ENABLE_UDP_STREAMING_PORT = False  # Accept CoT datagrams. Like the TCP streaming port, UDP isn't authenticated
+    OTS_UDP_STREAMING_PORT = 8087
+    OTS_UDP_MULTICAST_GROUPS = []  # "address:port" of each group to receive CoT from, i.e. ATAK's mesh SA on "239.2.3.1:6969"
+    OTS_UDP_MULTICAST_INTERFACE = "0.0.0.0"  # Address of the interface to join the multicast groups on
+    OTS_UDP_BATCH_SIZE = 64  # Datagrams read with one system call and sent to RabbitMQ as one message
+    OTS_UDP_RECEIVE_BUFFER = 4194304  # In bytes, absorbs bursts of datagrams. Capped by net.core.rmem_max on Linux
+    OTS_MAX_COT_SIZE = 1048576  # In bytes, streaming clients that send a larger CoT are disconnected
+    OTS_ENABLE_TAK_PROTOCOL = True  # Lets streaming clients switch to TAK protocol version 1 (protobuf) instead of XML
+    OTS_ROSTER_DEDUP = True  # Don't send a newly connected EUD SA messages older than the ones in its roster
+    OTS_CLIENT_QUEUE_SIZE = 1000  # CoTs queued per streaming client. When full, new positions replace queued ones
+    OTS_CLIENT_QUEUE_HIGH_WATER = 800  # Clients with this many CoTs queued for OTS_CLIENT_SLOW_TIMEOUT are disconnected
+    OTS_CLIENT_SLOW_TIMEOUT = 30  # In seconds
+    OTS_SSL_HANDSHAKE_TIMEOUT = 10  # In seconds, SSL streaming clients that take longer to finish the handshake are dropped
+    OTS_SSL_MAX_HANDSHAKES = 100  # SSL handshakes in progress at once. More connections wait in the listen backlog
+    OTS_SSL_SESSION_TICKETS = 2  # TLS session tickets issued per connection so clients can resume. 0 disables resumption
+    OTS_STREAMING_WORKERS = 0  # Processes serving the TCP and SSL streaming ports with SO_REUSEPORT. 0 serves them in the main process
     OTS_BACKUP_COUNT = 7
     OTS_RABBITMQ_SERVER_ADDRESS = "127.0.0.1"
+    OTS_RABBITMQ_POOL_CONNECTIONS = 2  # RabbitMQ connections shared by all streaming clients
+    OTS_RABBITMQ_POOL_CHANNELS = 4  # Channels per pooled connection
+    OTS_RABBITMQ_POOL_MAX_PENDING = 10000  # Messages kept to publish once the first pool channel opens
+    OTS_COT_WRITER_BATCH_SIZE = 500  # CoTs written to the DB in one transaction
+    OTS_COT_WRITER_FLUSH_INTERVAL = 250  # In milliseconds, the longest a CoT is buffered before it's written to the DB
+    OTS_COT_WRITER_MAX_PENDING = 10000  # When this many CoTs are waiting to be written, new ones wait for the DB
+    OTS_PERSISTENCE_WORKERS = 2  # Threads that save CoTs to the DB after they've been routed
+    OTS_PERSISTENCE_MAX_PENDING = 10000  # RabbitMQ messages not yet saved. Past this the broker holds new ones back
+    OTS_ARCHIVE_FOLDER = os.path.join(OTS_DATA_FOLDER, "archive")  # One SQLite file of CoTs and points per day
+    OTS_ARCHIVE_AFTER_DAYS = 7  # CoTs older than this are moved from the database to the archive by the Archive CoTs job
+    OTS_ARCHIVE_RETENTION_DAYS = 90  # Days of archive to keep. 0 keeps it forever
+    OTS_ARCHIVE_BATCH_SIZE = 5000  # CoTs moved per transaction
     OTS_MEDIAMTX_ENABLE = True
     OTS_MEDIAMTX_API_ADDRESS = "http://localhost:9997"
     OTS_MEDIAMTX_TOKEN = str(secrets.SystemRandom().getrandbits(128))
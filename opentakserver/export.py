@@ -0,0 +1,195 @@
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+import yaml
+from sqlalchemy import Boolean, DateTime, Float, Integer, JSON, create_engine, exists, select
+
+from opentakserver import geohash
+from opentakserver.archive import CoTArchive
+from opentakserver.defaultconfig import DefaultConfig
+from opentakserver.functions import datetime_from_iso8601_string
+from opentakserver.models.CoT import CoT
+from opentakserver.models.Marker import Marker
+from opentakserver.models.Point import Point
+
+# Exports CoTs, points and markers to Parquet or Arrow IPC one chunk of rows at a time, so memory use depends on the
+# chunk size and not on how much data is exported. pyarrow is only needed when exporting
+FORMATS = {'parquet': 'application/vnd.apache.parquet', 'arrow': 'application/vnd.apache.arrow.stream'}
+TABLES = {'cot': CoT.__table__, 'points': Point.__table__, 'markers': Marker.__table__}
+
+
+def arrow_type(pa, column_type):
+    if isinstance(column_type, Integer):
+        return pa.int64()
+    elif isinstance(column_type, Float):
+        return pa.float64()
+    elif isinstance(column_type, Boolean):
+        return pa.bool_()
+    elif isinstance(column_type, DateTime):
+        return pa.timestamp('us')
+    return pa.string()
+
+
+def schema(pa, table):
+    return pa.schema([(column.name, arrow_type(pa, column.type)) for column in table.columns])
+
+
+# cot and points can be given the archive's copies of those tables
+def query(table, start=None, end=None, sender_uid=None, type_prefix=None, bbox=None, cot=CoT.__table__,
+          points=Point.__table__):
+    statement = select(table)
+
+    if table.name == 'markers':
+        # Markers are filtered by the CoT and point they were last updated by
+        statement = statement.join(cot, cot.c.id == table.c.cot_id)
+        if bbox:
+            statement = statement.join(points, points.c.id == table.c.point_id)
+    elif table.name == 'points' and (type_prefix or sender_uid):
+        statement = statement.join(cot, cot.c.id == table.c.cot_id)
+
+    if start:
+        statement = statement.where((table.c.timestamp if table.name == 'points' else cot.c.timestamp) >= start)
+    if end:
+        statement = statement.where((table.c.timestamp if table.name == 'points' else cot.c.timestamp) < end)
+    if sender_uid:
+        statement = statement.where(cot.c.sender_uid == sender_uid)
+    if type_prefix:
+        statement = statement.where(cot.c.type.startswith(type_prefix, autoescape=True))
+    if bbox:
+        if table.name == 'cot':
+            statement = statement.where(exists().where(points.c.cot_id == cot.c.id,
+                                                       geohash.bbox_filter(points.c, *bbox)))
+        else:
+            statement = statement.where(geohash.bbox_filter(points.c, *bbox))
+
+    return statement.order_by(table.c.id)
+
+
+def record_batch(pa, arrow_schema, table, rows):
+    columns = list(zip(*rows))
+    arrays = []
+    for i, column in enumerate(table.columns):
+        values = columns[i]
+        if isinstance(column.type, JSON):
+            values = [json.dumps(value) if value is not None else None for value in values]
+        arrays.append(pa.array(values, type=arrow_schema.field(i).type))
+    return pa.record_batch(arrays, schema=arrow_schema)
+
+
+# Collects what pyarrow writes so it can be handed out as it's produced
+class Chunks:
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+# Yields the exported file in pieces. sources are (engine, cot table, points table) so archived days can be included
+def export(sources, table_name, export_format='parquet', chunk_size=50000, **filters):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = TABLES[table_name]
+    arrow_schema = schema(pa, table)
+    sink = Chunks()
+    output = pa.PythonFile(sink, mode='w')
+    if export_format == 'parquet':
+        writer = pq.ParquetWriter(output, arrow_schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_stream(output, arrow_schema)
+
+    for engine, cot, points in sources:
+        source_table = {'cot': cot, 'points': points}.get(table_name, table)
+        with engine.connect() as connection:
+            result = connection.execution_options(yield_per=chunk_size).execute(
+                query(source_table, cot=cot, points=points, **filters))
+            for rows in result.partitions():
+                writer.write_batch(record_batch(pa, arrow_schema, table, rows))
+                data = sink.drain()
+                if data:
+                    yield data
+
+    writer.close()
+    yield sink.drain()
+
+
+# The live database plus the archived days between start and end. Markers are never archived
+def sources(engine, archive_folder, table_name, start=None, end=None):
+    sources = [(engine, CoT.__table__, Point.__table__)]
+    if table_name == 'markers' or not archive_folder:
+        return sources
+
+    archive = CoTArchive(archive_folder, None)
+    for day, path in archive.partitions():
+        if (start and day < start.date()) or (end and day > end.date()):
+            continue
+        partition = create_engine("sqlite:///{}".format(path))
+        sources.insert(-1, (partition, archive.tables['cot'], archive.tables['points']))
+    return sources
+
+
+def parse_bbox(bbox):
+    west, south, east, north = [float(value) for value in bbox.split(',')]
+    if not (-180 <= west <= 180 and -180 <= east <= 180 and -90 <= south <= north <= 90):
+        raise ValueError("Invalid bbox: {}".format(bbox))
+    return west, south, east, north
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export CoTs, points or markers to Parquet or Arrow IPC")
+    parser.add_argument("table", choices=TABLES.keys())
+    parser.add_argument("output", help="File to write, - for stdout")
+    parser.add_argument("--format", choices=FORMATS.keys(), default="parquet")
+    parser.add_argument("--start", help="ISO8601 time, i.e. 2024-04-24T00:00:00Z")
+    parser.add_argument("--end", help="ISO8601 time")
+    parser.add_argument("--sender-uid")
+    parser.add_argument("--type", help="CoT type prefix, i.e. a-f")
+    parser.add_argument("--bbox", help="west,south,east,north")
+    parser.add_argument("--chunk-size", type=int, default=50000)
+    parser.add_argument("--database", help="SQLAlchemy database URI, defaults to the one in config.yml")
+    parser.add_argument("--no-archive", action="store_true", help="Don't include archived days")
+    args = parser.parse_args()
+
+    config = {key: getattr(DefaultConfig, key) for key in dir(DefaultConfig) if key.isupper()}
+    config_file = os.path.join(config['OTS_DATA_FOLDER'], "config.yml")
+    if os.path.exists(config_file):
+        with open(config_file) as f:
+            config.update(yaml.safe_load(f) or {})
+
+    start = datetime_from_iso8601_string(args.start) if args.start else None
+    end = datetime_from_iso8601_string(args.end) if args.end else None
+    engine = create_engine(args.database or config['SQLALCHEMY_DATABASE_URI'])
+
+    output = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    written = 0
+    started = datetime.now()
+    for data in export(sources(engine, None if args.no_archive else config.get('OTS_ARCHIVE_FOLDER'), args.table,
+                               start, end),
+                       args.table, args.format, args.chunk_size, start=start, end=end, sender_uid=args.sender_uid,
+                       type_prefix=args.type, bbox=parse_bbox(args.bbox) if args.bbox else None):
+        output.write(data)
+        written += len(data)
+    output.close()
+
+    print("Wrote {} bytes in {}".format(written, datetime.now() - started), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,16 @@
+import logging
+import os
+import sys
+from logging.handlers import TimedRotatingFileHandler
+
 import colorlog
 from flask_sqlalchemy import SQLAlchemy
 from flask_socketio import SocketIO
 from opentakserver.models.Base import Base
 from flask_mailman import Mail
 from flask_apscheduler import APScheduler
+from opentakserver.presence import PresenceRegistry
+from opentakserver.rabbitmq_pool import RabbitMQPool
 
 logger = colorlog.getLogger('OpenTAKServer')
 
@@ -14,3 +21,28 @@ apscheduler = APScheduler()
 db = SQLAlchemy(model_class=Base)
 
 socketio = SocketIO(async_mode='eventlet')
+
+rabbitmq_pool = RabbitMQPool()
+
+presence = PresenceRegistry()
+
+
+def setup_logging(app, log_file='opentakserver.log'):
+    level = logging.INFO
+    if app.config.get("DEBUG"):
+        level = logging.DEBUG
+
+    if sys.stdout.isatty():
+        color_log_handler = colorlog.StreamHandler()
+        color_log_formatter = colorlog.ColoredFormatter(
+            '%(log_color)s[%(asctime)s] - OpenTAKServer[%(process)d] - %(module)s - %(levelname)s - %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
+        color_log_handler.setFormatter(color_log_formatter)
+        logger.setLevel(level)
+        logger.addHandler(color_log_handler)
+        logger.info("Added color logger")
+
+    os.makedirs(os.path.join(app.config.get("OTS_DATA_FOLDER"), "logs"), exist_ok=True)
+    fh = TimedRotatingFileHandler(os.path.join(app.config.get("OTS_DATA_FOLDER"), 'logs', log_file), when='midnight', backupCount=app.config.get("OTS_BACKUP_COUNT"))
+    fh.setLevel(level)
+    fh.setFormatter(logging.Formatter("[%(asctime)s] - OpenTAKServer[%(process)d] - %(module)s - %(levelname)s - %(message)s"))
+    logger.addHandler(fh)
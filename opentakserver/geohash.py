@@ -0,0 +1,110 @@
+import math
+
+from sqlalchemy import and_, or_
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+PRECISION = 12
+METERS_PER_DEGREE = 111320
+
+# The base32 alphabet is in ASCII order, so a geohash cell and everything inside it is a contiguous range of strings
+# and bounding box queries become a handful of range scans on the geohash column's B-tree index
+
+
+def cell_bits(precision):
+    bits = precision * 5
+    return (bits + 1) // 2, bits // 2
+
+
+def interleave(lon_index, lat_index, precision):
+    lon_bits, lat_bits = cell_bits(precision)
+    value = 0
+    for i in range(precision * 5):
+        if i % 2 == 0:
+            lon_bits -= 1
+            value = (value << 1) | ((lon_index >> lon_bits) & 1)
+        else:
+            lat_bits -= 1
+            value = (value << 1) | ((lat_index >> lat_bits) & 1)
+    return value
+
+
+def to_string(value, precision):
+    chars = []
+    for i in range(precision):
+        chars.append(BASE32[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+
+def cell_index(degrees, minimum, span, bits):
+    return min(max(int((degrees - minimum) / span * (1 << bits)), 0), (1 << bits) - 1)
+
+
+def encode(latitude, longitude, precision=PRECISION):
+    lon_bits, lat_bits = cell_bits(precision)
+    return to_string(interleave(cell_index(longitude, -180, 360, lon_bits),
+                                cell_index(latitude, -90, 180, lat_bits), precision), precision)
+
+
+# Returns (low, high) string ranges at the finest precision that covers the box in no more than max_cells cells
+def cover(west, south, east, north, max_cells=64):
+    if west > east:
+        # The box crosses the antimeridian
+        return cover(west, south, 180, north, max_cells // 2) + cover(-180, south, east, north, max_cells // 2)
+
+    precision = PRECISION
+    while precision > 1:
+        lon_bits, lat_bits = cell_bits(precision)
+        lon_cells = cell_index(east, -180, 360, lon_bits) - cell_index(west, -180, 360, lon_bits) + 1
+        lat_cells = cell_index(north, -90, 180, lat_bits) - cell_index(south, -90, 180, lat_bits) + 1
+        if lon_cells * lat_cells <= max_cells:
+            break
+        precision -= 1
+
+    lon_bits, lat_bits = cell_bits(precision)
+    cells = sorted(interleave(lon_index, lat_index, precision)
+                   for lon_index in range(cell_index(west, -180, 360, lon_bits), cell_index(east, -180, 360, lon_bits) + 1)
+                   for lat_index in range(cell_index(south, -90, 180, lat_bits), cell_index(north, -90, 180, lat_bits) + 1))
+
+    # Merge neighbouring cells into one range
+    ranges = []
+    for cell in cells:
+        if ranges and ranges[-1][1] == cell:
+            ranges[-1][1] = cell + 1
+        else:
+            ranges.append([cell, cell + 1])
+
+    last = 1 << (precision * 5)
+    # '{' sorts after 'z', so it's the upper bound of the last cell
+    return [(to_string(low, precision), to_string(high, precision) if high < last else '{') for low, high in ranges]
+
+
+def bbox_filter(model, west, south, east, north):
+    ranges = or_(*[and_(model.geohash >= low, model.geohash < high) for low, high in cover(west, south, east, north)])
+    if west > east:
+        longitude = or_(model.longitude >= west, model.longitude <= east)
+    else:
+        longitude = model.longitude.between(west, east)
+    return and_(ranges, model.latitude.between(south, north), longitude)
+
+
+# Uses an equirectangular approximation for the distance, which is accurate to well under 1% for radii of up to a few
+# hundred kilometers and only needs arithmetic the database can do on its own
+def radius_filter(model, latitude, longitude, meters):
+    lat_delta = meters / METERS_PER_DEGREE
+    scale = METERS_PER_DEGREE * math.cos(math.radians(latitude))
+    if scale * 180 <= meters or abs(latitude) + lat_delta >= 90:
+        west, east = -180, 180
+    else:
+        lon_delta = meters / scale
+        west = longitude - lon_delta
+        east = longitude + lon_delta
+        if west < -180:
+            west += 360
+        if east > 180:
+            east -= 360
+
+    distance = (((model.latitude - latitude) * METERS_PER_DEGREE) * ((model.latitude - latitude) * METERS_PER_DEGREE) +
+                ((model.longitude - longitude) * scale) * ((model.longitude - longitude) * scale))
+    return and_(bbox_filter(model, west, max(latitude - lat_delta, -90), east, min(latitude + lat_delta, 90)),
+                distance <= meters * meters)
@@ -0,0 +1,90 @@
+import traceback
+from datetime import datetime
+
+import sqlalchemy
+from sqlalchemy import and_, func, insert, select, update
+
+from opentakserver import geohash
+from opentakserver.models.CoT import CoT
+from opentakserver.models.LastPoint import LastPoint
+from opentakserver.models.Point import Point
+from opentakserver.models.SchemaVersion import SchemaVersion
+
+# db.create_all() creates missing tables but never changes existing ones, so changes to existing tables go here.
+# Each migration runs once, in order, and is recorded in the schema_version table. A new database gets its tables
+# from create_all() first, so migrations also have to work when there's nothing to change.
+# Never reorder or remove a migration, only append new ones. Every model has to be imported before migrate() runs, see
+# init_extensions()
+MIGRATIONS = []
+
+
+def migration(function):
+    MIGRATIONS.append(function)
+    return function
+
+
+def create_indexes(db, model):
+    for index in model.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+
+@migration
+def add_point_geohashes(db, logger):
+    if 'geohash' not in [column['name'] for column in sqlalchemy.inspect(db.engine).get_columns('points')]:
+        db.session.execute(sqlalchemy.text("ALTER TABLE points ADD COLUMN geohash VARCHAR"))
+        db.session.commit()
+    create_indexes(db, Point)
+
+    while True:
+        points = db.session.execute(select(Point.id, Point.latitude, Point.longitude)
+                                    .where(Point.geohash.is_(None), Point.latitude.is_not(None),
+                                           Point.longitude.is_not(None)).limit(10000)).all()
+        if not points:
+            break
+
+        db.session.execute(update(Point), [{'id': point.id, 'geohash': geohash.encode(point.latitude, point.longitude)}
+                                           for point in points])
+        db.session.commit()
+
+
+@migration
+def add_last_points(db, logger):
+    if db.session.execute(select(LastPoint.device_uid).limit(1)).first():
+        return
+
+    # The point with the latest timestamp, like CoTWriter.update_last_points(). Points aren't always saved in the order
+    # they were sent, so the highest id isn't necessarily the latest. The id only breaks ties
+    latest_time = (select(Point.device_uid, func.max(Point.timestamp).label('timestamp'))
+                   .where(Point.uid == Point.device_uid).group_by(Point.device_uid).subquery())
+    latest = (select(Point.device_uid, func.max(Point.id).label('id'))
+              .join(latest_time, and_(Point.device_uid == latest_time.c.device_uid,
+                                      Point.timestamp == latest_time.c.timestamp))
+              .where(Point.uid == Point.device_uid).group_by(Point.device_uid).subquery())
+    db.session.execute(insert(LastPoint).from_select(['device_uid', 'point_id', 'timestamp'],
+                                                     select(latest.c.device_uid, Point.id, Point.timestamp)
+                                                     .join(Point, Point.id == latest.c.id)))
+    db.session.commit()
+
+
+@migration
+def add_lookup_indexes(db, logger):
+    create_indexes(db, CoT)
+    create_indexes(db, Point)
+
+
+def migrate(db, logger):
+    version = db.session.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+    for number, function in enumerate(MIGRATIONS[version:], version + 1):
+        logger.info("Migrating the database to version {}: {}".format(number, function.__name__))
+        try:
+            function(db, logger)
+            db.session.add(SchemaVersion(version=number, applied=datetime.utcnow()))
+            db.session.commit()
+        except BaseException:
+            db.session.rollback()
+            logger.error("Database migration {} failed".format(number))
+            logger.error(traceback.format_exc())
+            # Boot stops here instead of running on a half migrated schema. The version isn't recorded, so the next boot
+            # tries it again
+            raise
@@ -109,7 +109,12 @@ class CasEvac(db.Model):
         }
 
     def to_json(self):
-        icon = db.session.execute(db.session.query(Icon).filter(Icon.filename == 'red_crs.png')).first()[0]
+        # Every CasEvac has the same icon, so it's only looked up once per session. Its JSON is kept rather than the
+        # Icon, which would be expired or detached after the session commits or rolls back
+        icon = db.session.info.get('casevac_icon')
+        if not icon:
+            icon = db.session.execute(db.select(Icon).filter_by(filename='red_crs.png')).scalars().first().to_json()
+            db.session.info['casevac_icon'] = icon
         return {
             'sender_uid': self.sender_uid,
             'uid': self.uid,
@@ -155,7 +160,7 @@ class CasEvac(db.Model):
             'zmist': self.zmist.serialize() if self.zmist else None,
             'eud': self.eud,
             'point': self.point.to_json() if self.point else None,
-            'icon': icon.to_json(),
+            'icon': dict(icon),
             'start': iso8601_string_from_datetime(self.cot.start) if self.cot else None,
             'stale': iso8601_string_from_datetime(self.cot.stale) if self.cot else None,
         }
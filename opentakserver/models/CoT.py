@@ -1,7 +1,7 @@
 from datetime import datetime
 
 from opentakserver.extensions import db
-from sqlalchemy import Integer, String, JSON, ForeignKey, DateTime
+from sqlalchemy import Integer, String, JSON, ForeignKey, DateTime, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from opentakserver.functions import iso8601_string_from_datetime
@@ -9,6 +9,10 @@ from opentakserver.functions import iso8601_string_from_datetime
 
 class CoT(db.Model):
     __tablename__ = "cot"
+    # Newest first by sender or type and cursor pagination on (timestamp, id)
+    __table_args__ = (Index("ix_cot_sender_uid_timestamp", "sender_uid", "timestamp"),
+                      Index("ix_cot_type_timestamp", "type", "timestamp"),
+                      Index("ix_cot_timestamp_id", "timestamp", "id"))
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     how: Mapped[str] = mapped_column(String, nullable=True)
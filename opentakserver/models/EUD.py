@@ -26,6 +26,7 @@ class EUD(db.Model):
     team_id: Mapped[int] = mapped_column(Integer, ForeignKey("teams.id"), nullable=True)
     team_role: Mapped[str] = mapped_column(String, nullable=True)
     points = relationship("Point", back_populates="eud")
+    last_point = relationship("Point", secondary="last_points", uselist=False, viewonly=True)
     cots = relationship("CoT", back_populates="eud")
     casevacs = relationship("CasEvac", back_populates="eud")
     geochats = relationship("GeoChat", back_populates="eud")
@@ -69,7 +70,7 @@ class EUD(db.Model):
             'last_event_time': iso8601_string_from_datetime(self.last_event_time) if self.last_event_time else None,
             'last_status': self.last_status,
             'username': self.user.username if self.user else None,
-            'last_point': self.points[-1].to_json() if self.points else None,
+            'last_point': self.last_point.to_json() if self.last_point else None,
             'team': self.team.name if self.team else None,
             'team_color': self.team.get_team_color() if self.team else None,
             'team_role': self.team_role,
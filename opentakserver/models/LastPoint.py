@@ -0,0 +1,14 @@
+from datetime import datetime
+
+from opentakserver.extensions import db
+from sqlalchemy import Integer, String, ForeignKey, DateTime
+from sqlalchemy.orm import Mapped, mapped_column
+
+
+# Each EUD's last known position, kept up to date by the CoT writer so it can be read without loading every point
+class LastPoint(db.Model):
+    __tablename__ = "last_points"
+
+    device_uid: Mapped[str] = mapped_column(String, ForeignKey("euds.uid"), primary_key=True)
+    point_id: Mapped[int] = mapped_column(Integer, ForeignKey("points.id"))
+    timestamp: Mapped[datetime] = mapped_column(DateTime)
@@ -1,7 +1,7 @@
 from datetime import datetime
 
 from opentakserver.extensions import db
-from sqlalchemy import Integer, String, ForeignKey, Float, DateTime
+from sqlalchemy import Integer, String, ForeignKey, Float, DateTime, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from opentakserver.functions import iso8601_string_from_datetime
@@ -9,12 +9,18 @@ from opentakserver.functions import iso8601_string_from_datetime
 
 class Point(db.Model):
     __tablename__ = "points"
+    # latitude and longitude are in the index so bounding box queries can filter without reading the table
+    __table_args__ = (Index("ix_points_geohash", "geohash", "latitude", "longitude"),
+                      Index("ix_points_device_uid_timestamp", "device_uid", "timestamp"),
+                      Index("ix_points_timestamp_id", "timestamp", "id"))
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     uid: Mapped[str] = mapped_column(String)
     device_uid: Mapped[str] = mapped_column(String, ForeignKey("euds.uid"))
     latitude: Mapped[float] = mapped_column(Float, nullable=True)
     longitude: Mapped[float] = mapped_column(Float, nullable=True)
+    # Spatial index for bounding box and radius queries, see opentakserver/geohash.py
+    geohash: Mapped[str] = mapped_column(String, nullable=True)
     ce: Mapped[float] = mapped_column(Float, nullable=True)
     hae: Mapped[float] = mapped_column(Float, nullable=True)
     le: Mapped[float] = mapped_column(Float, nullable=True)
@@ -0,0 +1,13 @@
+from datetime import datetime
+
+from opentakserver.extensions import db
+from sqlalchemy import Integer, DateTime
+from sqlalchemy.orm import Mapped, mapped_column
+
+
+# One row per migration in opentakserver/migrations.py that has been applied to this database
+class SchemaVersion(db.Model):
+    __tablename__ = "schema_version"
+
+    version: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    applied: Mapped[datetime] = mapped_column(DateTime)
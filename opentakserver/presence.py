@@ -0,0 +1,253 @@
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from threading import Lock
+
+import msgpack
+
+
+class EUDPresence:
+    __slots__ = ('uid', 'callsign', 'cot', 'proto', 'last_event_time', 'last_status', 'stale', 'slot')
+
+    def __init__(self, uid, callsign=None, cot=None, last_event_time=None, last_status=None, stale=None, proto=None):
+        self.uid = uid
+        self.callsign = callsign
+        # The EUD's latest SA message as bytes, replayed to EUDs when they connect, and as a TAK protocol stream
+        # message for the ones that speak protobuf
+        self.cot = cot
+        self.proto = proto
+        self.last_event_time = last_event_time
+        self.last_status = last_status
+        # Seconds since the epoch
+        self.stale = stale
+        self.slot = None
+
+
+EUDSnapshot = namedtuple('EUDSnapshot', ['uid', 'callsign', 'last_event_time', 'last_status', 'online'])
+
+
+def timestamp(datetime_object):
+    if datetime_object is None:
+        return None
+    return datetime_object.replace(tzinfo=timezone.utc).timestamp()
+
+
+def from_timestamp(seconds):
+    if seconds is None:
+        return None
+    return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+
+
+# Changes as they're published to the streaming workers
+def pack_change(change):
+    kind, uid, callsign, cot, last_event_time, stale, status, proto = change
+    return msgpack.packb([kind, uid, callsign, cot, timestamp(last_event_time), timestamp(stale), status, proto])
+
+
+def unpack_change(data):
+    kind, uid, callsign, cot, last_event_time, stale, status, proto = msgpack.unpackb(data)
+    return kind, uid, callsign, cot, from_timestamp(last_event_time), from_timestamp(stale), status, proto
+
+
+# Tracks every known EUD and which ones are online, with O(1) lookups by uid and callsign. Online EUDs whose SA goes
+# stale are expired by a timing wheel with one slot per resolution seconds, so expiring only looks at the EUDs that
+# are due instead of every online EUD.
+class PresenceRegistry:
+    def __init__(self, wheel_slots=512, resolution=1.0):
+        self.lock = Lock()
+        self.euds = {}
+        self.online = {}
+        self.callsigns = {}
+
+        self.wheel = [set() for _ in range(wheel_slots)]
+        self.resolution = resolution
+        self.tick = int(time.time() / resolution)
+
+        self.version = 0
+        self._snapshot = None
+
+        # Called with every connect, update and disconnect, i.e. to share them with the streaming workers
+        self.listeners = []
+
+    def __contains__(self, uid):
+        return uid in self.online
+
+    def __len__(self):
+        return len(self.online)
+
+    # Loads EUDs that were seen before the server started. They're known but not online
+    def load(self, euds):
+        with self.lock:
+            for eud in euds:
+                if eud.uid not in self.euds:
+                    self.euds[eud.uid] = EUDPresence(eud.uid, eud.callsign, None, eud.last_event_time,
+                                                     eud.last_status)
+            self.version += 1
+
+    # Returns True if the EUD wasn't already online
+    def connect(self, uid, callsign, cot, last_event_time, stale, proto=None):
+        with self.lock:
+            eud = self.euds.get(uid)
+            if not eud:
+                eud = self.euds[uid] = EUDPresence(uid)
+
+            if eud.callsign != callsign and self.callsigns.get(eud.callsign) == uid:
+                del self.callsigns[eud.callsign]
+
+            eud.callsign = callsign
+            eud.cot = cot
+            eud.proto = proto
+            eud.last_event_time = last_event_time
+            eud.last_status = 'Connected'
+            if callsign:
+                self.callsigns[callsign] = uid
+
+            is_new = uid not in self.online
+            self.online[uid] = eud
+            self._schedule(eud, timestamp(stale))
+            self.version += 1
+
+        self.notify('connect', uid, callsign, cot, last_event_time, stale, 'Connected', proto)
+        return is_new
+
+    # A new SA message from an EUD that's already online
+    def update(self, uid, cot, last_event_time, stale, proto=None):
+        with self.lock:
+            eud = self.online.get(uid)
+            if not eud:
+                return False
+
+            eud.cot = cot
+            eud.proto = proto
+            eud.last_event_time = last_event_time
+            self._schedule(eud, timestamp(stale))
+            self.version += 1
+
+        self.notify('update', uid, None, cot, last_event_time, stale, None, proto)
+        return True
+
+    def disconnect(self, uid, last_event_time=None, status='Disconnected'):
+        with self.lock:
+            eud = self.online.pop(uid, None)
+            if not eud:
+                return None
+
+            if self.callsigns.get(eud.callsign) == uid:
+                del self.callsigns[eud.callsign]
+            if eud.slot is not None:
+                self.wheel[eud.slot].discard(uid)
+                eud.slot = None
+
+            eud.cot = None
+            eud.proto = None
+            eud.last_status = status
+            if last_event_time:
+                eud.last_event_time = last_event_time
+            self.version += 1
+
+        self.notify('disconnect', uid, None, None, eud.last_event_time, None, status, None)
+        return eud
+
+    # Changes are (kind, uid, callsign, cot, last_event_time, stale, status, proto)
+    def notify(self, *change):
+        for listener in self.listeners:
+            listener(change)
+
+    # Mirrors a change another process' registry notified about. A worker's snapshot of the online EUDs can arrive
+    # after newer changes, so anything older than what's already known is ignored. Returns True if it was applied
+    def apply(self, change):
+        kind, uid, callsign, cot, last_event_time, stale, status, proto = change
+        eud = self.euds.get(uid)
+        if eud and eud.last_event_time and last_event_time:
+            if last_event_time < eud.last_event_time:
+                return False
+            # An EUD that went offline since the snapshot was taken
+            if last_event_time == eud.last_event_time and kind != 'disconnect' and uid not in self.online:
+                return False
+
+        if kind == 'disconnect':
+            return self.disconnect(uid, last_event_time, status) is not None
+        elif kind == 'update' and self.update(uid, cot, last_event_time, stale, proto):
+            return True
+
+        # Updates from EUDs this registry missed the connect of are connects
+        self.connect(uid, callsign or (eud.callsign if eud else None), cot, last_event_time, stale, proto)
+        return True
+
+    # Drops offline EUDs, i.e. after their DB rows are deleted
+    def forget_offline(self):
+        with self.lock:
+            self.euds = {uid: eud for uid, eud in self.euds.items() if uid in self.online}
+            self.version += 1
+
+    # Marks every online EUD whose stale time has passed as Stale and returns their uids
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        current = int(now / self.resolution)
+        expired = []
+
+        with self.lock:
+            # After a long pause every slot is due, but each only needs to be checked once
+            first = max(self.tick, current - len(self.wheel) + 1)
+            for tick in range(first, current + 1):
+                for uid in list(self.wheel[tick % len(self.wheel)]):
+                    eud = self.online[uid]
+                    # Stale times more than a full turn of the wheel away stay in their slot until their turn
+                    if eud.stale <= now:
+                        expired.append(uid)
+            self.tick = current + 1
+
+        for uid in expired:
+            self.disconnect(uid, status='Stale')
+        return expired
+
+    def _schedule(self, eud, stale):
+        if eud.slot is not None:
+            self.wheel[eud.slot].discard(eud.uid)
+            eud.slot = None
+
+        eud.stale = stale
+        if stale is not None:
+            # Anything already due goes in the next slot to be checked
+            eud.slot = max(int(stale / self.resolution), self.tick) % len(self.wheel)
+            self.wheel[eud.slot].add(eud.uid)
+
+    def get(self, uid):
+        return self.euds.get(uid)
+
+    def get_uid(self, callsign):
+        return self.callsigns.get(callsign)
+
+    def get_callsign(self, uid):
+        eud = self.online.get(uid)
+        return eud.callsign if eud else None
+
+    # (uid, callsign, latest SA message, last_event_time, stale, stream message) of every online EUD, in the order
+    # connect() takes them
+    def online_euds(self):
+        with self.lock:
+            return [(eud.uid, eud.callsign, eud.cot, eud.last_event_time, from_timestamp(eud.stale), eud.proto)
+                    for eud in self.online.values()]
+
+    # (uid, last_event_time, latest SA message, stream message) of every online EUD
+    def roster(self, exclude=None):
+        with self.lock:
+            return [(eud.uid, eud.last_event_time, eud.cot, eud.proto) for eud in self.online.values()
+                    if eud.cot and eud.uid != exclude]
+
+    # An immutable copy of every known EUD that's only rebuilt after something changes, so it's cheap to call on
+    # every request
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot and snapshot[0] == self.version:
+            return snapshot[1]
+
+        with self.lock:
+            euds = tuple(EUDSnapshot(eud.uid, eud.callsign, eud.last_event_time, eud.last_status, eud.uid in self.online)
+                         for eud in self.euds.values())
+            self._snapshot = (self.version, euds)
+            return euds
+
+    def stats(self):
+        return {'known': len(self.euds), 'online': len(self.online), 'callsigns': len(self.callsigns),
+                'scheduled': sum(len(slot) for slot in self.wheel)}
@@ -0,0 +1,269 @@
+import itertools
+import traceback
+from collections import deque
+from threading import Thread, Lock
+
+import pika
+
+
+class PooledChannel:
+    def __init__(self, pool, connection, number):
+        self.pool = pool
+        self.connection = connection
+        self.number = number
+        self.channel = None
+        self.leases = 0
+        self.published = 0
+
+        # key -> [queue, exchange, on_message_callback, consumer_tag, exclusive]. Only modified on the connection's
+        # ioloop thread
+        self.consumers = {}
+
+    @property
+    def is_open(self):
+        return self.channel is not None and self.channel.is_open
+
+    def open(self):
+        self.connection.connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_channel_open(self, channel):
+        # Under the pool's lock so nothing is added to its pending publishes once a channel is open
+        with self.pool.lock:
+            self.channel = channel
+            pending = self.pool.take_pending()
+        self.channel.add_on_close_callback(self.on_channel_closed)
+
+        # Re-subscribe consumers after a reconnect
+        for key in list(self.consumers.keys()):
+            self._consume(key)
+
+        for exchange, body, routing_key, properties in pending:
+            self._publish(exchange, body, routing_key, properties)
+
+    def on_channel_closed(self, channel, error):
+        self.channel = None
+        self.pool.logger.warning("RabbitMQ pool channel {}.{} closed: {}".format(self.connection.number, self.number, error))
+
+        if self.connection.is_open:
+            self.open()
+
+    def publish(self, exchange, body, routing_key='', properties=None):
+        def basic_publish():
+            if self.is_open:
+                self._publish(exchange, body, routing_key, properties)
+
+        self.connection.call(basic_publish)
+
+    # Exclusive queues are deleted when their connection closes
+    def consume(self, queue, on_message_callback, exchange=None, exclusive=False):
+        key = next(self.pool.consumer_keys)
+
+        def add_consumer():
+            self.consumers[key] = [queue, exchange, on_message_callback, None, exclusive]
+            self._consume(key)
+
+        self.connection.call(add_consumer)
+        return key
+
+    def unbind(self, queue, exchange):
+        def queue_unbind():
+            if self.is_open:
+                self.channel.queue_unbind(queue=queue, exchange=exchange)
+
+        self.connection.call(queue_unbind)
+
+    def cancel(self, key):
+        def remove_consumer():
+            consumer = self.consumers.pop(key, None)
+            if consumer and consumer[3] and self.is_open:
+                self.channel.basic_cancel(consumer[3])
+
+        self.connection.call(remove_consumer)
+
+    def _publish(self, exchange, body, routing_key, properties):
+        self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+        self.published += 1
+
+    def _consume(self, key):
+        if not self.is_open:
+            return
+
+        queue, exchange, on_message_callback, consumer_tag, exclusive = self.consumers[key]
+        self.channel.queue_declare(queue=queue, exclusive=exclusive)
+        if exchange:
+            self.channel.queue_bind(exchange=exchange, queue=queue)
+        self.consumers[key][3] = self.channel.basic_consume(queue=queue, on_message_callback=on_message_callback,
+                                                            auto_ack=True)
+
+
+class PooledConnection:
+    def __init__(self, pool, number, channels):
+        self.pool = pool
+        self.number = number
+        self.connection = None
+        self.iothread = None
+        self.channels = [PooledChannel(pool, self, i) for i in range(channels)]
+
+    @property
+    def is_open(self):
+        return self.connection is not None and self.connection.is_open
+
+    def connect(self):
+        self.connection = pika.SelectConnection(pika.ConnectionParameters(self.pool.address),
+                                                on_open_callback=self.on_connection_open,
+                                                on_open_error_callback=self.on_connection_error,
+                                                on_close_callback=self.on_connection_closed)
+        self.iothread = Thread(target=self.connection.ioloop.start)
+        self.iothread.daemon = True
+        self.iothread.start()
+
+    def on_connection_open(self, connection):
+        self.pool.logger.debug("RabbitMQ pool connection {} is open".format(self.number))
+        for channel in self.channels:
+            channel.open()
+
+    def on_connection_error(self, connection, error):
+        self.pool.logger.error("RabbitMQ pool connection {} failed: {}".format(self.number, error))
+        self.schedule_reconnect()
+
+    def on_connection_closed(self, connection, error):
+        for channel in self.channels:
+            channel.channel = None
+
+        if not self.pool.shutdown:
+            self.pool.logger.warning("RabbitMQ pool connection {} closed: {}".format(self.number, error))
+            self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        if not self.pool.shutdown:
+            self.connection.ioloop.call_later(self.pool.reconnect_delay, self.reconnect)
+
+    def reconnect(self):
+        old_connection = self.connection
+        self.connect()
+        old_connection.ioloop.stop()
+
+    def call(self, callback):
+        try:
+            self.connection.ioloop.add_callback_threadsafe(callback)
+        except BaseException as e:
+            self.pool.logger.error("RabbitMQ pool connection {} is unavailable: {}".format(self.number, e))
+
+    def close(self):
+        if self.is_open:
+            self.call(self.connection.close)
+
+
+class RabbitMQPool:
+    def __init__(self, app=None):
+        self.logger = None
+        self.address = None
+        self.pool_connections = 2
+        self.pool_channels = 4
+        self.reconnect_delay = 5
+        self.connections = []
+        self.consumer_keys = itertools.count()
+        self.round_robin = None
+        # Publishes made before any channel has opened, sent by the first one that does
+        self.pending = deque(maxlen=10000)
+        self.dropped = 0
+        self.lock = Lock()
+        self.started = False
+        self.shutdown = False
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from opentakserver.extensions import logger
+
+        self.logger = logger
+        self.address = app.config.get("OTS_RABBITMQ_SERVER_ADDRESS")
+        self.pool_connections = max(1, app.config.get("OTS_RABBITMQ_POOL_CONNECTIONS", 2))
+        self.pool_channels = max(1, app.config.get("OTS_RABBITMQ_POOL_CHANNELS", 4))
+        self.pending = deque(maxlen=max(1, app.config.get("OTS_RABBITMQ_POOL_MAX_PENDING", 10000)))
+
+    # Connections are opened on first use so processes that never stream, like the tests, don't open them
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+
+            self.shutdown = False
+            self.connections = [PooledConnection(self, i, self.pool_channels) for i in range(self.pool_connections)]
+            for connection in self.connections:
+                try:
+                    connection.connect()
+                except BaseException as e:
+                    self.logger.error("Failed to connect to rabbitmq: {}".format(e))
+                    self.logger.debug(traceback.format_exc())
+
+            self.round_robin = itertools.cycle(self.channels())
+            self.started = True
+
+    def stop(self):
+        with self.lock:
+            self.shutdown = True
+            self.started = False
+            for connection in self.connections:
+                connection.close()
+
+    def channels(self):
+        return [channel for connection in self.connections for channel in connection.channels]
+
+    # Lease the least loaded channel, preferring ones that are open
+    def acquire(self):
+        self.start()
+        with self.lock:
+            channel = min(self.channels(), key=lambda c: (not c.is_open, c.leases))
+            channel.leases += 1
+            return channel
+
+    def release(self, channel):
+        with self.lock:
+            channel.leases = max(0, channel.leases - 1)
+
+    def publish(self, exchange, body, routing_key='', properties=None):
+        self.start()
+        with self.lock:
+            for i in range(len(self.connections) * self.pool_channels):
+                channel = next(self.round_robin)
+                if channel.is_open:
+                    break
+            else:
+                # No RabbitMQ channel has opened yet
+                if len(self.pending) == self.pending.maxlen:
+                    self.dropped += 1
+                    if self.dropped == 1 or self.dropped % 1000 == 0:
+                        self.logger.warning("No RabbitMQ channel is open, {} messages have been dropped".format(
+                            self.dropped))
+                self.pending.append((exchange, body, routing_key, properties))
+                return
+        channel.publish(exchange, body, routing_key, properties)
+
+    # Called with the lock held
+    def take_pending(self):
+        pending = list(self.pending)
+        self.pending.clear()
+        return pending
+
+    def stats(self):
+        channels = self.channels()
+        open_channels = [channel for channel in channels if channel.is_open]
+        leases = sum(channel.leases for channel in channels)
+
+        return {
+            'connections': len(self.connections),
+            'open_connections': sum(1 for connection in self.connections if connection.is_open),
+            'channels': len(channels),
+            'open_channels': len(open_channels),
+            'leases': leases,
+            'consumers': sum(len(channel.consumers) for channel in channels),
+            'published': sum(channel.published for channel in channels),
+            'pending': len(self.pending),
+            'dropped': self.dropped,
+            'leases_per_channel': leases / len(open_channels) if open_channels else 0,
+            'pool': [{'connection': channel.connection.number, 'channel': channel.number, 'open': channel.is_open,
+                      'leases': channel.leases, 'consumers': len(channel.consumers),
+                      'published': channel.published} for channel in channels]
+        }
@@ -0,0 +1,54 @@
+from sqlalchemy.orm import selectinload
+
+from opentakserver.models.Alert import Alert
+from opentakserver.models.CasEvac import CasEvac
+from opentakserver.models.Certificate import Certificate
+from opentakserver.models.CoT import CoT
+from opentakserver.models.DataPackage import DataPackage
+from opentakserver.models.EUD import EUD
+from opentakserver.models.GeoChat import GeoChat
+from opentakserver.models.Marker import Marker
+from opentakserver.models.Point import Point
+from opentakserver.models.RBLine import RBLine
+from opentakserver.models.user import User
+
+# The relationships each model's to_json() reads, loaded up front with one SELECT .. IN per relationship so a page of
+# results costs the same number of queries no matter how many rows are on it. Models without an entry don't touch
+# any relationships
+loaders = {}
+
+
+def register(model, *options):
+    loaders[model] = options
+
+
+def load_options(model):
+    return loaders.get(model, ())
+
+
+def point(relationship):
+    return selectinload(relationship).options(selectinload(Point.cot), selectinload(Point.eud))
+
+
+def eud(relationship, include_data_packages=True):
+    options = [selectinload(EUD.user), selectinload(EUD.team), point(EUD.last_point),
+               selectinload(EUD.certificate).selectinload(Certificate.data_package)]
+    if include_data_packages:
+        options.append(selectinload(EUD.data_packages).selectinload(DataPackage.user))
+    return selectinload(relationship).options(*options) if relationship else options
+
+
+register(Point, selectinload(Point.cot), selectinload(Point.eud))
+register(EUD, *eud(None))
+register(Alert, point(Alert.point), selectinload(Alert.eud))
+register(CasEvac, point(CasEvac.point), selectinload(CasEvac.zmist), selectinload(CasEvac.cot))
+register(GeoChat, point(GeoChat.point))
+register(Marker, point(Marker.point), selectinload(Marker.icon), selectinload(Marker.cot))
+register(RBLine, point(RBLine.point))
+register(DataPackage, selectinload(DataPackage.user), eud(DataPackage.eud, False))
+register(Certificate, selectinload(Certificate.data_package))
+register(User, selectinload(User.euds), selectinload(User.video_streams), selectinload(User.roles))
+register(CoT, eud(CoT.eud), point(CoT.point), selectinload(CoT.video),
+         selectinload(CoT.alert).options(point(Alert.point), selectinload(Alert.eud)),
+         selectinload(CoT.casevac).options(point(CasEvac.point), selectinload(CasEvac.zmist), selectinload(CasEvac.cot)),
+         selectinload(CoT.geochat).options(point(GeoChat.point)))
@@ -0,0 +1,263 @@
+import importlib
+import json
+import os
+import pkgutil
+import select
+import socket
+import subprocess
+import sys
+import traceback
+from threading import Lock, Timer
+
+import flask_wtf
+import pika
+import sqlalchemy
+import yaml
+from flask import Flask
+from flask_security import Security, SQLAlchemyUserDatastore
+from flask_security.models import fsqla_v3 as fsqla
+
+from opentakserver import models
+from opentakserver.SocketServer import SocketServer, handshake_stats
+from opentakserver.defaultconfig import DefaultConfig
+from opentakserver.extensions import db, logger, presence, rabbitmq_pool, setup_logging
+from opentakserver.presence import unpack_change
+
+# With OTS_STREAMING_WORKERS set, the TCP and SSL streaming ports are served by that many processes instead of the main
+# one. Every worker listens on both ports with SO_REUSEPORT and the kernel spreads new connections over them. Workers
+# only frame, authenticate and deliver CoTs, what they receive still goes to the CoTController in the main process
+# through RabbitMQ, and DMs and chatroom messages reach them through the EUD's queue like before. The main process
+# publishes every presence change to the presence exchange and each worker keeps a copy of the registry, so EUDs get
+# the same roster whichever worker they connect to. The main process talks to each worker with one JSON object per
+# line over its stdin and stdout
+
+
+def create_app(number):
+    app = Flask(__name__)
+    app.config.from_object(DefaultConfig)
+    # The main process has already created config.yml and the CA
+    app.config.from_file(os.path.join(app.config.get("OTS_DATA_FOLDER"), "config.yml"), load=yaml.safe_load)
+    setup_logging(app, "streaming-worker-{}.log".format(number))
+
+    db.init_app(app)
+    try:
+        fsqla.FsModels.set_db_info(db)
+    except sqlalchemy.exc.InvalidRequestError:
+        pass
+
+    # Every model has to be imported for the EUD model's relationships to resolve
+    for module in pkgutil.iter_modules(models.__path__):
+        importlib.import_module("opentakserver.models.{}".format(module.name))
+
+    from opentakserver.models.user import User
+    from opentakserver.models.role import Role
+    from opentakserver.models.WebAuthn import WebAuthn
+
+    # Security checks for it because of the CSRF cookie settings in DefaultConfig
+    flask_wtf.CSRFProtect(app)
+    app.security = Security(app, SQLAlchemyUserDatastore(db, User, Role, WebAuthn), register_blueprint=False)
+    rabbitmq_pool.init_app(app)
+    return app
+
+
+# Keeps this process' presence registry in sync with the main process'
+class PresenceMirror:
+    def __init__(self, sync_interval=5):
+        self.queue = "presence-{}-{}".format(socket.gethostname(), os.getpid())
+        self.sync_interval = sync_interval
+        self.synced = False
+        self.channel = None
+        self.timer = None
+
+    def start(self):
+        self.channel = rabbitmq_pool.acquire()
+        self.channel.consume(self.queue, self.on_message, exchange='presence', exclusive=True)
+        self.request_sync()
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+
+    # The request is dropped if it reaches the main process before this worker's queue exists, so it's repeated
+    # until the online EUDs arrive
+    def request_sync(self):
+        if self.synced:
+            return
+
+        self.channel.publish('', b'', routing_key='presence_sync', properties=pika.BasicProperties(reply_to=self.queue))
+        self.timer = Timer(self.sync_interval, self.request_sync)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def on_message(self, unused_channel, basic_deliver, properties, body):
+        try:
+            if properties.type == 'synced':
+                if not self.synced:
+                    logger.info("Synced {} online EUDs".format(len(presence)))
+                self.synced = True
+            else:
+                presence.apply(unpack_change(body))
+        except BaseException as e:
+            logger.error(traceback.format_exc())
+
+
+class StreamingWorker:
+    def __init__(self, app):
+        self.app = app
+        self.servers = {}
+        self.presence = PresenceMirror()
+
+    def start_server(self, port):
+        if port == 'tcp':
+            server = SocketServer(logger, self.app.app_context(), self.app.config.get("OTS_TCP_STREAMING_PORT"),
+                                  reuse_port=True)
+        else:
+            server = SocketServer(logger, self.app.app_context(), self.app.config.get("OTS_SSL_STREAMING_PORT"), True,
+                                  reuse_port=True)
+        server.start()
+        self.servers[port] = server
+
+    def start(self):
+        self.presence.start()
+        self.start_server('tcp')
+        self.start_server('ssl')
+
+    def stop(self):
+        self.presence.stop()
+        for server in self.servers.values():
+            if server.is_alive():
+                server.stop()
+                server.join()
+        rabbitmq_pool.stop()
+
+    def handle(self, command, port):
+        server = self.servers[port]
+        if command == 'start' and not server.is_alive():
+            if port == 'tcp':
+                self.app.config.update(OTS_ENABLE_TCP_STREAMING_PORT=True)
+            self.start_server(port)
+        elif command == 'stop' and server.is_alive():
+            server.stop()
+            server.join()
+        elif command == 'stats':
+            return {'alive': server.is_alive(), 'clients': server.client_stats(),
+                    'handshake_counts': server.handshake_counts, 'handshake_times': list(server.handshake_times),
+                    'handshakes_in_progress': len(server.handshakes)}
+        return {'alive': self.servers[port].is_alive()}
+
+    def serve(self, commands, replies):
+        for line in commands:
+            try:
+                request = json.loads(line)
+                reply = self.handle(request['command'], request['port'])
+            except BaseException as e:
+                logger.error(traceback.format_exc())
+                reply = {'error': str(e)}
+            replies.write(json.dumps(reply) + "\n")
+            replies.flush()
+
+
+# The worker processes as seen from the main process. Workers that exit or stop answering are replaced
+class StreamingWorkers:
+    def __init__(self, logger, count, timeout=5):
+        self.logger = logger
+        self.timeout = timeout
+        self.lock = Lock()
+        self.processes = [self.spawn(number) for number in range(1, count + 1)]
+
+    def spawn(self, number):
+        self.logger.info("Starting streaming worker {}".format(number))
+        return subprocess.Popen([sys.executable, "-m", "opentakserver.streaming_worker", str(number)],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+    def call(self, command, port):
+        replies = []
+        with self.lock:
+            for i, process in enumerate(self.processes):
+                if process.poll() is not None:
+                    self.logger.error("Streaming worker {} exited with {}".format(i + 1, process.returncode))
+                    self.processes[i] = self.spawn(i + 1)
+                    continue
+
+                try:
+                    process.stdin.write(json.dumps({'command': command, 'port': port}) + "\n")
+                    process.stdin.flush()
+                    readable, writable, exceptional = select.select([process.stdout], [], [], self.timeout)
+                    if not readable:
+                        raise TimeoutError("No reply after {} seconds".format(self.timeout))
+                    replies.append(json.loads(process.stdout.readline()))
+                except BaseException as e:
+                    self.logger.error("Streaming worker {} failed to {} {}: {}".format(i + 1, command, port, e))
+                    process.kill()
+                    process.wait()
+                    self.processes[i] = self.spawn(i + 1)
+        return replies
+
+    def stop(self):
+        with self.lock:
+            for process in self.processes:
+                # Workers shut down when their stdin closes
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+            for process in self.processes:
+                try:
+                    process.wait(self.timeout)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+
+# Stands in for the main process' SocketServer of one port, so the API can start, stop and check on it the same way
+class WorkerPort:
+    def __init__(self, workers, port):
+        self.workers = workers
+        self.port = port
+
+    def is_alive(self):
+        return any(reply.get('alive') for reply in self.workers.call('is_alive', self.port))
+
+    def start(self):
+        self.workers.call('start', self.port)
+
+    def stop(self):
+        self.workers.call('stop', self.port)
+
+    def client_stats(self):
+        return [client for reply in self.workers.call('stats', self.port) for client in reply.get('clients', [])]
+
+    def handshake_stats(self):
+        counts = {}
+        times = []
+        in_progress = 0
+        for reply in self.workers.call('stats', self.port):
+            for name, count in reply.get('handshake_counts', {}).items():
+                counts[name] = counts.get(name, 0) + count
+            times += reply.get('handshake_times', [])
+            in_progress += reply.get('handshakes_in_progress', 0)
+        return handshake_stats(counts, times, in_progress)
+
+
+def main():
+    # Replies go to the original stdout, anything else that gets printed goes to stderr
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    number = int(sys.argv[1])
+    app = create_app(number)
+    worker = StreamingWorker(app)
+    worker.start()
+    logger.info("Streaming worker {} started".format(number))
+
+    try:
+        worker.serve(sys.stdin, replies)
+    except KeyboardInterrupt:
+        pass
+
+    # stdin closes when the main process stops or exits
+    worker.stop()
+    logger.info("Streaming worker {} stopped".format(number))
+
+
+if __name__ == '__main__':
+    main()
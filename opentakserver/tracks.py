@@ -0,0 +1,123 @@
+import numpy as np
+
+from opentakserver.geohash import METERS_PER_DEGREE
+
+# Downsamples EUD tracks for the web map. Douglas-Peucker keeps the points that change the shape of the track the most
+# and time buckets keep one point per slice of time. Both work on whole NumPy arrays, Douglas-Peucker splits every
+# segment of the track at once on each pass instead of recursing one segment at a time
+
+
+# Meters east and north of the equator and prime meridian, good enough for comparing distances along a track
+def project(latitudes, longitudes):
+    longitudes = np.degrees(np.unwrap(np.radians(longitudes)))
+    return longitudes * METERS_PER_DEGREE * np.cos(np.radians(latitudes)), latitudes * METERS_PER_DEGREE
+
+
+# Squared distance from each point to the segment between its start and end points
+def distances(x, y, points, start, end):
+    dx = x[end] - x[start]
+    dy = y[end] - y[start]
+    px = x[points] - x[start]
+    py = y[points] - y[start]
+    length = dx * dx + dy * dy
+    t = np.clip(np.divide(px * dx + py * dy, length, out=np.zeros_like(length), where=length > 0), 0, 1)
+    px -= t * dx
+    py -= t * dy
+    return px * px + py * py
+
+
+# How far off the simplified track would be without each point, in meters. A point never ranks above the point that
+# split its segment, so the n highest ranked points are always what Douglas-Peucker would keep for some tolerance.
+# Segments that are already within tolerance aren't split any further and their points rank 0. With a count, the
+# tolerance rises to the count-th highest rank so far, since nothing below it can make the cut
+def significance(x, y, tolerance=0, count=None):
+    ranks = np.zeros(len(x))
+    ranks[[0, -1]] = np.inf
+    # Squared distances are compared until the end
+    tolerance = tolerance * tolerance
+
+    # Every point that's still in a segment being split, with that segment's start and end
+    active = np.arange(1, len(x) - 1)
+    start = np.zeros(active.size, dtype=np.intp)
+    end = np.full(active.size, len(x) - 1, dtype=np.intp)
+
+    while active.size:
+        if count:
+            kept = ranks[ranks > 0]
+            if kept.size > count:
+                tolerance = max(tolerance, np.partition(kept, -count)[-count])
+
+        distance = distances(x, y, active, start, end)
+
+        # active is sorted, so each segment's points are next to each other
+        first = np.flatnonzero(np.concatenate(([True], start[1:] != start[:-1])))
+        sizes = np.diff(np.append(first, active.size))
+        maxima = np.maximum.reduceat(distance, first)
+        candidates = np.flatnonzero(distance == np.repeat(maxima, sizes))
+        group = np.repeat(np.arange(first.size), sizes)[candidates]
+        split = candidates[np.concatenate(([True], group[1:] != group[:-1]))]
+
+        splitting = maxima > tolerance
+        ranks[active[split[splitting]]] = np.minimum(maxima[splitting], np.minimum(ranks[start[split[splitting]]],
+                                                                                   ranks[end[split[splitting]]]))
+
+        # Points of segments that weren't split are done, the rest move into the half of the segment they're in
+        split = np.repeat(active[split], sizes)
+        before = active < split
+        remaining = np.repeat(splitting, sizes) & (active != split)
+        start = np.where(before, start, split)[remaining]
+        end = np.where(before, split, end)[remaining]
+        active = active[remaining]
+
+    return np.sqrt(ranks)
+
+
+# Indexes of the points to keep, either at most count points or every point more than tolerance meters off the track
+def douglas_peucker(latitudes, longitudes, count=None, tolerance=None):
+    if len(latitudes) <= 2 or (count and len(latitudes) <= count):
+        return np.arange(len(latitudes))
+
+    x, y = project(latitudes, longitudes)
+    if tolerance is not None:
+        return np.flatnonzero(significance(x, y, tolerance) > tolerance)
+
+    ranks = significance(x, y, count=count)
+    return np.sort(np.argpartition(-ranks, count - 1)[:count])
+
+
+# The first point in each of count - 1 equal slices of time, plus the last point. Finding where each slice starts
+# with a binary search avoids doing any arithmetic on every timestamp
+def time_buckets(timestamps, count):
+    if len(timestamps) <= count:
+        return np.arange(len(timestamps))
+
+    step = (timestamps[-1] - timestamps[0]) / (count - 1)
+    starts = np.array([timestamps[0] + step * i for i in range(count - 1)], dtype=object)
+    return np.unique(np.append(np.searchsorted(timestamps, starts), len(timestamps) - 1))
+
+
+def simplify(timestamps, latitudes, longitudes, method='dp', count=None, tolerance=None):
+    if method == 'time':
+        return time_buckets(timestamps, count)
+    return douglas_peucker(latitudes, longitudes, count, tolerance)
+
+
+# rows are (uid, timestamp, latitude, longitude) sorted by uid and timestamp. Returns {uid: (timestamps, latitudes,
+# longitudes, total points)}
+def tracks(rows, method='dp', count=None, tolerance=None):
+    if not rows:
+        return {}
+
+    # Timestamps stay datetimes, converting them all to datetime64 takes longer than simplifying the tracks
+    uids = np.array([row[0] for row in rows], dtype=object)
+    timestamps = np.array([row[1] for row in rows], dtype=object)
+    latitudes = np.array([row[2] for row in rows], dtype=np.float64)
+    longitudes = np.array([row[3] for row in rows], dtype=np.float64)
+
+    result = {}
+    bounds = np.r_[0, np.flatnonzero(uids[1:] != uids[:-1]) + 1, len(uids)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        indexes = start + simplify(timestamps[start:end], latitudes[start:end], longitudes[start:end], method, count,
+                                   tolerance)
+        result[uids[start]] = (timestamps[indexes], latitudes[indexes], longitudes[indexes], int(end - start))
+    return result
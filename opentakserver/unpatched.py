@@ -0,0 +1,74 @@
+import importlib
+import socket
+import sys
+import traceback
+from collections import deque
+
+import eventlet
+from eventlet import patcher
+
+# app.py monkey patches the standard library with eventlet. Threads become green threads that take turns on one OS
+# thread, and selectors only has a SelectSelector that goes through eventlet's hub and registers every socket again on
+# each select(). Loops that have to keep up with thousands of sockets run on a real thread with these modules instead.
+# Without monkey patching they're the same as the usual ones
+
+
+# Like eventlet.patcher.original(), but the module is imported with the original versions of its dependencies.
+# patcher.original('selectors') would still see the patched select module, which has no epoll
+def original(module_name, *dependencies):
+    original_name = "__original_module_" + module_name
+    if original_name in sys.modules:
+        return sys.modules[original_name]
+
+    saver = patcher.SysModulesSaver((module_name,) + dependencies)
+    try:
+        for dependency in dependencies:
+            sys.modules[dependency] = patcher.original(dependency)
+        sys.modules.pop(module_name, None)
+        sys.modules[original_name] = importlib.import_module(module_name)
+    finally:
+        saver.restore()
+
+    return sys.modules[original_name]
+
+
+threading = patcher.original('threading')
+queue = patcher.original('queue')
+selectors = original('selectors', 'select')
+
+
+# Green objects like socketio's queues only work on the OS thread that runs eventlet's hub. Real threads hand
+# functions to call() and a green thread calls them, woken up through a socketpair like SocketServer.call_soon()
+class GreenCalls:
+    def __init__(self, logger):
+        self.logger = logger
+        self.monkey_patched = patcher.is_monkey_patched('thread')
+        self.hub_thread = threading.get_ident()
+        self.calls = deque()
+
+        if self.monkey_patched:
+            self.receiver, self.sender = socket.socketpair()
+            self.sender.setblocking(False)
+            eventlet.spawn(self.run)
+
+    def call(self, function, *args, **kwargs):
+        if not self.monkey_patched or threading.get_ident() == self.hub_thread:
+            function(*args, **kwargs)
+            return
+
+        self.calls.append((function, args, kwargs))
+        try:
+            self.sender.send(b'\0')
+        except BlockingIOError:
+            # The green thread already has wake ups it hasn't read
+            pass
+
+    def run(self):
+        while True:
+            self.receiver.recv(4096)
+            while self.calls:
+                function, args, kwargs = self.calls.popleft()
+                try:
+                    function(*args, **kwargs)
+                except BaseException:
+                    self.logger.error(traceback.format_exc())
@@ -1,4 +1,57 @@
 import base64
+import itertools
+import importlib
+import json
+import os
+import pkgutil
+import random
+import selectors
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+import sqlalchemy
+from flask import Flask
+from flask_security.models import fsqla_v3 as fsqla
+from sqlalchemy import select, tuple_
+
+from opentakserver import geohash, models, unpatched
+from opentakserver.SocketServer import SocketServer
+from opentakserver.UDPServer import receiver
+from opentakserver.controllers.cot_controller import CoTController, Delivery
+from opentakserver.controllers.outbound_queue import OutboundQueue
+from opentakserver.controllers.persistence_pool import PersistencePool
+from opentakserver.cot.datagrams import parse_datagrams
+from opentakserver.cot.envelope import CoTEnvelope
+from opentakserver.cot.event import CoTEvent
+from opentakserver.cot.framer import CoTFramer, ProtobufFramer
+from opentakserver.cot.protobuf import decode_event, encode_event, event_to_message, requested_version
+from opentakserver.cot.wire import WireCoT
+from opentakserver.defaultconfig import DefaultConfig
+from opentakserver.extensions import db, logger
+from opentakserver.migrations import MIGRATIONS, add_last_points, migrate
+from opentakserver.models.CasEvac import CasEvac
+from opentakserver.models.CoT import CoT
+from opentakserver.models.EUD import EUD
+from opentakserver.models.Icon import Icon
+from opentakserver.models.LastPoint import LastPoint
+from opentakserver.models.Point import Point
+from opentakserver.models.SchemaVersion import SchemaVersion
+from opentakserver.presence import PresenceRegistry, pack_change, unpack_change
+from opentakserver.rabbitmq_pool import PooledConnection, RabbitMQPool
+
+# The tests that create tables or query without the app need every model, like init_extensions() does
+try:
+    fsqla.FsModels.set_db_info(db)
+except sqlalchemy.exc.InvalidRequestError:
+    pass
+for module in pkgutil.iter_modules(models.__path__):
+    importlib.import_module("opentakserver.models.{}".format(module.name))
 
 
 def test_marti_api_clientendpoints(client):
@@ -17,6 +70,577 @@ def test_points(auth):
     assert response.status_code == 200
 
 
+def test_points_cursor(app, auth):
+    # Four points share a timestamp and the pages split them, so only the id tiebreak keeps them in order
+    device_uid = str(uuid.uuid4())
+    with app.app_context():
+        for i, minute in enumerate((5, 4, 4, 4, 4, 2, 1)):
+            timestamp = datetime(2001, 1, 1, 0, minute)
+            cot = CoT(how='m-g', type='a-f-G-U-C', sender_callsign=device_uid, sender_uid=device_uid,
+                      xml='<event/>', timestamp=timestamp, start=timestamp, stale=timestamp)
+            cot.point = Point(uid='{}-{}'.format(device_uid, i), device_uid=device_uid, latitude=1, longitude=2,
+                              timestamp=timestamp)
+            db.session.add(cot)
+        db.session.commit()
+        ids = dict(db.session.execute(select(Point.uid, Point.id).where(Point.device_uid == device_uid)).all())
+
+    points = '/api/point?start=2001-01-01T00:00:00Z&end=2001-01-01T00:10:00Z&per_page=3'
+    pages = []
+    cursor = ''
+    while cursor is not None:
+        response = auth.get('{}&cursor={}'.format(points, urllib.parse.quote(cursor)))
+        assert response.status_code == 200
+        pages.append(response.json['results'])
+        cursor = response.json['next_cursor']
+    assert [len(page) for page in pages] == [3, 3, 1]
+
+    keys = [(point['timestamp'], ids[point['uid']]) for page in pages for point in page]
+    # Strictly newest first, which also means no point is on two pages
+    assert all(key > next_key for key, next_key in zip(keys, keys[1:]))
+
+    offset = []
+    for page in range(1, 4):
+        offset += [point['uid'] for point in auth.get('{}&page={}'.format(points, page)).json['results']]
+    assert sorted(point['uid'] for page in pages for point in page) == sorted(offset)
+    assert sorted(offset) == sorted(ids)
+
+    response = auth.get('/api/point?cursor=not-a-cursor')
+    assert response.status_code == 400
+
+
+def test_cot_stream_ndjson(auth):
+    response = auth.get('/api/cot?stream=ndjson')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    for line in response.get_data(as_text=True).splitlines():
+        assert 'sender_uid' in json.loads(line)
+
+
+def test_cot_page_query_count(app, auth):
+    uid = str(uuid.uuid4())
+    with app.app_context():
+        db.session.add(EUD(uid=uid, callsign=uid))
+        for i in range(30):
+            cot = CoT(how='m-g', type='a-f-G-U-C', sender_callsign=uid, sender_uid=uid, xml='<event/>',
+                      timestamp=datetime.utcnow(), start=datetime.utcnow(), stale=datetime.utcnow())
+            cot.point = Point(uid=uid, device_uid=uid, latitude=1, longitude=2, timestamp=datetime.utcnow())
+            db.session.add(cot)
+        db.session.commit()
+
+        statements = []
+
+        def count(*args):
+            statements.append(args)
+
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count)
+
+    query_counts = []
+    for per_page in (1, 30):
+        for cursor in ('', None):
+            statements.clear()
+            path = '/api/cot?sender_uid={}&per_page={}'.format(uid, per_page)
+            response = auth.get(path if cursor is None else path + '&cursor=')
+            assert response.status_code == 200
+            query_counts.append(len(statements))
+
+    with app.app_context():
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute', count)
+
+    # Serializing 30 CoTs costs the same number of queries as serializing one
+    assert query_counts[0] == query_counts[2]
+    assert query_counts[1] == query_counts[3]
+
+
+def test_export_without_pyarrow(auth, monkeypatch):
+    # A None entry makes importing it fail like it isn't installed
+    monkeypatch.setitem(sys.modules, 'pyarrow', None)
+    response = auth.get('/api/export?table=points')
+    assert response.status_code == 501
+    assert 'pyarrow' in response.json['error']
+
+
+def test_casevac_icon_cache():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add(Icon(filename='red_crs.png', groupName='CasEvac'))
+        db.session.commit()
+        assert CasEvac(timestamp=datetime(2024, 4, 24)).to_json()['icon']['filename'] == 'red_crs.png'
+
+        # The Icon is expired by the commit and detached by close(), the cached JSON isn't
+        db.session.commit()
+        db.session.close()
+        assert CasEvac(timestamp=datetime(2024, 4, 24)).to_json()['icon']['groupName'] == 'CasEvac'
+
+
+def test_last_points_backfill():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        # Saved out of order, the highest id isn't the latest position. Of two with the same timestamp the later one wins
+        for uid, minute in (('alpha', 5), ('alpha', 1), ('bravo', 2), ('bravo', 2), ('bravo', 1)):
+            db.session.add(Point(uid=uid, device_uid=uid, timestamp=datetime(2024, 4, 24, 14, minute)))
+        db.session.add(Point(uid='marker', device_uid='alpha', timestamp=datetime(2024, 4, 24, 15)))
+        db.session.commit()
+
+        add_last_points(db, logger)
+        last_points = {last_point.device_uid: last_point.point_id
+                       for last_point in db.session.execute(select(LastPoint)).scalars()}
+        assert last_points == {'alpha': 1, 'bravo': 4}
+
+
 def test_me(auth):
     response = auth.get('/api/me')
     assert response.json['username'] == 'TestUser'
+
+
+# create_app() with its data folder and database in tmp_path. Booting again with the same tmp_path starts from the
+# config.yml and database the first boot left behind
+def fresh_app(tmp_path, monkeypatch):
+    folder = str(tmp_path)
+    monkeypatch.setattr(DefaultConfig, 'OTS_DATA_FOLDER', folder)
+    monkeypatch.setattr(DefaultConfig, 'OTS_ARCHIVE_FOLDER', os.path.join(folder, 'archive'))
+    monkeypatch.setattr(DefaultConfig, 'OTS_CA_FOLDER', os.path.join(folder, 'ca'))
+    monkeypatch.setattr(DefaultConfig, 'UPLOAD_FOLDER', os.path.join(folder, 'uploads'))
+    monkeypatch.setattr(DefaultConfig, 'SQLALCHEMY_DATABASE_URI', 'sqlite:///{}'.format(os.path.join(folder, 'ots.db')))
+
+    from opentakserver.app import create_app
+    return create_app()
+
+
+def test_create_app_fresh_data_folder(tmp_path, monkeypatch):
+    app = fresh_app(tmp_path, monkeypatch)
+    assert os.path.exists(os.path.join(tmp_path, 'config.yml'))
+    with app.app_context():
+        assert db.session.execute(select(EUD)).scalars().all() == []
+
+
+def test_migrations_on_boot(tmp_path, monkeypatch):
+    for boot in range(2):
+        app = fresh_app(tmp_path, monkeypatch)
+        with app.app_context():
+            versions = db.session.execute(select(SchemaVersion.version).order_by(SchemaVersion.version)).scalars()
+            # Applied by the first boot, not again by the second
+            assert list(versions) == list(range(1, len(MIGRATIONS) + 1))
+
+
+def test_failed_migration_stops_boot(monkeypatch):
+    applied = []
+
+    def first(db, logger):
+        applied.append('first')
+
+    def broken(db, logger):
+        raise RuntimeError("broken migration")
+
+    def after(db, logger):
+        applied.append('after')
+
+    monkeypatch.setattr('opentakserver.migrations.MIGRATIONS', [first, broken, after])
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        with pytest.raises(RuntimeError):
+            migrate(db, logger)
+
+        assert applied == ['first']
+        assert db.session.execute(select(SchemaVersion.version)).scalars().all() == [1]
+
+
+def test_stale_status_saved():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add(EUD(uid='stale-uid', callsign='Stale', last_status='Connected'))
+        db.session.commit()
+
+    # Just what save_status() uses, without connecting to RabbitMQ
+    controller = CoTController.__new__(CoTController)
+    controller.app = app
+    controller.contexts = threading.local()
+    controller.db = db
+    controller.logger = logger
+    controller.green = unpatched.GreenCalls(logger)
+    controller.save_status('stale-uid', 'Stale')
+    controller.save_status('unknown-uid', 'Stale')
+
+    with app.app_context():
+        assert db.session.execute(select(EUD.last_status).filter_by(uid='stale-uid')).scalar_one() == 'Stale'
+
+
+# Stands in for a pika channel that has just opened, recording what's published on it
+class OpenChannel:
+    is_open = True
+
+    def __init__(self):
+        self.published = []
+
+    def add_on_close_callback(self, callback):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published.append(body)
+
+
+def test_rabbitmq_pool_pending_publishes():
+    pool = RabbitMQPool()
+    pool.logger = logger
+    pool.connections = [PooledConnection(pool, 0, 2)]
+    pool.round_robin = itertools.cycle(pool.channels())
+    pool.started = True
+
+    # Nothing is open yet, so these wait for the first channel to open instead of being dropped
+    for i in range(3):
+        pool.publish('cot_controller', str(i).encode())
+    assert pool.stats()['pending'] == 3
+
+    channel = OpenChannel()
+    pool.channels()[1].on_channel_open(channel)
+    assert channel.published == [b'0', b'1', b'2']
+    assert pool.stats()['pending'] == 0
+
+
+def test_cot_framer_random_segmentation():
+    events = [b'<auth><cot username="TestUser" password="TestPass" uid="test-uid"/></auth>',
+              b'<event version="2.0" uid="test-uid" type="a-f-G-U-C" how="m-g"><point lat="1" lon="2"/></event>',
+              b'<?xml version="1.0"?><event uid="test-uid-ping" type="t-x-c-t"><detail/></event >']
+    stream = b'\n'.join(events) * 10
+    rng = random.Random(0)
+
+    for i in range(200):
+        framer = CoTFramer()
+        frames = []
+        position = 0
+        while position < len(stream):
+            size = rng.randint(1, 64)
+            frames.extend(framer.feed(stream[position:position + size]))
+            position += size
+
+        assert frames == events * 10
+        assert len(framer) == 0
+
+
+def test_presence_registry_expiry():
+    presence = PresenceRegistry()
+    now = datetime.utcnow()
+    assert presence.connect('uid-1', 'ALPHA', b'<event/>', now, now + timedelta(seconds=10))
+    assert presence.connect('uid-2', 'BRAVO', b'<event/>', now, now + timedelta(minutes=30))
+    assert not presence.connect('uid-1', 'ALPHA', b'<event/>', now, now + timedelta(seconds=10))
+    assert presence.get_uid('ALPHA') == 'uid-1'
+
+    assert presence.expire(time.time() + 5) == []
+    assert presence.expire(time.time() + 11) == ['uid-1']
+    assert presence.get_uid('ALPHA') is None
+    assert 'uid-2' in presence
+
+    presence.disconnect('uid-2')
+    assert presence.get_uid('BRAVO') is None
+    assert [eud.last_status for eud in presence.snapshot()] == ['Stale', 'Disconnected']
+
+
+def test_presence_mirror():
+    presence = PresenceRegistry()
+    mirror = PresenceRegistry()
+    presence.listeners.append(lambda change: mirror.apply(unpack_change(pack_change(change))))
+
+    now = datetime.utcnow().replace(microsecond=0)
+    presence.connect('uid-1', 'ALPHA', b'<event/>', now, now + timedelta(minutes=5))
+    presence.update('uid-1', b'<event v="2"/>', now + timedelta(seconds=1), now + timedelta(minutes=5))
+    assert mirror.roster() == [('uid-1', now + timedelta(seconds=1), b'<event v="2"/>', None)]
+    assert mirror.get_uid('ALPHA') == 'uid-1'
+
+    # A snapshot taken before the EUD went offline doesn't bring it back
+    snapshot = presence.online_euds()[0]
+    presence.disconnect('uid-1', now + timedelta(seconds=2))
+    assert not mirror.apply(('connect',) + snapshot[:5] + ('Connected', snapshot[5]))
+    assert 'uid-1' not in mirror
+
+
+def test_udp_datagrams():
+    sa = (b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><event version="2.0" uid="uid-{}" type="a-f-G" '
+          b'how="m-g"><point lat="1" lon="2" hae="0" ce="0" le="0"/><detail><contact callsign="A"/></detail></event>')
+    # Two halves that are only well-formed when parsed together must not turn into one event
+    datagrams = [sa.replace(b'{}', b'1'), b'<event><!--</event>', b'<event>--></event>', b'junk', sa.replace(b'{}', b'2')]
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server, \
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+        server.bind(('127.0.0.1', 0))
+        server.setblocking(False)
+        for datagram in datagrams:
+            client.sendto(datagram, server.getsockname())
+        time.sleep(0.1)
+        received, truncated = receiver(server, 8).receive()
+
+    assert received == datagrams
+    events = parse_datagrams(received)
+    assert [event.attrs.get('uid') if event else None for event in events] == ['uid-1', None, None, None, 'uid-2']
+    assert events[2] is not None and events[0].find('contact').attrs['callsign'] == 'A'
+
+
+def test_tak_protocol():
+    sa = CoTEvent.from_xml(b'<event version="2.0" uid="uid-1" type="a-f-G" time="2024-04-24T14:00:40.000Z" '
+                           b'start="2024-04-24T14:00:40.000Z" stale="2024-04-24T14:06:40Z" how="m-g"><point lat="1.5" '
+                           b'lon="2" hae="0" ce="9" le="9"/><detail><contact callsign="A &amp; B" endpoint="*:-1:stcp"/>'
+                           b'<contact callsign="C"/><status battery="86"/><track speed="1.6" course="x"/></detail>'
+                           b'</event>')
+    message = event_to_message(sa)
+    assert message.cotEvent.detail.contact.callsign == 'A & B'
+    assert message.cotEvent.staleTime - message.cotEvent.startTime == 360000
+    # What doesn't fit the protobuf fields is kept as XML
+    assert message.cotEvent.detail.xmlDetail == '<contact callsign="C"/><track speed="1.6" course="x"/>'
+
+    proto = encode_event(sa)
+    payload = ProtobufFramer().feed(proto)[0]
+    event = decode_event(payload)
+    assert [contact.attrs for contact in event.find_all('contact')] == [{'callsign': 'C'},
+                                                                        {'callsign': 'A & B', 'endpoint': '*:-1:stcp'}]
+    assert event.attrs['stale'] == '2024-04-24T14:06:40.000Z'
+
+    # Byte by byte, the length varint included
+    framer = ProtobufFramer()
+    assert [frame for byte in proto * 2 for frame in framer.feed(bytes([byte]))] == [payload] * 2
+    with pytest.raises(ValueError):
+        framer.feed(b'<event/>')
+
+    request = CoTEvent.from_xml(b'<event type="t-x-takp-q"><detail><TakControl><TakRequest version="1"/></TakControl>'
+                                b'</detail></event>')
+    assert requested_version(request) == 1
+
+
+def test_wire_cot_shared():
+    sa = CoTEvent.from_xml(b'<event version="2.0" uid="uid-1" type="a-f-G" time="2024-04-24T14:00:40.000Z" '
+                           b'start="2024-04-24T14:00:40.000Z" stale="2024-04-24T14:06:40Z" how="m-g"><point lat="1.5" '
+                           b'lon="2" hae="0" ce="9" le="9"/><detail><contact callsign="A"/></detail></event>')
+    cot = WireCoT(CoTEnvelope.unpack(CoTEnvelope.from_event("uid-1", sa).pack()))
+    assert cot.key == 'uid-1'
+    # Every client gets a view of the same bytes
+    assert cot.xml is cot.xml
+    assert cot.xml.obj is cot.envelope.xml
+    # Translated once when the envelope didn't carry the stream message
+    assert cot.proto is cot.proto
+    assert bytes(cot.proto) == encode_event(sa)
+    assert cot.start.year == 2024
+
+    queue = OutboundQueue()
+    queue.put(cot.xml, cot.key)
+    assert queue.next().obj is cot.envelope.xml
+
+
+def test_persistence_pool_submit_never_blocks():
+    pool = PersistencePool(logger, workers=1)
+    # The workers are real threads even after another test imports app.py and eventlet monkey patches threading
+    release = unpatched.threading.Event()
+    saved = []
+    done = []
+    pool.submit('uid', release.wait)
+    while pool.depth:
+        time.sleep(0.01)
+
+    # The worker is stuck but submit() still returns right away
+    start = time.monotonic()
+    for i in range(1000):
+        pool.submit('uid', saved.append, i, done=lambda: done.append(True))
+    assert time.monotonic() - start < 0.5
+    assert pool.depth == 1000
+    assert not done
+
+    # A task that raises is still marked done, so its RabbitMQ message is acked
+    pool.submit('uid', int, 'not a number', done=lambda: done.append(False))
+    release.set()
+    pool.stop()
+    assert saved == list(range(1000))
+    assert done == [True] * 1000 + [False]
+
+
+def test_delivery_acked_after_saves():
+    class Channel:
+        is_open = True
+        acked = []
+
+        def basic_ack(self, delivery_tag):
+            self.acked.append(delivery_tag)
+
+    class Connection:
+        is_open = True
+
+        def __init__(self):
+            self.ioloop = self
+            self.callbacks = []
+
+        def add_callback_threadsafe(self, callback):
+            self.callbacks.append(callback)
+
+    controller = type('Controller', (), {'rabbit_connection': Connection()})()
+    channel = Channel()
+    delivery = Delivery(controller, channel, 7)
+    delivery.add()
+    delivery.add()
+    delivery.release()
+
+    delivery.saved()
+    controller.rabbit_connection.callbacks.pop()()
+    assert channel.acked == []
+    delivery.saved()
+    controller.rabbit_connection.callbacks.pop()()
+    assert channel.acked == [7]
+
+
+def test_tak_protocol_switch_mid_read():
+    app = Flask(__name__)
+    app.config.from_object(DefaultConfig)
+    server = SocketServer(logger, app.app_context(), 0)
+    server.selector = selectors.DefaultSelector()
+    sock, reader = socket.socketpair()
+    server.add_client(sock, '127.0.0.1', 0)
+    client = server.clients[sock.fileno()]
+    payloads = []
+    client.handle_message = payloads.append
+
+    ping = encode_event(CoTEvent.from_xml(b'<event version="2.0" uid="uid-1-ping" type="t-x-c-t" '
+                                          b'time="2024-04-24T14:00:40.000Z" start="2024-04-24T14:00:40.000Z" '
+                                          b'stale="2024-04-24T14:01:40.000Z" how="h-g-i-g-o"><point lat="0" lon="0" '
+                                          b'hae="0" ce="9" le="9"/></event>'))
+    request = (b'<event version="2.0" uid="protouid" type="t-x-takp-q"><detail><TakControl><TakRequest version="1"/>'
+               b'</TakControl></detail></event>\n')
+    # The request, a whole stream message and part of another in one recv(), the rest of it in the next one
+    client.receive(request + ping + ping[:5])
+    assert client.protocol_version == 1
+    client.receive(ping[5:])
+    assert payloads == ProtobufFramer().feed(ping * 2)
+
+    sock.close()
+    reader.close()
+
+
+def test_outbound_queue_coalescing():
+    queue = OutboundQueue(max_size=3)
+    assert queue.put(b'alpha-1', 'alpha')
+    assert queue.put(b'bravo-1', 'bravo')
+    assert queue.put(b'chat')
+    assert queue.put(b'alpha-2', 'alpha')
+    assert not queue.put(b'chat-2')
+    assert not queue.put(b'charlie-1', 'charlie')
+    assert (queue.coalesced, queue.dropped, len(queue)) == (1, 2, 3)
+
+    queue.next()
+    queue.sent(3)
+    assert bytes(queue.next()) == b'ha-2'
+    queue.sent(4)
+
+    sent = []
+    while queue.next() is not None:
+        sent.append(bytes(queue.next()))
+        queue.sent(len(queue.next()))
+    assert sent == [b'bravo-1', b'chat']
+
+
+def test_tls_handshake_timeout(app):
+    app.config['OTS_SSL_HANDSHAKE_TIMEOUT'] = 1
+    server = SocketServer(logger, app.app_context(), 0, True)
+    server.start()
+    while not server.accepting:
+        time.sleep(0.1)
+
+    # A client that never sends its ClientHello is dropped without holding up the next one
+    stalled = socket.create_connection(('127.0.0.1', server.socket.getsockname()[1]))
+    stalled.settimeout(5)
+    other = socket.create_connection(('127.0.0.1', server.socket.getsockname()[1]))
+    other.close()
+    assert stalled.recv(1) == b''
+    assert server.handshake_stats()['timed_out'] == 1
+
+    stalled.close()
+    server.stop()
+
+
+def test_geohash_cover():
+    assert geohash.encode(57.64911, 10.40744, 11) == 'u4pruydqqvj'
+
+    rng = random.Random(0)
+    for west, south, east, north in ((-74.1, 40.6, -73.8, 40.9), (179.5, -10, -179.5, 10), (-180, -90, 180, 90)):
+        ranges = geohash.cover(west, south, east, north)
+        for i in range(500):
+            latitude = rng.uniform(south, north)
+            if west > east:
+                longitude = rng.choice((rng.uniform(west, 180), rng.uniform(-180, east)))
+            else:
+                longitude = rng.uniform(west, east)
+            point = geohash.encode(latitude, longitude)
+            assert any(low <= point < high for low, high in ranges)
+
+
+def test_track_simplification():
+    pytest.importorskip('numpy')
+    from opentakserver import tracks
+
+    # Heading east along the equator with a 50 m detour in the middle
+    latitudes = [0.0] * 101
+    latitudes[50] = 50 / geohash.METERS_PER_DEGREE
+    longitudes = [i / 1000 for i in range(101)]
+    timestamps = [datetime(2024, 1, 1) + timedelta(seconds=i) for i in range(101)]
+    rows = [('bravo', timestamps[i], latitudes[i], longitudes[i]) for i in range(101)]
+    rows.insert(0, ('alpha', timestamps[0], 1.0, 1.0))
+
+    result = tracks.tracks(rows, 'dp', tolerance=10)
+    assert result['alpha'][3] == 1
+    # The points either side of the detour are far off the lines to its peak
+    assert result['bravo'][2].tolist() == [0, 0.049, 0.05, 0.051, 0.1]
+    assert result['bravo'][3] == 101
+    assert len(tracks.tracks(rows, 'dp', tolerance=100)['bravo'][1]) == 2
+    assert list(tracks.tracks(rows, 'dp', count=3)['bravo'][2]) == [0, 0.05, 0.1]
+
+    result = tracks.tracks(rows, 'time', count=11)
+    assert list(result['bravo'][0]) == timestamps[::10]
+
+
+# The queries behind search() filters, cursor pagination and the CoT writer, and the index each one should use
+QUERY_PLANS = {
+    'ix_cot_sender_uid_timestamp': select(CoT).where(CoT.sender_uid == 'uid').order_by(CoT.timestamp.desc()).limit(10),
+    'ix_cot_type_timestamp': select(CoT).where(CoT.type == 'a-f-G-U-C').order_by(CoT.timestamp.desc()).limit(10),
+    'ix_cot_timestamp_id': select(CoT).where(tuple_(CoT.timestamp, CoT.id) < tuple_(datetime(2024, 1, 1), 100))
+    .order_by(CoT.timestamp.desc(), CoT.id.desc()).limit(10),
+    'ix_points_device_uid_timestamp': select(Point).where(Point.device_uid == 'uid')
+    .order_by(Point.timestamp.desc()).limit(10),
+    'ix_points_timestamp_id': select(Point).order_by(Point.timestamp.desc(), Point.id.desc()).limit(10),
+    'ix_points_geohash': select(Point.id).where(Point.geohash >= 'dr5r', Point.geohash < 'dr5s'),
+}
+
+
+# Set OTS_TEST_POSTGRESQL_URI to a scratch database to check PostgreSQL too. Everything runs in a transaction that's
+# rolled back
+@pytest.mark.parametrize('database', ['sqlite', 'postgresql'])
+def test_query_plans(database):
+    if database == 'sqlite':
+        engine = sqlalchemy.create_engine('sqlite://')
+    elif os.environ.get('OTS_TEST_POSTGRESQL_URI'):
+        engine = sqlalchemy.create_engine(os.environ.get('OTS_TEST_POSTGRESQL_URI'))
+    else:
+        pytest.skip('OTS_TEST_POSTGRESQL_URI is not set')
+
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        db.metadata.create_all(connection)
+
+        if database == 'postgresql':
+            # The tables are empty, so without this the planner would always pick a sequential scan
+            connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+
+        for index, statement in QUERY_PLANS.items():
+            compiled = statement.compile(connection)
+            if database == 'sqlite':
+                plan = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled),
+                                                  tuple(compiled.params[name] for name in compiled.positiontup))
+            else:
+                plan = connection.exec_driver_sql('EXPLAIN ' + str(compiled), compiled.params)
+            plan = ' '.join(str(row[-1]) for row in plan)
+            assert index in plan, '{} not used: {}'.format(index, plan)
+
+        transaction.rollback()